@@ -3,6 +3,9 @@
 import sys
 import os
 import json
+import argparse
+import asyncio
+import cProfile
 
 sys.path.insert(0, 'src')
 
@@ -11,38 +14,277 @@ from chem_feature import *
 from action_feature import *
 from link_feature import *
 from query_feature import *
+from pipeline import run_pipeline, combine_batch_csvs
+from batch_output import index_file_dict
+from import_feature import read_sample_csvs, save_import_files, check_import_files, import_command
+from bolt_loader import Neo4jGraph, load_samples, read_sample_frames, result_frames
+from benchmark import run_benchmark, benchmark_similarity
+from graph_index import build_graph_index, index_file_tables
+from similarity import update_similarity_index
+from ingest import IngestDaemon
+import instrument
 
 # data = get_data()
-# act = save_action_csvs(data[0], data[1])
+# act = save_action_csvs(save_chem_csvs(data, 'b19'))
 # save_link_csvs(act)
 # save_queries()
 
-def main(targets):
+def main(targets, data_dir='test/testdata', workers=None, chunksize=1, samples=None, manifest=None,
+         load_mode='create', batch_size=1000, legacy=False, uri='bolt://localhost:7687', user='neo4j',
+         output_store=None, bench_sizes=(1, 10, 100, 1000), metrics=None, trace_memory=False,
+         batch_output=False, table_format='csv', shared_chemicals=False,
+         decode_threads=None, fit_metrics=False, features=False, spin_store=None, spin_interval=None,
+         watch_interval=2.0, settle=5.0, queue_size=16, image_preview=None, recipe_cache=None):
     '''
     Runs the main project pipeline on the given targets.
     Targets are "data", "features", "graph"
     
     'main' should run the targets in order:
     'data' -> 'features' -> 'graph'
+    
+    The "batches" target replaces "data" and "features" for a folder of batches
+    (data_dir), processing the samples in parallel with the given number of workers:
+    'batches' -> 'graph'
+    
+    The "load" target can replace "graph" to write the samples straight to the
+    Neo4j database at uri over Bolt (the password is read from NEO4J_PASSWORD). After
+    "batches", the tables of the samples are loaded as they are, without reading the files back.
+    
+    The "import" target can replace "graph" to write the files of an offline load
+    with neo4j-admin database import (in the import folder) instead of a cypher file.
+    
+    The "index" target saves the graph of the tables in the graph_index folder, for lineage
+    queries without Neo4j (see graph_index.load_graph_index).
+    
+    With an output_store folder, the characterization outputs are saved there as .npy
+    files and the action csv files only reference them.
+    
+    With a manifest file, only the samples whose inputs changed since the last run
+    are processed and written to the cypher file.
+    
+    With batch_output, the "batches" target writes one chem, one action and one link
+    csv per batch, indexed in output_index.csv, instead of three csv files per sample.
+    
+    With the "merge" load mode, the csv files are combined into one file per batch
+    and the cypher file merges them in batches of batch_size rows.
+    
+    The "benchmark" target times every stage of the pipeline on synthetic batches
+    of bench_sizes samples and saves the results in benchmark.csv, and times the queries
+    of the similarity index at archive sizes in similarity_benchmark.csv.
+    
+    With a metrics file, the wall time, cpu time, rows, bytes written (and peak memory 
+    with trace_memory) of every stage of every sample are appended to the file as JSON lines.
+    
+    With the "parquet" table_format, the "batches" target saves the tables as typed
+    parquet files, for the "load" and "import" targets (the cypher file needs csv files).
+    
+    With shared_chemicals, the solutes, solvents and antisolvents are Chemical nodes shared by 
+    every sample in the cypher file, only the Mix solutions belong to their sample.
+    
+    With decode_threads, each worker reads the characterization files of a sample with
+    that many threads.
+    
+    With fit_metrics, the PL and transmission metrics of the samples are computed for each
+    batch and added to the action tables as fitted_metrics steps.
+    
+    With features, the "batches" target adds the process-parameter vectors of the samples
+    to the similarity index saved in the similarity_index folder.
+    
+    With a spin_store folder, the "batches" target saves the spin logs there as compressed
+    time series (one point every spin_interval seconds, if any) and the spin rows only
+    reference them.
+    
+    With image_preview, the "batches" target reads every image_preview-th row and column
+    of the characterization images only.
+    
+    With a recipe_cache json file, the recipe strings parsed by the "batches" target are
+    loaded from the file before the samples and saved to it after them.
+    
+    The "watch" target runs until interrupted: it polls data_dir every watch_interval seconds
+    and processes each sample once its worklist entries and characterization files have not
+    changed for settle seconds, writing its cypher file in the cypher folder (and loading it
+    into Neo4j with the "load" target), with at most queue_size samples waiting for the workers.
     '''
+    if table_format == 'parquet' and 'graph' in targets:
+        raise ValueError('the graph target loads csv files, use the load or import target with parquet tables')
+    if shared_chemicals and 'batches' not in targets and 'watch' not in targets:
+        raise ValueError('the chemical keys of the shared chemicals are added by the batches and watch targets')
+    if shared_chemicals and ('load' in targets or 'import' in targets):
+        raise ValueError('the load and import targets write one Chemical node per sample, '
+                         'the shared chemicals are only made by the cypher queries of the graph target')
+    
+    if metrics != None:
+        instrument.enable(memory=trace_memory)
+    
     if 'test' in targets:
         targets = ['data', 'features', 'graph']
     
+    if 'watch' in targets:
+        graph = None
+        if 'load' in targets:
+            graph = Neo4jGraph(uri, user, os.environ.get('NEO4J_PASSWORD', ''))
+        daemon = IngestDaemon(data_dir, graph=graph, interval=watch_interval, settle=settle, queue_size=queue_size,
+                              workers=workers or os.cpu_count(), manifest_file=manifest, store=output_store,
+                              shared_chemicals=shared_chemicals)
+        try:
+            asyncio.run(daemon.run())
+        except KeyboardInterrupt:
+            pass
+        if graph != None:
+            graph.close()
+        if metrics != None:
+            instrument.write_records(instrument.take_records(), metrics)
+        return
+    
     if 'data' in targets:
         data = get_data()
     
     if 'features' in targets:
-        save_chem_csvs(data[0], 'b19')
+        # the samples are streamed through the three stages one at a time
+        samples = save_chem_csvs(data, 'b19')
         
-        action_dfs = save_action_csvs(data[0], data[1])
+        action_dfs = save_action_csvs(samples, store=output_store)
         
         save_link_csvs(action_dfs)
         
+    file_dict = None
+    replaced = []
+    if 'batches' in targets:
+        results = run_pipeline(data_dir, workers, chunksize, samples, manifest_file=manifest, store=output_store,
+                               batch_output=batch_output, table_format=table_format, 
+                               shared_chemicals=shared_chemicals, decode_threads=decode_threads, 
+                               fit_metrics=fit_metrics, features=features, spin_store=spin_store,
+                               spin_interval=spin_interval, image_preview=image_preview,
+                               recipe_cache_file=recipe_cache, return_tables='load' in targets)
+        if features:
+            update_similarity_index(results)
+        if batch_output:
+            file_dict = index_file_dict('output_index.csv')
+        else:
+            file_dict = {(r['batch_id'], r['sample']): r for r in results if r['changed']}
+        replaced = [(r['batch_id'], r['sample']) for r in results if r['replaced']]
+        
     if 'graph' in targets:
-        save_queries()
+        if load_mode == 'merge':
+            if file_dict == None:
+                file_dict, file_list = find_local_csv_files()
+            # the batch files are already one file per batch
+            if not batch_output:
+                file_dict = combine_batch_csvs(file_dict)
+            save_batch_queries(file_dict, replaced, batch_size=batch_size, legacy=legacy, 
+                               shared_chemicals=shared_chemicals)
+        elif batch_output:
+            save_queries(replaced=replaced, index='output_index.csv', shared_chemicals=shared_chemicals)
+        else:
+            save_queries(file_dict, replaced, shared_chemicals=shared_chemicals)
+            
+    if 'load' in targets:
+        if 'batches' in targets:
+            # the tables of the samples processed in this run are loaded without reading their files
+            frames = result_frames(results)
+        else:
+            file_dict, file_list = find_local_csv_files()
+            frames = read_sample_frames(file_dict)
+        graph = Neo4jGraph(uri, user, os.environ.get('NEO4J_PASSWORD', ''))
+        load_samples(graph, frames, replaced, batch_size=batch_size, workers=workers or 4)
+        graph.close()
+        
+    if 'import' in targets:
+        if file_dict == None:
+            file_dict, file_list = find_local_csv_files()
+        files = save_import_files(*read_sample_csvs(file_dict))
+        problems = check_import_files(files)
+        for problem in problems:
+            print(problem)
+        if len(problems) == 0:
+            print(import_command(files))
+        
+    if 'index' in targets:
+        if file_dict == None:
+            file_dict, file_list = find_local_csv_files()
+        build_graph_index(*index_file_tables(file_dict)).save('graph_index')
         
+    if 'benchmark' in targets:
+        results = run_benchmark(bench_sizes)
+        print(results.to_string(index=False))
+        results.to_csv('benchmark.csv', index=False)
+        results = benchmark_similarity()
+        print(results.to_string(index=False))
+        results.to_csv('similarity_benchmark.csv', index=False)
+        
+    if metrics != None:
+        instrument.write_records(instrument.take_records(), metrics)
+    
     return
         
 if __name__ == '__main__':
-    targets = sys.argv[1:]
-    main(targets)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('targets', nargs='*')
+    parser.add_argument('--data-dir', default='test/testdata', 
+                        help='folder with one batch or one subfolder per batch')
+    parser.add_argument('--workers', type=int, default=None, 
+                        help='number of worker processes, defaults to the number of cpus')
+    parser.add_argument('--chunksize', type=int, default=1, 
+                        help='number of samples sent to a worker at a time')
+    parser.add_argument('--samples', nargs='+', default=None, 
+                        help='only process these samples')
+    parser.add_argument('--manifest', default=None, 
+                        help='manifest csv with the hash of each sample, only changed samples are processed')
+    parser.add_argument('--load-mode', choices=['create', 'merge'], default='create', 
+                        help='create: 6 queries per sample, merge: batched MERGE of one csv per batch')
+    parser.add_argument('--batch-size', type=int, default=1000, 
+                        help='rows per transaction in the merge load mode and per write in the load target')
+    parser.add_argument('--legacy', action='store_true', 
+                        help='use the Neo4j 4.x syntax in the merge load mode')
+    parser.add_argument('--uri', default='bolt://localhost:7687', help='Neo4j uri for the load target')
+    parser.add_argument('--user', default='neo4j', help='Neo4j user for the load target')
+    parser.add_argument('--output-store', default=None, 
+                        help='folder where the characterization outputs are saved as .npy files')
+    parser.add_argument('--bench-sizes', type=int, nargs='+', default=[1, 10, 100, 1000], 
+                        help='numbers of samples of the synthetic batches of the benchmark target')
+    parser.add_argument('--batch-output', action='store_true', 
+                        help='write one chem, action and link csv per batch instead of per sample')
+    parser.add_argument('--table-format', choices=['csv', 'parquet'], default='csv', 
+                        help='format of the tables of the batches target, parquet needs pyarrow')
+    parser.add_argument('--shared-chemicals', action='store_true', 
+                        help='solutes, solvents and antisolvents are graph nodes shared by every sample')
+    parser.add_argument('--decode-threads', type=int, default=None, 
+                        help='threads of each worker reading the characterization files of a sample')
+    parser.add_argument('--fit-metrics', action='store_true', 
+                        help='add the PL and transmission metrics of each sample to its action table')
+    parser.add_argument('--features', action='store_true', 
+                        help='add the feature vectors of the samples to the similarity index')
+    parser.add_argument('--spin-store', default=None, 
+                        help='folder where the spin logs of the batches target are saved as .npz files')
+    parser.add_argument('--spin-interval', type=float, default=None, 
+                        help='seconds between the points kept in the spin logs of the spin store')
+    parser.add_argument('--image-preview', type=int, default=None, 
+                        help='read every n-th row and column of the characterization images only')
+    parser.add_argument('--recipe-cache', default=None, 
+                        help='json file of the parsed recipe strings kept between runs of the batches target')
+    parser.add_argument('--watch-interval', type=float, default=2.0, 
+                        help='seconds between two scans of the data directory in the watch target')
+    parser.add_argument('--settle', type=float, default=5.0, 
+                        help='seconds without changes before the watch target processes a sample')
+    parser.add_argument('--queue-size', type=int, default=16, 
+                        help='samples of the watch target waiting for a worker')
+    parser.add_argument('--metrics', default=None, 
+                        help='JSON lines file where the time, rows and bytes of every stage are appended')
+    parser.add_argument('--trace-memory', action='store_true', 
+                        help='also record the peak memory of every stage in the metrics file')
+    parser.add_argument('--profile', default=None, 
+                        help='file where the cProfile stats of the run are saved')
+    args = parser.parse_args()
+    
+    if args.profile != None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    main(args.targets, args.data_dir, args.workers, args.chunksize, args.samples, args.manifest,
+         args.load_mode, args.batch_size, args.legacy, args.uri, args.user, args.output_store,
+         args.bench_sizes, args.metrics, args.trace_memory, args.batch_output, args.table_format,
+         args.shared_chemicals, args.decode_threads, args.fit_metrics,
+         args.features, args.spin_store, args.spin_interval, args.watch_interval, args.settle,
+         args.queue_size, args.image_preview, args.recipe_cache)
+    if args.profile != None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
@@ -1,12 +1,22 @@
 from os import listdir, remove
-from os.path import isfile, join
+from os.path import isfile, join, getsize
 from json import load, loads
-from tifffile import imread,imwrite
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition
+from tifffile import imread,imwrite,TiffFile
+from tifffile import memmap as tifffile_memmap
 from re import search, findall
+from fnmatch import fnmatchcase
 
 import numpy as np
 import pandas as pd
 
+from output_store import store_outputs
+from spin_logs import store_spin_logs
+from char_metrics import metrics_row
+from instrument import stage, helper, file_size
+
 def step_helper(worklists):
     """
     Helper function to get the step names for each step in worklist(s).
@@ -24,6 +34,10 @@ def step_helper(worklists):
     
     return steps
 
+# keys of a step that are not copied into its rows
+step_exclude = frozenset(['precedent', 'id', 'details'])
+char_exclude = step_exclude | {'name', 'sample'}
+
 def dissolve_helper(drop_list, step_num = None):
     drop_steps = drop_list['details']['drops']
     
@@ -89,7 +103,7 @@ def anneal_helper(anneal_list, step_num):
     for i in anneal_info:
         anneal_row['anneal_'+i] = anneal_info.get(i)
         
-    attributes = [i for i in anneal_list.keys() if i not in ['precedent', 'id', 'details']]
+    attributes = [i for i in anneal_list if i not in step_exclude]
     for i in attributes:
         anneal_row[i] = anneal_list[i]
     row.append(anneal_row)
@@ -99,7 +113,7 @@ def rest_helper(rest_step, step_num):
     rest_row = {'step_id': step_num, 'action':'rest'}
     rest_row['rest_duration'] = rest_step['details']['duration']
     
-    attributes = [i for i in rest_step.keys() if i not in ['precedent', 'id', 'details']]
+    attributes = [i for i in rest_step if i not in step_exclude]
     for i in attributes:
         rest_row[i] = rest_step[i]
     return [rest_row]
@@ -107,6 +121,7 @@ def rest_helper(rest_step, step_num):
 def char_helper(char_list, step_num):
     char_rows = []
     char_details = char_list['details']['characterization_tasks']
+    attributes = [i for i in char_list if i not in char_exclude]
     for char in char_details:
         char_params = [i for i in list(char['details'].keys())]
         char_info = [i for i in char if i != 'details']
@@ -125,7 +140,6 @@ def char_helper(char_list, step_num):
             else:
                 row['char_'+i] = char[i]
                 
-        attributes = [i for i in char_list.keys() if i not in ['precedent', 'id', 'details', 'name', 'sample', ]]
         for i in attributes:
             row[i] = char_list[i]
         char_rows.append(row)
@@ -143,115 +157,401 @@ func_map = {
     "characterization_tasks": char_helper
 }
 
+# handlers of the worklist steps by (step key, step name) and by step key, see register_step
+step_handlers = {}
+# number of steps of each unknown type skipped by action_table since the last take_unknown_steps
+unknown_steps = Counter()
+# number of rows with a column their handler did not declare, since the last take_undeclared_columns
+undeclared_columns = Counter()
+# whether a column matches the declared columns of a handler, by (column, declared columns)
+declared_matches = {}
+
+# keys of a worklist step copied into the rows of its anneal, rest and char steps
+step_attributes = ['name', 'sample', 'start', 'start_actual', 'finish_actual', 'duration']
+
+def register_step(key, helpers, name = None, columns = None):
+    """
+    Registers how action_table makes the rows of a type of worklist step, e.g. for a new instrument.
+    
+    :param key: the key of the step's details, e.g. 'drops'
+    :param helpers: list of (helper name, function, gap) called in turn with the step and the step
+        number. Each function returns a list of rows (dictionaries with a step_id), and the next
+        function (or step) is numbered from the step_id of the last row plus gap.
+        An empty list skips the step
+    :param name: optional name of the step, the handler is then only used for the steps with this
+        name (e.g. the 'duration' steps named 'anneal'), before the handler of the key
+    :param columns: optional list of the columns the helpers make, as names or fnmatch patterns
+        (e.g. 'spin_*'). The rows with other columns are counted in undeclared_columns
+    """
+    step_handlers[(key, name)] = {'helpers': list(helpers), 'columns': tuple(columns) if columns != None else None}
+
+def find_handler(step):
+    """Handler (helpers and columns) of a worklist step (see register_step), or None for an unknown step type"""
+    key = next(iter(step['details']))
+    handler = step_handlers.get((key, step.get('name')))
+    if handler is None:
+        handler = step_handlers.get((key, None))
+    if handler is None:
+        unknown_steps[key] += 1
+    return handler
+
+def take_unknown_steps():
+    """Returns the counts of the unknown step types skipped by action_table and clears them"""
+    res = dict(unknown_steps)
+    unknown_steps.clear()
+    return res
+
+def take_undeclared_columns():
+    """Returns the counts of the rows with undeclared columns, by column, and clears them"""
+    res = dict(undeclared_columns)
+    undeclared_columns.clear()
+    return res
+
+def report_steps(unknown, undeclared):
+    """
+    Prints the totals of the counts of take_unknown_steps and take_undeclared_columns of 
+    many samples (lists of dictionaries), when there are any
+    """
+    for counts, message in [(unknown, 'skipped worklist steps of an unknown type:'),
+                            (undeclared, 'rows with columns their step handler did not declare:')]:
+        total = Counter()
+        for c in counts:
+            total.update(c)
+        if len(total) > 0:
+            print(message, dict(total))
+
+def is_declared(col, columns):
+    if (col, columns) not in declared_matches:
+        declared_matches[(col, columns)] = any(fnmatchcase(col, pattern) for pattern in columns)
+    return declared_matches[(col, columns)]
+
+step_columns = {
+    'drops': ['step_id', 'action', 'chemical_from', 'drop_*', 'spin_*', 'start', 'start_actual', 'finish_actual',
+              'liquidhandler_timings', 'spincoater_log'],
+    'spin': ['step_id', 'action', 'spin_*', 'start', 'start_actual', 'finish_actual', 'liquidhandler_timings',
+             'spincoater_log'],
+    'anneal': ['step_id', 'action', 'anneal_*'] + step_attributes,
+    'duration': ['step_id', 'action', 'rest_duration'] + step_attributes,
+    'characterization_tasks': ['step_id', 'action', 'char_*'] + step_attributes
+}
+register_step('destination', [], columns=[])
+register_step('drops', [('dissolve', dissolve_helper, 0), ('drops', drop_helper, 3), ('spin', spin_helper, 2)],
+              columns=step_columns['drops'])
+register_step('duration', [('anneal', anneal_helper, 2)], name='anneal', columns=step_columns['anneal'])
+for key in ['spin', 'anneal', 'duration', 'characterization_tasks']:
+    register_step(key, [(key, func_map[key], 2)], columns=step_columns[key])
+
+class ActionColumns:
+    """
+    Column buffers the action table is built in: every row is added to one list per column and
+    the DataFrame is built once at the end. A column is registered the first time a row has it
+    (the rows before get NaN), so the columns are in the order the steps bring them, as with
+    pd.DataFrame(rows).
+    """
+    def __init__(self):
+        self.columns = {}
+        self.rows = 0
+        # step_id of the last row, the next steps are numbered from it
+        self.last_step = None
+
+    def add_rows(self, rows, columns = None):
+        """
+        Adds rows to the buffers. With the columns declared by their handler (see register_step),
+        the rows with other columns are counted in undeclared_columns
+        """
+        for row in rows:
+            for col in row:
+                if columns != None and not is_declared(col, columns):
+                    undeclared_columns[col] += 1
+                if col not in self.columns:
+                    self.columns[col] = [np.nan] * self.rows
+            for col, values in self.columns.items():
+                values.append(row.get(col, np.nan))
+            self.rows += 1
+            self.last_step = row['step_id']
+
+    def fill(self, col, value):
+        """Sets a column to value for every row added so far"""
+        self.columns[col] = [value] * self.rows
+
+    def frame(self):
+        return pd.DataFrame(self.columns)
+
 # PIPELINE
-def action_table(worklists, sample_id=np.nan, batch_id=np.nan):
+def action_table(worklists, sample_id=np.nan, batch_id=np.nan, output_df=None, metrics=None):
     """
     The action_table function takes in one or more worklists. 
     If more than one worklist, include it in a list.
+    With the output_df of char_outputs, the char_output rows are added at the end of the
+    table in the same pass (see append_outputs).
+    With the metrics of the sample (a row of char_metrics.batch_metrics as a dictionary),
+    a fitted_metrics row is added last.
+    The rows of each step are made by the helpers registered for its type (see register_step),
+    steps of an unknown type are skipped and counted in unknown_steps, and the rows with
+    columns their handler did not declare are counted in undeclared_columns.
     """
     if type(worklists[0]) != list:
         worklists = [worklists]
-        
-    # obtain steps from worklists
-    steps = step_helper(worklists)
     
-    rows = []
+    table = ActionColumns()
     step_num = 1
-    for i in range(len(worklists)):
-        curr_worklist = worklists[i]
-        curr_steplist = steps[i]
-        for j in range(len(curr_steplist)):
-            if curr_steplist[j] == 'destination':
+    for worklist in worklists:
+        for step in worklist:
+            handler = find_handler(step)
+            if handler is None:
                 continue
-            else:
-                if curr_steplist[j] == 'drops':
-                    rows = rows + func_map['dissolve'](curr_worklist[j], step_num)
-                    step_num = rows[-1]['step_id']
-                    rows = rows + func_map['drops'](curr_worklist[j], step_num)
-                    step_num = rows[-1]['step_id']+3
-                    rows = rows + func_map['spin'](curr_worklist[j], step_num)
-                    step_num = rows[-1]['step_id']+2
-                else:
-                    if curr_steplist[j] == 'duration' and curr_worklist[j]['name'] == 'anneal':
-                        rows = rows + func_map['anneal'](curr_worklist[j], step_num)
-                    else:
-                        rows = rows + func_map[curr_steplist[j]](curr_worklist[j], step_num)
-                    step_num = rows[-1]['step_id']+2
+            for name, func, gap in handler['helpers']:
+                table.add_rows(helper(name, func, step, step_num), handler['columns'])
+                step_num = table.last_step + gap
     
-    res = pd.DataFrame(rows)
-    res['sample_id'] = [sample_id] * res.shape[0]
-    res['batch_id'] = [batch_id] * res.shape[0]
+    table.fill('sample_id', sample_id)
+    table.fill('batch_id', batch_id)
+    if output_df is not None:
+        table.add_rows(output_rows(output_df, table.last_step+2, sample_id, batch_id))
+    row = metrics_row(metrics, table.last_step+2, sample_id, batch_id)
+    if row != None:
+        table.add_rows([row])
     
-    return res
+    return table.frame()
 
 # PIPELINE
-# helper function used in char_outputs.
-def load_image(fid):
-    img = imread(fid) * 64 * 255
-    img = img.astype(np.float32)
-    img = np.dot(img[...,:3], [0.2989, 0.5870, 0.1140]) #convert to single channel/greyscale??
-    return img.astype(int) #truncate
+# helper functions used in char_outputs.
+# weights of the red, green and blue channels in the greyscale image, and the scale of the values
+grey_weights = np.array([0.2989, 0.5870, 0.1140], dtype=np.float32)
+grey_scale = np.float32(64 * 255)
 
-# PIPELINE
-def char_outputs(folder, sample):
-    path = folder + '/' + sample + "/characterization0"
-    fids = [f for f in listdir(path)]
+def read_tiff(fid):
+    """
+    Opens a tiff without decoding it when possible: uncompressed tiffs are memory-mapped,
+    so only the pixels that are used get read. Other tiffs are decoded with imread.
+    """
+    try:
+        return tifffile_memmap(fid, mode='r')
+    except ValueError:
+        return imread(fid)
+
+def is_colour(img):
+    """Whether the last axis of an image holds its colour channels (RGB or RGBA)"""
+    return img.ndim >= 3 and img.shape[-1] in (3, 4)
+
+def to_greyscale(img, block_rows = 256):
+    """
+    Converts an image to a greyscale int32 image, 64 * 255 * (0.2989 R + 0.5870 G + 0.1140 B),
+    truncated. Single channel images are only scaled. Stacks of frames, (frames, rows, columns) or
+    (frames, rows, columns, channels), give a stack of greyscale frames.
+    The frames are converted one at a time, in blocks of block_rows rows that are converted to
+    float32 one at a time, so the only full size array is the int32 result (integer images are
+    not scaled in their own dtype, which could overflow). Values are clipped to the int32 range.
+    """
+    colour = is_colour(img)
+    res = np.empty(img.shape[:-1] if colour else img.shape, dtype=np.int32)
+    limits = np.iinfo(np.int32)
+    # the axes before the rows, columns (and channels) are frames
+    frames = img.shape[:max(img.ndim - (3 if colour else 2), 0)]
+    rows = img.shape[len(frames)]
+    for frame in np.ndindex(frames):
+        for i in range(0, rows, block_rows):
+            block = np.array(img[frame + (slice(i, i + block_rows),)], dtype=np.float32)
+            if colour:
+                block = block[..., :3] @ grey_weights
+            block *= grey_scale
+            np.clip(block, limits.min, limits.max, out=block)
+            res[frame + (slice(i, i + block_rows),)] = block
+    return res
+
+def load_image(fid, preview = None):
+    """
+    Reads a characterization image as a greyscale int32 array (see to_greyscale).
     
-    data = []
-    ids = []
-    for fid in fids:
-        if '.tif' in fid:
-            data.append(load_image(path+"/"+fid))
-        elif '.csv' in fid:
-            data.append(pd.read_csv(path+"/"+fid).drop(0,axis=0).to_dict())
-        else:
-            print('haven\'t had to deal w this filetype yet')
+    :param preview: optional step, only every preview-th row and column is read and converted
+    """
+    img = read_tiff(fid)
+    if preview != None:
+        # rows and columns are the last two axes, or the two before the channels
+        img = img[..., ::preview, ::preview, :] if is_colour(img) else img[..., ::preview, ::preview]
+    return to_greyscale(img)
+
+class LazyImage:
+    """
+    Characterization image that is only decoded when its data is used (np.asarray(image) or
+    image.load()). The shape and dtype of the tiff are read from its header without decoding.
+    """
+    def __init__(self, fid, preview = None):
+        self.fid = fid
+        self.preview = preview
+        tif = TiffFile(fid)
+        self.shape = tif.series[0].shape
+        self.dtype = tif.series[0].dtype
+        tif.close()
 
-        ids.append(fid.split('_', 1)[1].split('.')[0])    
-    df = pd.DataFrame({'join_on': ids, 'fid':fids, 'output':data})
+    def load(self):
+        return load_image(self.fid, self.preview)
 
-    return(df)
+    def __array__(self, dtype = None, copy = None):
+        img = self.load()
+        return img if dtype == None else img.astype(dtype)
 
-# PIPELINE
-def append_outputs(output_df, action_df):
-    step_id = action_df.iloc[-1]['step_id']+2
+    def __repr__(self):
+        return 'LazyImage({}, shape={}, dtype={})'.format(self.fid, self.shape, self.dtype)
+
+def read_output(fid, lazy = False, preview = None):
+    """
+    Reads one characterization output file: an image as a greyscale array (or a LazyImage) and
+    a csv file as a dictionary. Returns None for the other files.
+    """
+    if '.tif' in fid:
+        if lazy:
+            return LazyImage(fid, preview)
+        return load_image(fid, preview)
+    elif '.csv' in fid:
+        return pd.read_csv(fid).drop(0,axis=0).to_dict()
+    print('haven\'t had to deal w this filetype yet')
+    return None
+
+class DecodePool:
+    """
+    Bounded pool of threads reading characterization output files (see read_output). Decoding
+    tiffs and parsing csv files mostly releases the GIL, so the files of a sample (or of the next
+    samples) are read at the same time. submit waits while the files being read add up to more 
+    than max_bytes, so reading ahead does not fill the memory. A file bigger than max_bytes is
+    read on its own. The budget counts the size of the files on disk (not of the decoded
+    outputs, which can be larger for compressed tiffs) and a file stops counting once it is
+    read, whether or not its output has been used yet.
     
-    row_template = action_df.iloc[-1].copy()
-    row_template.loc[:]=np.nan
-    row_template['action'] = 'char_output'
-    row_template['sample_id'] = action_df['sample_id'].iloc[0]
-    row_template['batch_id'] = action_df['batch_id'].iloc[0]
+    :param workers: number of threads
+    :param max_bytes: most bytes of files read at the same time
+    """
+    def __init__(self, workers = 4, max_bytes = 256 * 2 ** 20):
+        self.pool = ThreadPoolExecutor(max_workers = workers)
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.condition = Condition()
+
+    def submit(self, fid, lazy = False, preview = None):
+        """Starts reading a file, returns the future of read_output"""
+        size = getsize(fid)
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_flight == 0 or self.in_flight + size <= self.max_bytes)
+            self.in_flight += size
+        future = self.pool.submit(read_output, fid, lazy, preview)
+        future.add_done_callback(lambda f: self.release(size))
+        return future
+
+    def release(self, size):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+    def close(self):
+        self.pool.shutdown()
+
+def output_files(folder, sample):
+    """Path of the characterization folder of a sample, and its files sorted by name"""
+    path = folder + '/' + sample + "/characterization0"
+    return path, sorted(listdir(path))
+
+def output_frame(fids, data):
+    """DataFrame of char_outputs from the file names and the outputs read from them"""
+    ids = [fid.split('_', 1)[1].split('.')[0] for fid in fids]
+    data = [output for output in data if output is not None]
+    return pd.DataFrame({'join_on': ids, 'fid':fids, 'output':data})
+
+# PIPELINE
+def char_outputs(folder, sample, lazy = False, preview = None, pool = None):
+    """
+    Reads the characterization outputs of a sample: images as greyscale arrays and csv files
+    as dictionaries.
     
-    output_rows = []
-    for r in range(output_df.shape[0]):
-        output_row = output_df.iloc[r]
-        row = row_template.copy()
-        row['step_id'] = step_id
-        row['char_name'] = output_row['join_on']
-        row['fid'] = output_row['fid']
-        row['output'] = output_row['output']
-        output_rows.append(row)
+    :param lazy: images are returned as LazyImage, decoded only when their data is used
+    :param preview: optional step to downsample the images, see load_image
+    :param pool: optional DecodePool, the files are then read at the same time. The outputs
+        are in the order of the files either way
+    """
+    path, fids = output_files(folder, sample)
+    if pool == None:
+        data = [read_output(path+"/"+fid, lazy, preview) for fid in fids]
+    else:
+        futures = [pool.submit(path+"/"+fid, lazy, preview) for fid in fids]
+        data = [future.result() for future in futures]
+    return output_frame(fids, data)
+
+# PIPELINE
+def output_rows(output_df, step_id, sample_id, batch_id):
+    """
+    Rows of the char_output steps, one per characterization output of output_df (from char_outputs),
+    numbered from step_id. The shape, dtype and checksum of outputs saved with store_outputs
+    are kept in their output_* columns.
+    """
+    output_cols = [col for col in output_df.columns if col.startswith('output_')]
+    rows = []
+    for r, (join_on, fid, output) in enumerate(zip(output_df['join_on'], output_df['fid'], output_df['output'])):
+        row = {'step_id': step_id, 'action': 'char_output', 'sample_id': sample_id, 'batch_id': batch_id,
+               'char_name': join_on, 'fid': fid, 'output': output}
+        for col in output_cols:
+            row[col] = output_df[col].iat[r]
+        rows.append(row)
         step_id += 1
-        
-    action_df = action_df.append(output_rows)
-    
-    return action_df
+    return rows
+
+def append_outputs(output_df, action_df):
+    """Adds the char_output rows of the characterization outputs at the end of an action table"""
+    rows = output_rows(output_df, action_df['step_id'].iat[-1]+2, 
+                       action_df['sample_id'].iat[0], action_df['batch_id'].iat[0])
+    return pd.concat([action_df, pd.DataFrame(rows)], ignore_index=True)
 
-def save_action_csvs(process_data, char_data):
+def sample_action_table(process_sample, char_sample, sample_id, batch_id, folder, store = None, pool = None,
+                        metrics = None, spin_store = None, spin_interval = None, preview = None):
+    """
+    Builds the action table of one sample from its process and characterization worklists,
+    with the characterization outputs found in folder appended at the end.
+    char_sample can be None when the sample has not been characterized.
+    With a store folder, the outputs are saved there as .npy files and the action table
+    only references them (see output_store.store_outputs).
+    With a DecodePool, the characterization files are read at the same time. With a store and
+    no DecodePool, the images are only decoded when they are saved, one at a time (see LazyImage).
+    With a preview step, the images are downsampled (see load_image).
+    With the metrics of the sample (see char_metrics.batch_metrics), a fitted_metrics row is added last.
+    With a spin_store folder, the spin logs are saved there (downsampled to one point every
+    spin_interval seconds, if any) and the spin rows only reference them (see spin_logs.store_spin_logs).
+    """
+    if char_sample != None:
+        lazy = store != None and pool == None
+        output_df = helper('char_outputs', char_outputs, folder, sample_id, lazy, preview, pool)
+        if store != None:
+            output_df = store_outputs(output_df, store, batch_id)
+        a_df = action_table([process_sample['worklist'], char_sample['worklist']], sample_id, batch_id, output_df,
+                            metrics)
+    else:
+        a_df = action_table([process_sample['worklist']], sample_id, batch_id, metrics=metrics)
+    if spin_store != None:
+        a_df = store_spin_logs(a_df, spin_store, batch_id, sample_id, spin_interval)
+    return a_df.astype({'chemical_from':'Int64'})
+
+def action_filename(batch_id, sample):
+    """Name of the action csv file of a sample, with the whitespace replaced by underscores"""
+    fname = batch_id + '_' + sample + '_action.csv'
+    return fname.replace(' ', '_')
+
+def save_action_csvs(samples, batch_id = 'b19', 
+                     folder = 'test/testdata/Characterization_B19', filepath = '', store = None):
+    """
+    Takes in the samples, as (sample_id, process_sample, char_sample) tuples from etl.stream_samples
+    (or save_chem_csvs) and saves the action csv of each one.
+    This is a generator that yields the action table of each sample once it is saved, 
+    to be consumed by save_link_csvs.
+    """
     # PIPELINE
     # run to save all as csvs
-    action_dfs = []
-    batch_id = 'b19'
-    folder = 'test/testdata/Characterization_B19'
-
-    for s in process_data:
-        a_df = pd.DataFrame(action_table([process_data[s]['worklist'], char_data[s]['worklist']], s, batch_id))
-        output_df = char_outputs(folder, s)
-        a_df = append_outputs(output_df, a_df)
-        a_df = a_df.astype({'chemical_from':'Int64'})
-        action_dfs.append(a_df)
-        fname = batch_id + '_' + s + '_action.csv'
-        fname = fname.replace(' ', '_')
-        a_df.to_csv(fname,index=False)
-
-    return action_dfs
\ No newline at end of file
+    unknown, undeclared = [], []
+    for s, process_sample, char_sample in samples:
+        with stage('action', batch_id, s) as record:
+            a_df = sample_action_table(process_sample, char_sample, s, batch_id, folder, store)
+            a_df.to_csv(join(filepath, action_filename(batch_id, s)),index=False)
+            record['rows'] = a_df.shape[0]
+            record['bytes'] = file_size(join(filepath, action_filename(batch_id, s)))
+            record['unknown_steps'] = take_unknown_steps()
+            record['undeclared_columns'] = take_undeclared_columns()
+            unknown.append(record['unknown_steps'])
+            undeclared.append(record['undeclared_columns'])
+        yield a_df
+    report_steps(unknown, undeclared)
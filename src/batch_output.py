@@ -0,0 +1,167 @@
+from os import replace, remove
+from os.path import join, isfile
+from io import BytesIO
+
+import pandas as pd
+
+tables = ['chem', 'action', 'link']
+index_cols = ['batch_id', 'sample_id', 'table', 'file', 'offset', 'length', 'first_row', 'rows']
+
+def batch_filename(batch_id, table):
+    """Name of the csv file of a table of a whole batch, e.g. 'b19_chem.csv'"""
+    return (batch_id + '_' + table + '.csv').replace(' ', '_')
+
+class BatchWriter:
+    """
+    Writes the chem, action and link tables of the samples into one csv per batch and table
+    (see batch_filename) instead of three csv files per sample. The rows of each sample are
+    appended to the batch files as the samples come in, and the index records where they are:
+    the byte offset and length of the sample's rows in each file, and their row numbers.
+
+    The header of a file has the columns of its first sample. When a later sample brings new
+    columns (action tables of samples with other steps), they are added at the end of the header
+    and the file is rewritten once with every column when the writer is closed.
+
+    The samples of an earlier run that are not written again (the unchanged samples of a run with a
+    manifest) are kept: their rows are copied from the previous batch files when these are
+    rewritten, and the index keeps them.
+
+    :param filepath: folder where the batch files and the index (output_index.csv) are saved
+    """
+    def __init__(self, filepath = ''):
+        self.filepath = filepath
+        index_file = join(filepath, 'output_index.csv')
+        self.previous = load_output_index(index_file) if isfile(index_file) else pd.DataFrame(columns=index_cols)
+        # number of header columns of the previous batch files being rewritten, which are renamed
+        # to <file>.old until the writer is closed
+        self.old = {}
+        self.written = set()
+        self.files = {}
+        self.columns = {}
+        self.rows = {}
+        self.grown = set()
+        self.index = []
+        # number of header columns each sample's rows were written with
+        self.written_columns = []
+
+    def write(self, batch_id, sample_id, sample_tables):
+        """
+        Appends the rows of one sample.
+
+        :param sample_tables: dictionary with the chem, action and link DataFrames of the sample
+        """
+        for table in tables:
+            df = sample_tables[table]
+            key = (batch_id, table)
+            if key not in self.files:
+                fname = join(self.filepath, batch_filename(batch_id, table))
+                self.columns[key] = list(df.columns)
+                if isfile(fname) and self.previous_rows(key).shape[0] > 0:
+                    # the rows of the previous samples are copied with the columns of the previous header
+                    replace(fname, fname + '.old')
+                    self.columns[key] = list(pd.read_csv(fname + '.old', nrows=0).columns)
+                    self.old[key] = len(self.columns[key])
+                self.files[key] = open(fname, 'wb')
+                self.rows[key] = 0
+                self.files[key].write(pd.DataFrame(columns=self.columns[key]).to_csv(index=False).encode())
+            new_columns = [col for col in df.columns if col not in self.columns[key]]
+            if len(new_columns) > 0:
+                self.columns[key] += new_columns
+                self.grown.add(key)
+
+            data = df.reindex(columns=self.columns[key]).to_csv(index=False, header=False).encode()
+            f = self.files[key]
+            self.index.append([batch_id, sample_id, table, batch_filename(batch_id, table), f.tell(), len(data),
+                               self.rows[key], df.shape[0]])
+            self.written_columns.append(len(self.columns[key]))
+            self.written.add((batch_id, sample_id, table))
+            f.write(data)
+            self.rows[key] += df.shape[0]
+
+    def previous_rows(self, key):
+        """Rows of the previous index of a batch file"""
+        return self.previous[(self.previous['batch_id'] == key[0]) & (self.previous['table'] == key[1])]
+
+    def carry(self, key):
+        """Appends the rows of the previous samples not written again to a batch file"""
+        fname = join(self.filepath, batch_filename(*key))
+        source = open(fname + '.old', 'rb')
+        f = self.files[key]
+        for row in self.previous_rows(key).itertuples(index=False):
+            if (row.batch_id, row.sample_id, row.table) in self.written:
+                continue
+            source.seek(row.offset)
+            data = source.read(row.length)
+            self.index.append([row.batch_id, row.sample_id, row.table, row.file, f.tell(), len(data),
+                               self.rows[key], row.rows])
+            self.written_columns.append(self.old[key])
+            f.write(data)
+            self.rows[key] += row.rows
+        source.close()
+        remove(fname + '.old')
+
+    def rewrite(self, key):
+        """Rewrites a file whose columns grew, with every column in the header and in each row"""
+        fname = join(self.filepath, batch_filename(*key))
+        source = open(fname, 'rb')
+        target = open(fname + '.tmp', 'wb')
+        target.write(pd.DataFrame(columns=self.columns[key]).to_csv(index=False).encode())
+        for i, row in enumerate(self.index):
+            if (row[0], row[2]) != key:
+                continue
+            source.seek(row[4])
+            data = source.read(row[5])
+            if self.written_columns[i] < len(self.columns[key]) and len(data) > 0:
+                cols = self.columns[key][:self.written_columns[i]]
+                df = pd.read_csv(BytesIO(data), names=cols, header=None, dtype=str, keep_default_na=False)
+                data = df.reindex(columns=self.columns[key], fill_value='').to_csv(index=False, header=False).encode()
+            row[4] = target.tell()
+            row[5] = len(data)
+            target.write(data)
+        source.close()
+        target.close()
+        replace(fname + '.tmp', fname)
+
+    def close(self):
+        """
+        Closes the batch files and saves the index as output_index.csv.
+
+        :return: the index, as a DataFrame (see load_output_index)
+        """
+        for key in self.old:
+            self.carry(key)
+        for key in self.files:
+            self.files[key].close()
+        for key in self.grown:
+            self.rewrite(key)
+        # the batch files not opened in this run are left as they were
+        kept = [key not in self.files for key in zip(self.previous['batch_id'], self.previous['table'])]
+        index = pd.concat([self.previous.loc[kept], pd.DataFrame(self.index, columns=index_cols)], ignore_index=True)
+        index.to_csv(join(self.filepath, 'output_index.csv'), index=False)
+        return index
+
+def load_output_index(index_file):
+    """Reads the index saved by BatchWriter"""
+    return pd.read_csv(index_file, dtype={'batch_id': str, 'sample_id': str})
+
+def index_file_dict(index):
+    """
+    Dictionary with the chem, action and link csv file of each batch of an index (a DataFrame
+    or the path of output_index.csv), in the format of the file_dict of save_queries
+    """
+    if isinstance(index, str):
+        index = load_output_index(index)
+    file_dict = {}
+    for batch_id, table, fname in zip(index['batch_id'], index['table'], index['file']):
+        file_dict.setdefault(batch_id, {})[table] = fname
+    return file_dict
+
+def read_sample_rows(index, batch_id, sample_id, table, filepath = ''):
+    """Reads the rows of one sample from a batch file, using the offsets of the index"""
+    row = index[(index['batch_id'] == batch_id) & (index['sample_id'] == sample_id) & (index['table'] == table)].iloc[0]
+    f = open(join(filepath, row['file']), 'rb')
+    header = f.readline()
+    f.seek(row['offset'])
+    data = f.read(row['length'])
+    f.close()
+    return pd.read_csv(BytesIO(header + data))
@@ -0,0 +1,158 @@
+from os import getcwd, chdir, makedirs
+from os.path import join
+from time import perf_counter
+from shutil import rmtree
+from tempfile import mkdtemp
+import tracemalloc
+import resource
+
+import numpy as np
+import pandas as pd
+
+from etl import stream_samples
+from chem_feature import chem_table, chem_filename
+from action_feature import action_table, char_outputs, action_filename
+from link_feature import sample_link_table, link_filename
+from query_feature import save_queries
+from synthetic import make_batch
+from similarity import SimilarityIndex, feature_names
+
+stages = ['chem_table', 'char_outputs', 'action_table', 'link_table', 'write_csvs', 'save_queries']
+
+class StageTimer:
+    """
+    Adds up the time spent in each stage and keeps the peak memory allocated by a single call
+    of the stage (traced by tracemalloc, which has to be started for memory to be measured).
+    """
+    def __init__(self):
+        self.seconds = {stage: 0.0 for stage in stages}
+        self.peak = {stage: 0 for stage in stages}
+
+    def run(self, stage, func, *args):
+        memory = tracemalloc.is_tracing()
+        if memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = perf_counter()
+        res = func(*args)
+        self.seconds[stage] += perf_counter() - start
+        if memory:
+            self.peak[stage] = max(self.peak[stage], tracemalloc.get_traced_memory()[1] - start_memory)
+        return res
+
+def save_sample_csvs(chem_df, a_df, l_df, batch_id, sample, filepath):
+    chem_df.to_csv(join(filepath, chem_filename(batch_id, sample)), index=False)
+    a_df.to_csv(join(filepath, action_filename(batch_id, sample)), index=False)
+    l_df.to_csv(join(filepath, link_filename(batch_id, sample)), index=False)
+
+def save_batch_queries_in(filepath, file_dict):
+    # save_queries reads the csv files and writes output.cypher in the current directory
+    cwd = getcwd()
+    chdir(filepath)
+    try:
+        save_queries(file_dict)
+    finally:
+        chdir(cwd)
+
+def benchmark_batch(batch, filepath):
+    """
+    Runs every stage of the chem -> action -> link -> query pipeline on the samples of a batch,
+    timing each stage separately. The stages do the same work as sample_action_table and
+    pipeline.process_sample, one sample at a time.
+
+    :param batch: batch as returned by etl.find_batch (or synthetic.make_batch)
+    :param filepath: folder where the csv files and output.cypher are saved
+    :return: DataFrame with the seconds, samples per second and peak memory (MB) of each stage,
+        and a 'total' row. The peak memory is NaN when tracemalloc is not tracing
+    """
+    timer = StageTimer()
+    batch_id = batch['batch_id']
+    file_dict = {}
+    for sample, process_sample, char_sample in stream_samples(batch['process_file'], batch['char_file']):
+        chem_df = timer.run('chem_table', chem_table, process_sample, batch_id)
+        if char_sample != None:
+            output_df = timer.run('char_outputs', char_outputs, batch['char_folder'], sample)
+            a_df = timer.run('action_table', action_table, [process_sample['worklist'], char_sample['worklist']],
+                             sample, batch_id, output_df)
+        else:
+            a_df = timer.run('action_table', action_table, [process_sample['worklist']], sample, batch_id)
+        a_df = a_df.astype({'chemical_from':'Int64'})
+        l_df = timer.run('link_table', sample_link_table, a_df, batch_id)
+        timer.run('write_csvs', save_sample_csvs, chem_df, a_df, l_df, batch_id, sample, filepath)
+        file_dict[sample] = {'chem': chem_filename(batch_id, sample), 'action': action_filename(batch_id, sample),
+                             'link': link_filename(batch_id, sample)}
+    timer.run('save_queries', save_batch_queries_in, filepath, file_dict)
+
+    rows = []
+    for stage in stages:
+        rows.append([stage, timer.seconds[stage], timer.peak[stage] / 2 ** 20])
+    rows.append(['total', sum(timer.seconds.values()), max(timer.peak.values()) / 2 ** 20])
+    res = pd.DataFrame(rows, columns=['stage', 'seconds', 'peak_mb'])
+    res.insert(2, 'samples_per_sec', len(file_dict) / res['seconds'])
+    if not tracemalloc.is_tracing():
+        res['peak_mb'] = np.nan
+    return res
+
+def run_benchmark(sizes = (1, 10, 100, 1000), directory = None, memory = True, **batch_options):
+    """
+    Benchmarks the pipeline on synthetic batches of increasing size, to see how each stage
+    scales with the number of samples. Every batch is generated (not timed) in a temporary
+    folder, which is deleted once the batch is benchmarked.
+
+    :param sizes: numbers of samples of the batches
+    :param directory: folder where the temporary folders are created, defaults to the system's
+    :param memory: trace the memory allocations to report the peak memory of each stage.
+        Tracing slows the stages down, so the times are only comparable between runs with the
+        same setting
+    :param batch_options: options of synthetic.make_batch (drops, char_tasks, image_size, ...)
+    :return: DataFrame with one row per batch size and stage (see benchmark_batch), and the
+        maximum resident memory of the process (MB) after each batch
+    """
+    if memory:
+        tracemalloc.start()
+    results = []
+    try:
+        for size in sizes:
+            folder = mkdtemp(dir=directory)
+            try:
+                batch = make_batch(join(folder, 'batch'), size, **batch_options)
+                makedirs(join(folder, 'csv'))
+                res = benchmark_batch(batch, join(folder, 'csv'))
+            finally:
+                rmtree(folder)
+            res.insert(0, 'samples', size)
+            # ru_maxrss is in kilobytes on linux
+            res['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            results.append(res)
+    finally:
+        if memory:
+            tracemalloc.stop()
+    return pd.concat(results, ignore_index=True)
+
+
+def benchmark_similarity(sizes = (1000, 10000, 50000, 200000), queries = 200, k = 5, seed = 0):
+    """
+    Times the queries of a similarity.SimilarityIndex filled with random feature vectors, to see
+    the archive size up to which a query stays under a millisecond. The index is filled and
+    prepared (not timed) for each size, then queried with the vectors of queries of its samples.
+
+    :param sizes: numbers of samples of the index
+    :param queries: number of queries timed for each size
+    :param k: number of neighbors of each query
+    :return: DataFrame with one row per size, with the milliseconds per query and the queries per second
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for size in sizes:
+        index = SimilarityIndex()
+        matrix = rng.normal(size=(size, len(feature_names))).astype(np.float32)
+        for i in range(size):
+            index.add('bench', 'sample' + str(i), matrix[i])
+        index.prepare()
+        vectors = matrix[rng.integers(0, size, queries)]
+        start = perf_counter()
+        for features in vectors:
+            index.query(features, k)
+        seconds = perf_counter() - start
+        rows.append([size, 1000 * seconds / queries, queries / seconds])
+    return pd.DataFrame(rows, columns=['samples', 'ms_per_query', 'queries_per_sec'])
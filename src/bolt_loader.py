@@ -0,0 +1,237 @@
+from time import sleep
+from os.path import join
+from threading import Lock
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from query_feature import create_constraints, delete_sample
+from import_feature import id_columns
+from columnar import read_frame
+
+# keys of the nodes, and the write operations of the loader with their Cypher query.
+# Every query takes a batch of rows as the $rows parameter.
+node_keys = {'Chemical': ['chemical_id', 'sample_id', 'batch_id'],
+             'Action': ['step_id', 'sample_id', 'batch_id']}
+
+bolt_queries = {
+    'chem': "UNWIND $rows AS row MERGE (c:Chemical {chemical_id: row.chemical_id, sample_id: row.sample_id, \
+batch_id: row.batch_id}) SET c += row",
+    'action': "UNWIND $rows AS row MERGE (a:Action {step_id: row.step_id, sample_id: row.sample_id, \
+batch_id: row.batch_id}) SET a += row",
+    'goes_into': "UNWIND $rows AS row MATCH (c:Chemical {chemical_id: row.chemical_from, sample_id: row.sample_id, \
+batch_id: row.batch_id}), (a:Action {step_id: row.step_to, sample_id: row.sample_id, batch_id: row.batch_id}) \
+MERGE (c)-[:GOES_INTO]->(a)",
+    'outputs': "UNWIND $rows AS row MATCH (a:Action {step_id: row.step_from, sample_id: row.sample_id, \
+batch_id: row.batch_id}), (c:Chemical {chemical_id: row.chemical_to, sample_id: row.sample_id, batch_id: row.batch_id}) \
+WHERE a.action = 'dissolve' MERGE (a)-[:OUTPUTS]->(c)",
+    'drop_next': "UNWIND $rows AS row MATCH (a:Action {step_id: row.step_from, sample_id: row.sample_id, \
+batch_id: row.batch_id}), (c:Chemical {chemical_id: row.chemical_to, sample_id: row.sample_id, batch_id: row.batch_id}) \
+WHERE a.action = 'drop' MERGE (a)-[:NEXT]->(c)",
+    'next': "UNWIND $rows AS row MATCH (a1:Action {step_id: row.step_from, sample_id: row.sample_id, \
+batch_id: row.batch_id}), (a2:Action {step_id: row.step_to, sample_id: row.sample_id, batch_id: row.batch_id}) \
+MERGE (a1)-[:NEXT]->(a2)"
+}
+
+# columns a link row needs for each link operation
+link_operations = {'goes_into': ['chemical_from', 'step_to'],
+                   'outputs': ['step_from', 'chemical_to'],
+                   'drop_next': ['step_from', 'chemical_to'],
+                   'next': ['step_from', 'step_to']}
+
+class TransientWriteError(Exception):
+    """A write that failed for a reason that can go away when it is tried again (deadlock, leader switch, ...)"""
+
+class Neo4jGraph:
+    """
+    Graph the loader writes to over Bolt. The driver keeps a pool of connections that the
+    sessions of the loader's threads share.
+    Needs the neo4j python driver (pip install neo4j).
+    """
+    def __init__(self, uri, user, password, database = None, pool_size = 10):
+        try:
+            from neo4j import GraphDatabase
+            from neo4j.exceptions import TransientError, ServiceUnavailable, SessionExpired
+        except ImportError as e:
+            raise ImportError('the load target needs the neo4j driver, install it with pip install neo4j') from e
+        self.transient = (TransientError, ServiceUnavailable, SessionExpired)
+        self.driver = GraphDatabase.driver(uri, auth=(user, password), max_connection_pool_size=pool_size)
+        self.database = database
+
+    def run(self, query, parameters = None):
+        try:
+            with self.driver.session(database=self.database) as session:
+                session.execute_write(lambda tx: tx.run(query, parameters).consume())
+        except self.transient as e:
+            raise TransientWriteError(str(e))
+
+    def setup(self):
+        for query in create_constraints():
+            self.run(query)
+
+    def delete_sample(self, batch_id, sample_id):
+        self.run(delete_sample(batch_id, sample_id))
+
+    def write(self, operation, rows):
+        self.run(bolt_queries[operation], {'rows': rows})
+
+    def close(self):
+        self.driver.close()
+
+class MemoryGraph:
+    """
+    In-memory stand-in for Neo4jGraph with the same write operations, to run the loader
+    without a database. Nodes are kept by label and key, relationships as
+    (type, start label, start key, end label, end key) tuples.
+
+    :param failures: number of writes that raise TransientWriteError before the writes succeed,
+        to exercise the retries
+    """
+    def __init__(self, failures = 0):
+        self.nodes = {'Chemical': {}, 'Action': {}}
+        self.relationships = set()
+        self.failures = failures
+        self.writes = 0
+        self.lock = Lock()
+
+    def setup(self):
+        pass
+
+    def delete_sample(self, batch_id, sample_id):
+        with self.lock:
+            for label in self.nodes:
+                self.nodes[label] = {k: v for k, v in self.nodes[label].items() if k[1:] != (sample_id, batch_id)}
+            self.relationships = {r for r in self.relationships if r[2][1:] != (sample_id, batch_id)}
+
+    def node(self, label, row, cols):
+        return self.nodes[label].get(tuple(row.get(c) for c in cols))
+
+    def write(self, operation, rows):
+        with self.lock:
+            self.write_rows(operation, rows)
+
+    def write_rows(self, operation, rows):
+        if self.failures > 0:
+            self.failures -= 1
+            raise TransientWriteError('simulated failure')
+        self.writes += 1
+        for row in rows:
+            if operation in ['chem', 'action']:
+                label = 'Chemical' if operation == 'chem' else 'Action'
+                key = tuple(row.get(c) for c in node_keys[label])
+                self.nodes[label].setdefault(key, {}).update(row)
+                continue
+
+            start_col, end_col = link_operations[operation]
+            start_label = 'Chemical' if start_col == 'chemical_from' else 'Action'
+            end_label = 'Chemical' if end_col == 'chemical_to' else 'Action'
+            start = self.node(start_label, row, [start_col, 'sample_id', 'batch_id'])
+            end = self.node(end_label, row, [end_col, 'sample_id', 'batch_id'])
+            if start == None or end == None:
+                continue
+            if (operation == 'outputs' and start.get('action') != 'dissolve') or \
+            (operation == 'drop_next' and start.get('action') != 'drop'):
+                continue
+            rel_type = {'goes_into': 'GOES_INTO', 'outputs': 'OUTPUTS'}.get(operation, 'NEXT')
+            self.relationships.add((rel_type,
+                                    start_label, (row[start_col], row['sample_id'], row['batch_id']),
+                                    end_label, (row[end_col], row['sample_id'], row['batch_id'])))
+
+    def close(self):
+        pass
+
+def bolt_rows(df):
+    """
+    Turns a chem/action/link DataFrame into the list of row dictionaries sent as $rows.
+    Values are the text they have in the csv files (ids without decimals), and missing or
+    empty values are left out, so the nodes are the same as with LOAD CSV.
+    """
+    rows = []
+    for record in df.to_dict('records'):
+        row = {}
+        for col, value in record.items():
+            if (pd.api.types.is_scalar(value) and pd.isna(value)) or (isinstance(value, str) and value == ''):
+                continue
+            if col in id_columns and isinstance(value, float):
+                value = int(value)
+            row[col] = str(value)
+        rows.append(row)
+    return rows
+
+def read_sample_frames(file_dict, filepath = ''):
+    """
+    Generator of the (chem_df, action_df, link_df) of each sample in a file_dict (as used by 
+    save_queries), read as text from the csv files (or typed from parquet files), for load_samples
+    """
+    for sample in file_dict:
+        yield tuple(read_frame(join(filepath, file_dict[sample][table]), dtype=str, keep_default_na=False)
+                    for table in ['chem', 'action', 'link'])
+
+def result_frames(results):
+    """
+    Generator of the (chem_df, action_df, link_df) of the changed samples of the results of
+    pipeline.run_pipeline (with return_tables), for load_samples. The tables are dropped from
+    the results as they are handed out
+    """
+    for r in results:
+        if r['changed']:
+            tables = r.pop('tables')
+            yield tables['chem'], tables['action'], tables['link']
+
+def write_batches(graph, operation, rows, batch_size = 1000, max_retries = 3, backoff = 0.5):
+    """Writes the rows in batches of batch_size, retrying a batch after a transient error"""
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        for attempt in range(max_retries + 1):
+            try:
+                graph.write(operation, batch)
+                break
+            except TransientWriteError:
+                if attempt == max_retries:
+                    raise
+                sleep(backoff * 2 ** attempt)
+
+def load_sample(graph, chem_df, action_df, link_df, batch_size = 1000, max_retries = 3, backoff = 0.5):
+    """Writes the nodes and then the links of one sample"""
+    write_batches(graph, 'chem', bolt_rows(chem_df), batch_size, max_retries, backoff)
+    write_batches(graph, 'action', bolt_rows(action_df), batch_size, max_retries, backoff)
+    links = bolt_rows(link_df)
+    for operation in link_operations:
+        cols = link_operations[operation]
+        op_rows = [row for row in links if cols[0] in row and cols[1] in row]
+        write_batches(graph, operation, op_rows, batch_size, max_retries, backoff)
+
+def load_samples(graph, samples, replaced = (), batch_size = 1000, workers = 4, max_retries = 3, backoff = 0.5):
+    """
+    Loads samples straight from their DataFrames into the graph, without csv files.
+    The constraints are created first, replaced samples are deleted, then the samples are written
+    by concurrent writer threads (one sample at a time each) in parameterized batches of rows.
+    At most two samples per thread are waiting to be written, so samples can be streamed in.
+
+    :param graph: Neo4jGraph, or MemoryGraph to run without a database
+    :param samples: iterable of (chem_df, action_df, link_df) tuples, one per sample
+    :param replaced: optional list of (batch_id, sample_id) to delete before loading, see save_queries
+    :param batch_size: number of rows per write
+    :param workers: number of writer threads
+    :param max_retries: number of times a batch is tried again after a transient error, with
+        an exponential backoff starting at backoff seconds
+    :return: number of samples loaded
+    """
+    graph.setup()
+    for batch_id, sample_id in replaced:
+        graph.delete_sample(batch_id, sample_id)
+
+    loaded = 0
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        pending = deque()
+        for chem_df, action_df, link_df in samples:
+            pending.append(pool.submit(load_sample, graph, chem_df, action_df, link_df,
+                                       batch_size, max_retries, backoff))
+            if len(pending) >= 2 * workers:
+                pending.popleft().result()
+                loaded += 1
+        while len(pending) > 0:
+            pending.popleft().result()
+            loaded += 1
+    return loaded
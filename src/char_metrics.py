@@ -0,0 +1,207 @@
+from os import listdir
+from os.path import isdir, join
+
+import numpy as np
+import pandas as pd
+
+# h * c in eV nm, to convert wavelengths to photon energies
+hc = 1239.84
+metric_cols = ['metric_pl_peak_nm', 'metric_pl_fwhm_nm', 'metric_pl_intensity', 'metric_absorbance_max',
+               'metric_bandgap_ev']
+
+def read_spectrum(fid):
+    """
+    Reads a PL or transmission csv as (wavelength, values) arrays. The PL files have a first row
+    with the dwell time of each column, their values are the counts per second over every column.
+    """
+    f = open(fid)
+    first = f.readline()
+    f.close()
+    if first.startswith('Dwelltimes'):
+        dwelltimes = np.array(first.strip().split(',')[1:], dtype=float)
+        data = np.loadtxt(fid, delimiter=',', skiprows=2, ndmin=2)
+        return data[:, 0], data[:, 1:].sum(axis=1) / dwelltimes.sum()
+    data = np.loadtxt(fid, delimiter=',', skiprows=1, ndmin=2)
+    return data[:, 0], data[:, 1]
+
+def stack_spectra(spectra):
+    """
+    Stacks spectra into a 2-D array on a shared wavelength grid, one row per spectrum.
+    The grid is the wavelengths of the first spectrum; spectra measured on other wavelengths
+    are interpolated onto it, and missing spectra (None) are rows of NaN.
+
+    :param spectra: list of (wavelength, values) or None
+    :return: the grid and the 2-D array
+    """
+    found = [s for s in spectra if s is not None]
+    if len(found) == 0:
+        return np.empty(0), np.empty((len(spectra), 0))
+    grid = found[0][0]
+    res = np.full((len(spectra), len(grid)), np.nan)
+    for i, s in enumerate(spectra):
+        if s is None:
+            continue
+        if len(s[0]) == len(grid) and np.array_equal(s[0], grid):
+            res[i] = s[1]
+        else:
+            res[i] = np.interp(grid, s[0], s[1], left=np.nan, right=np.nan)
+    # e.g. the inf of a division by a zero reference count
+    res[~np.isfinite(res)] = np.nan
+    return grid, res
+
+def crossing(grid, spectra, rows, left, right, level):
+    """Wavelength where each spectrum crosses level between the points left and right, by linear interpolation"""
+    y0 = spectra[rows, left]
+    y1 = spectra[rows, right]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(y1 != y0, (level - y0) / (y1 - y0), 0)
+    return grid[left] + np.clip(t, 0, 1) * (grid[right] - grid[left])
+
+def pl_metrics(grid, pl):
+    """
+    Peak wavelength, full width at half maximum and peak intensity of every PL spectrum
+    of a 2-D array (see stack_spectra), computed for all the spectra at once.
+    The half maximum crossings are interpolated between the points around them.
+    """
+    n, m = pl.shape
+    res = {'peak': np.full(n, np.nan), 'fwhm': np.full(n, np.nan), 'intensity': np.full(n, np.nan)}
+    valid = ~np.isnan(pl).all(axis=1) if m > 0 else np.zeros(n, dtype=bool)
+    if not valid.any():
+        return res
+    rows = np.flatnonzero(valid)
+    values = np.nan_to_num(pl[rows], nan=-np.inf)
+    peak = values.argmax(axis=1)
+    intensity = values[np.arange(len(rows)), peak]
+    half = intensity / 2
+
+    # last point below half maximum before the peak, first one after it
+    idx = np.arange(m)
+    below = values < half[:, None]
+    left = np.where(below & (idx < peak[:, None]), idx, -1).max(axis=1)
+    right = np.where(below & (idx > peak[:, None]), idx, m).min(axis=1)
+    has_left = left >= 0
+    has_right = right < m
+    left_nm = np.where(has_left, crossing(grid, values, np.arange(len(rows)), np.maximum(left, 0),
+                                          np.maximum(left, 0) + 1, half), grid[0])
+    right_nm = np.where(has_right, crossing(grid, values, np.arange(len(rows)), np.minimum(right, m - 1) - 1,
+                                            np.minimum(right, m - 1), half), grid[-1])
+
+    res['peak'][rows] = grid[peak]
+    res['fwhm'][rows] = right_nm - left_nm
+    res['intensity'][rows] = intensity
+    return res
+
+def absorbance(transmission, max_absorbance = 3):
+    """
+    Absorbance, -log10 of the transmission. The transmission is clipped to 10 ** -max_absorbance,
+    below what the spectrometer measures, so the noise of opaque points stays flat
+    """
+    return -np.log10(np.clip(transmission, 10.0 ** -max_absorbance, None))
+
+def smooth(spectra, points = 15):
+    """
+    Moving average of each row over points wavelengths, computed with the cumulative sums of 
+    the rows. NaN values are left out of the averages.
+    """
+    if spectra.shape[1] < points:
+        return spectra
+    pad = ((0, 0), (points // 2 + 1, points - 1 - points // 2))
+    sums = np.cumsum(np.pad(np.nan_to_num(spectra), pad), axis=1)
+    counts = np.cumsum(np.pad(~np.isnan(spectra), pad), axis=1)
+    total = sums[:, points:] - sums[:, :-points]
+    found = counts[:, points:] - counts[:, :-points]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(found > 0, total / found, np.nan)
+
+def energy_order(grid, energy_range):
+    """Photon energies (eV) of the wavelengths of grid within energy_range, increasing, and their points in grid"""
+    energy = hc / grid
+    in_range = (energy >= energy_range[0]) & (energy <= energy_range[1])
+    order = np.argsort(energy)[in_range[np.argsort(energy)]]
+    return energy[order], order
+
+def absorbance_max(grid, transmission, energy_range = (1.1, 3.2), points = 15):
+    """
+    Highest absorbance of the smoothed transmission of every spectrum within energy_range (eV),
+    the range of the Tauc fit. Outside of it the transmission of the films is at the noise floor
+    and the absorbance is the clip value of absorbance.
+    """
+    energy, order = energy_order(grid, energy_range)
+    if len(order) == 0:
+        return np.full(transmission.shape[0], np.nan)
+    res = np.nan_to_num(absorbance(smooth(transmission, points)[:, order]), nan=-np.inf).max(axis=1)
+    res[np.isneginf(res)] = np.nan
+    return res
+
+def tauc_bandgap(grid, transmission, energy_range = (1.1, 3.2), points = 15, edge = (0.2, 0.8)):
+    """
+    Direct bandgap of every spectrum from its Tauc plot, (A E)^2 against the photon energy E,
+    with A the absorbance of the smoothed transmission. Within energy_range (eV), the line of the
+    plot through the first points where A reaches edge[0] and edge[1] of its maximum (the absorption
+    edge) crosses the energy axis at the bandgap. Computed for all the spectra at once.
+    """
+    n = transmission.shape[0]
+    energy, order = energy_order(grid, energy_range)
+    if len(order) < 2:
+        return np.full(n, np.nan)
+    absorbances = absorbance(smooth(transmission, points)[:, order])
+    tauc = (absorbances * energy) ** 2
+    # first points (from low energies) above each fraction of the maximum absorbance
+    reached = np.nan_to_num(absorbances, nan=-np.inf)
+    top = reached.max(axis=1)
+    low = (reached >= edge[0] * top[:, None]).argmax(axis=1)
+    high = (reached >= edge[1] * top[:, None]).argmax(axis=1)
+    rows = np.arange(n)
+    e0, e1 = energy[low], energy[high]
+    y0, y1 = tauc[rows, low], tauc[rows, high]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bandgap = e0 - y0 * (e1 - e0) / (y1 - y0)
+    return np.where((high > low) & (top > 0) & np.isfinite(top), bandgap, np.nan)
+
+def find_spectrum(folder, sample, kind):
+    """Path of the PL ('pl') or transmission csv of a sample, None when it was not measured"""
+    path = join(folder, sample, 'characterization0')
+    if not isdir(path):
+        return None
+    for fid in listdir(path):
+        if fid.endswith('_' + kind + '.csv'):
+            return join(path, fid)
+    return None
+
+def batch_metrics(folder, samples = None):
+    """
+    Fitted characterization metrics of the samples of a batch: PL peak position, FWHM and
+    intensity, the highest absorbance within the range of the Tauc fit and the Tauc bandgap
+    estimate. The PL and transmission
+    spectra of every sample are stacked into 2-D arrays and the metrics are computed for the
+    whole batch at once.
+
+    :param folder: characterization folder of the batch, with one folder per sample
+    :param samples: optional list of sample names, by default every sample folder
+    :return: DataFrame with the metric columns (metric_cols), indexed by sample
+    """
+    if samples == None:
+        samples = sorted([s for s in listdir(folder) if isdir(join(folder, s))])
+    spectra = {}
+    for kind in ['pl', 'transmission']:
+        fids = [find_spectrum(folder, s, kind) for s in samples]
+        spectra[kind] = stack_spectra([read_spectrum(fid) if fid != None else None for fid in fids])
+
+    pl = pl_metrics(*spectra['pl'])
+    grid, transmission = spectra['transmission']
+    res = pd.DataFrame({'metric_pl_peak_nm': pl['peak'], 'metric_pl_fwhm_nm': pl['fwhm'],
+                        'metric_pl_intensity': pl['intensity'],
+                        'metric_absorbance_max': absorbance_max(grid, transmission),
+                        'metric_bandgap_ev': tauc_bandgap(grid, transmission)}, index=samples)
+    return res
+
+def metrics_row(metrics, step_id, sample_id, batch_id):
+    """
+    Row of the fitted_metrics step of a sample (one row of batch_metrics as a dictionary),
+    added at the end of its action table. None when the sample has no metrics.
+    """
+    if metrics == None or all(pd.isna(v) for v in metrics.values()):
+        return None
+    row = {'step_id': step_id, 'action': 'fitted_metrics', 'sample_id': sample_id, 'batch_id': batch_id}
+    row.update(metrics)
+    return row
@@ -1,16 +1,22 @@
 from os import listdir, remove
 from os.path import isfile, join
-from json import load, loads
+from json import load, loads, dump
 from tifffile import imread,imwrite
-from re import search, findall
+from re import search, findall, compile
+from collections import OrderedDict
 
 import numpy as np
 import pandas as pd
 
+from instrument import stage, file_size
+
+number_pattern = compile(r'\d+.\d+')
+name_format_pattern = compile(r'[A-Za-z]+\d+.?\d+_')
+
 def split_chemicals(input_string):
     result = []
     for i in input_string.split('_'):
-        first_digit = search(r'\d+.\d+', i).start()
+        first_digit = number_pattern.search(i).start()
         result.append((i[:first_digit], float(i[first_digit:])))
     return result
 
@@ -22,11 +28,135 @@ def check_name_format(chemicals_string_list):
     the format 'First0.75_Second0.10_Third0.5_Fourth0.5' 
     return True if yes and False if no
     """
-    return search(r'[A-Za-z]+\d+.?\d+_', chemicals_string_list) != None
+    return name_format_pattern.search(chemicals_string_list) != None
+
+class RecipeCache:
+    """
+    Parsed solutes and solvent strings of the drops. The samples of a batch reuse a few recipes
+    (e.g. 'DMF0.75_DMSO0.25'), so each string is only parsed once: parse returns the
+    (content, concentration) pairs of split_chemicals, or None for a string that does not follow
+    the format of check_name_format (e.g. 'Xu-Recipe-PSK').
+    The least recently used strings are dropped past max_size. The cache can be saved to a json
+    file and loaded in the next run; once a file is loaded, the strings parsed since the last
+    take_new are kept apart, for the worker processes to send them back to the process that saves the cache.
+    """
+    def __init__(self, max_size = 4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.new = {}
+        self.loaded = set()
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, recipe):
+        if recipe in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(recipe)
+            return self.entries[recipe]
+        self.misses += 1
+        parsed = tuple(split_chemicals(recipe)) if check_name_format(recipe) else None
+        if len(self.loaded) > 0:
+            self.new[recipe] = parsed
+        self.add({recipe: parsed})
+        return parsed
+
+    def add(self, entries):
+        """Adds parsed strings, e.g. from take_new in another process"""
+        for recipe, parsed in entries.items():
+            self.entries[recipe] = parsed
+            self.entries.move_to_end(recipe)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def take_new(self):
+        """Returns the strings parsed since the last call and forgets them"""
+        res = self.new
+        self.new = {}
+        return res
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'max_size': self.max_size}
+
+    def save(self, path):
+        f = open(path, 'w')
+        dump(self.entries, f)
+        f.close()
+
+    def load(self, path):
+        """Adds the strings of a file saved by save, when the file exists"""
+        self.loaded.add(path)
+        if not isfile(path):
+            return
+        f = open(path)
+        entries = load(f)
+        f.close()
+        self.add({recipe: None if parsed == None else tuple((c, float(v)) for c, v in parsed)
+                  for recipe, parsed in entries.items()})
+
+# cache of this process, shared by the chem tables of every sample and batch
+recipe_cache = RecipeCache()
+
+def chemical_key(content, concentration = np.nan):
+    """Key of a chemical across samples, e.g. 'DMF0.75', or the content alone without a concentration"""
+    if pd.isna(concentration):
+        return str(content)
+    return str(content) + str(float(concentration))
+
+def add_chemical_keys(c_df):
+    """
+    Adds the chemical_key column to a chem table, for the shared Chemical nodes: the key of the
+    solutes, solvents and antisolvents, empty for the Mix solutions that stay in their sample
+    """
+    c_df['chemical_key'] = [np.nan if chem_type == 'solution' else chemical_key(content, concentration)
+                            for content, concentration, chem_type 
+                            in zip(c_df['content'], c_df['concentration'], c_df['chem_type'])]
+    return c_df
 
-def chem_table(sample, batch_id):
+def append_column(values):
+    """Builds a column with the same dtype and values it would have had if it was grown
+    one row at a time with DataFrame.append, so the csv output stays the same (e.g. a 
+    molarity of 0 is written as 0.0 once the column holds floats, a volume of 40 is not)
+    """
+    # None while the column only has missing values
+    dtype = None
+    column = []
+    for value in values:
+        if type(value) == float and np.isnan(value):
+            pass
+        elif type(value) == float and dtype in [None, 'float64']:
+            dtype = 'float64'
+        elif type(value) == int and dtype == 'float64':
+            value = float(value)
+        else:
+            dtype = object
+        column.append(value)
+    if dtype == None:
+        dtype = object
+    return pd.Series(column, dtype=dtype)
+
+def chem_table(sample, batch_id, cache = None):
+    """
+    Chem table of a sample: the solutes, solvents and antisolvents of its drops and the Mix
+    solutions they make.
+    
+    :param cache: RecipeCache used to parse the solutes and solvent strings, recipe_cache by default
+    """
+    if cache == None:
+        cache = recipe_cache
     chem_cols = ['chemical_id', 'batch_id', 'content', 'concentration', 'molarity', 'volume', 'chem_type']
-    chem = pd.DataFrame(columns = chem_cols)
+    
+    # rows are collected into one buffer per column and the DataFrame is built once at the end
+    columns = {col: [] for col in chem_cols + ['sample_id']}
+    # (content, concentration) pairs of the split solutes/solvents, and every content seen so far
+    seen_chemicals = set()
+    seen_contents = set()
+    
+    def add_row(**kwargs):
+        for col in columns:
+            columns[col].append(kwargs.get(col, np.nan))
+        seen_contents.add(kwargs['content'])
+        if 'concentration' in kwargs:
+            seen_chemicals.add((kwargs['content'], kwargs['concentration']))
     
     # the first chemical has the id of 1, the first mix has the id of 1
     chemical_id = 1
@@ -45,79 +175,85 @@ def chem_table(sample, batch_id):
                     # check if the solutes string follows the format to further breaking 
                     # it down using check_name_format helper function
                     # if yes, break the string down using the split_chemicals to get the name and the concentration
-                    if check_name_format(droplet['solution']['solutes']):
-                        for solute in split_chemicals(droplet['solution']['solutes']):
+                    parsed = cache.parse(droplet['solution']['solutes'])
+                    if parsed != None:
+                        for solute in parsed:
                             content, concentration = solute
-                            if ((chem['content'] == content) & (chem['concentration'] == concentration)).sum() == 0:
-                                new_row = create_new_row(chemical_id = chemical_id, batch_id = batch_id, 
-                                                         content = content, concentration = concentration, 
-                                                         chem_type = 'solute', sample_id = sample_id)
-
-                                chem = chem.append(new_row, ignore_index=True)
+                            if (content, concentration) not in seen_chemicals:
+                                add_row(chemical_id = chemical_id, batch_id = batch_id, 
+                                        content = content, concentration = concentration, 
+                                        chem_type = 'solute', sample_id = sample_id)
                                 chemical_id += 1
                     # if no, use the solute recipe name as the content (such as 'Xu-Recipe-PSK')
                     else:
-                            new_row = create_new_row(chemical_id = chemical_id, batch_id = batch_id, 
-                                                     content = droplet['solution']['solutes'], 
-                                                     chem_type = 'solute', sample_id = sample_id)
-
-                            chem = chem.append(new_row, ignore_index=True)
-                            chemical_id += 1
+                        add_row(chemical_id = chemical_id, batch_id = batch_id, 
+                                content = droplet['solution']['solutes'], 
+                                chem_type = 'solute', sample_id = sample_id)
+                        chemical_id += 1
                     # check if the antisolvent string follows the format to further breaking 
                     # it down using check_name_format helper function
                     # if yes, break the string down using the split_chemicals to get the name and the concentration
-                    if check_name_format(droplet['solution']['solvent']):
-                        for solvent in split_chemicals(droplet['solution']['solvent']):
+                    parsed = cache.parse(droplet['solution']['solvent'])
+                    if parsed != None:
+                        for solvent in parsed:
                             content, concentration = solvent
-                            if ((chem['content'] == content) & (chem['concentration'] == concentration)).sum() == 0:
-                                new_row = create_new_row(chemical_id = chemical_id, batch_id = batch_id, 
-                                                         content = content, concentration = concentration, 
-                                                         chem_type = 'solvent', sample_id = sample_id)
-                                chem = chem.append(new_row, ignore_index=True)
+                            if (content, concentration) not in seen_chemicals:
+                                add_row(chemical_id = chemical_id, batch_id = batch_id, 
+                                        content = content, concentration = concentration, 
+                                        chem_type = 'solvent', sample_id = sample_id)
                                 chemical_id += 1
                     # if no, use the solute recipe name as the content (such as 'Xu-Recipe-PSK')
                     else:
-                        new_row = create_new_row(chemical_id = chemical_id, batch_id = batch_id, 
-                                                 content = droplet['solution']['solutes'], 
-                                                 chem_type = 'solvent', sample_id = sample_id)
-
-                        chem = chem.append(new_row, ignore_index=True)
+                        add_row(chemical_id = chemical_id, batch_id = batch_id, 
+                                content = droplet['solution']['solutes'], 
+                                chem_type = 'solvent', sample_id = sample_id)
                         chemical_id += 1
                     # adding the mix (or solution) from the previous solvents and solutes
-                    new_row = create_new_row(chemical_id = chemical_id, batch_id = batch_id, 
-                                             content = 'Mix'+str(mix_id), volume = droplet['volume'], 
-                                             molarity = droplet['solution']['molarity'],
-                                             chem_type = 'solution', sample_id = sample_id)
-
-                    chem = chem.append(new_row, ignore_index=True)
+                    add_row(chemical_id = chemical_id, batch_id = batch_id, 
+                            content = 'Mix'+str(mix_id), volume = droplet['volume'], 
+                            molarity = droplet['solution']['molarity'],
+                            chem_type = 'solution', sample_id = sample_id)
                     mix_id += 1
                     chemical_id += 1
                 # check if the drop is an antisolvent (no solvent and no solute present)
                 if 'solution' in droplet and droplet['solution']['solutes'] == '':
                     # check if the antisolvent is already in the df, add to the df if not in the df
-                    if (chem['content'] == droplet['solution']['solvent']).sum() == 0:
-                        new_row = create_new_row(chemical_id = chemical_id, batch_id = batch_id, 
-                                                 content = droplet['solution']['solvent'],
-                                                 molarity = droplet['solution']['molarity'],
-                                                 chem_type = 'antisolvent', sample_id = sample_id)
-                        chem = chem.append(new_row, ignore_index=True)
+                    if droplet['solution']['solvent'] not in seen_contents:
+                        add_row(chemical_id = chemical_id, batch_id = batch_id, 
+                                content = droplet['solution']['solvent'],
+                                molarity = droplet['solution']['molarity'],
+                                chem_type = 'antisolvent', sample_id = sample_id)
                         chemical_id += 1
                         
                     # adding the mix
-                    new_row = create_new_row(chemical_id = chemical_id, batch_id = batch_id, 
-                                             content = 'Mix'+str(mix_id),
-                                             volume = droplet['volume'],
-                                             chem_type = 'solution', sample_id = sample_id)
-
-                    chem = chem.append(new_row, ignore_index=True)
+                    add_row(chemical_id = chemical_id, batch_id = batch_id, 
+                            content = 'Mix'+str(mix_id),
+                            volume = droplet['volume'],
+                            chem_type = 'solution', sample_id = sample_id)
                     mix_id += 1
                     chemical_id += 1
-    return chem
+    
+    # an empty sample keeps the bare chem columns, like the empty frame it started as
+    if len(columns['chemical_id']) == 0:
+        return pd.DataFrame(columns = chem_cols)
+    return pd.DataFrame({col: append_column(columns[col]) for col in columns})
+
+def chem_filename(batch_id, sample):
+    """Name of the chem csv file of a sample, with the whitespace replaced by underscores"""
+    filename = batch_id + '_' + sample + '_' + 'chem.csv'
+    return filename.replace(' ', '_')
 
-def save_chem_csvs(samples, batch_id):
-    """Takes in the dictionary of samples and run chem_table and save the resulting csv files.
-    Replaces the whitespace in the name with underscore for Neo4J compatibility"""
+def save_chem_csvs(samples, batch_id, filepath = ''):
+    """Takes in the samples, as (sample_id, process_sample, char_sample) tuples from etl.stream_samples, 
+    run chem_table and save the resulting csv files.
+    Replaces the whitespace in the name with underscore for Neo4J compatibility.
+    This is a generator that yields the samples back once their csv is saved, so it can be chained 
+    with save_action_csvs without holding the batch in memory"""
     for sample in samples:
-        filename = batch_id + '_' + sample + '_' + 'chem.csv'
-        filename = filename.replace(' ', '_')
-        chem_table(samples[sample], batch_id).to_csv(filename, index=False)
+        filename = chem_filename(batch_id, sample[0])
+        with stage('chem', batch_id, sample[0]) as record:
+            c_df = chem_table(sample[1], batch_id)
+            c_df.to_csv(join(filepath, filename), index=False)
+            record['rows'] = c_df.shape[0]
+            record['bytes'] = file_size(join(filepath, filename))
+        yield sample
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+
+# Parquet format of the chem, action and link tables. Needs pyarrow (pip install pyarrow).
+# Types of the columns every table has. The ids are integers (nullable) and the columns with
+# few distinct values are dictionary encoded. The other columns of the action table depend on
+# the steps of the sample, their type is found from their values (see value_type).
+table_schemas = {
+    'chem': {'chemical_id': 'int64', 'batch_id': 'dictionary', 'content': 'string', 'concentration': 'float64',
+             'molarity': 'float64', 'volume': 'float64', 'chem_type': 'dictionary', 'sample_id': 'dictionary'},
+    'action': {'step_id': 'int64', 'action': 'dictionary', 'chemical_from': 'int64', 'sample_id': 'dictionary',
+               'batch_id': 'dictionary', 'char_name': 'dictionary'},
+    'link': {'step_id': 'int64', 'action': 'dictionary', 'chemical_from': 'int64', 'step_to': 'int64',
+             'chemical_to': 'int64', 'step_from': 'int64', 'sample_id': 'dictionary', 'batch_id': 'dictionary'}
+}
+
+def parquet_filename(fname):
+    """Name of the parquet file of a table, from the name of its csv file"""
+    return fname.rsplit('.', 1)[0] + '.parquet'
+
+def is_number(v):
+    return isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, (bool, np.bool_))
+
+def is_integer(v):
+    return isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_))
+
+def value_type(values):
+    """
+    Type of a column from its values: bool, int64 or float64 when every value is of that type,
+    list<int64> or list<float64> for lists of numbers (e.g. the spin logs), and string for
+    anything else (e.g. the dictionaries of the characterization outputs), written as in the csv.
+    """
+    values = [v for v in values if not (pd.api.types.is_scalar(v) and pd.isna(v))]
+    if len(values) == 0:
+        return 'string'
+    if all(isinstance(v, (bool, np.bool_)) for v in values):
+        return 'bool'
+    if all(is_integer(v) for v in values):
+        return 'int64'
+    if all(is_number(v) for v in values):
+        return 'float64'
+    if all(isinstance(v, list) for v in values):
+        items = [i for v in values for i in v]
+        if all(is_integer(i) for i in items):
+            return 'list<int64>'
+        if all(is_number(i) for i in items):
+            return 'list<float64>'
+    return 'string'
+
+def table_schema(df, table):
+    """Type of each column of a chem, action or link DataFrame, as a dictionary"""
+    return {col: table_schemas[table].get(col) or value_type(df[col]) for col in df.columns}
+
+def import_pyarrow():
+    """pyarrow and pyarrow.parquet, with an ImportError that says how to install them"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError('the parquet tables need pyarrow, install it with pip install pyarrow') from e
+    return pa, pq
+
+def arrow_array(values, col_type):
+    pa, pq = import_pyarrow()
+    if col_type == 'dictionary':
+        return pa.array(values.map(str, na_action='ignore'), type=pa.string(), from_pandas=True).dictionary_encode()
+    if col_type == 'string':
+        return pa.array(values.map(str, na_action='ignore'), type=pa.string(), from_pandas=True)
+    types = {'int64': pa.int64(), 'float64': pa.float64(), 'bool': pa.bool_(),
+             'list<int64>': pa.list_(pa.int64()), 'list<float64>': pa.list_(pa.float64())}
+    if col_type == 'int64':
+        values = values.astype('Int64')
+    return pa.array(values, type=types[col_type], from_pandas=True)
+
+def save_table(df, path, table):
+    """
+    Saves a chem, action or link DataFrame as a parquet file, with the types of table_schema.
+
+    :param table: 'chem', 'action' or 'link'
+    """
+    pa, pq = import_pyarrow()
+    schema = table_schema(df, table)
+    arrays = [arrow_array(df[col], schema[col]) for col in df.columns]
+    pq.write_table(pa.Table.from_arrays(arrays, names=[str(col) for col in df.columns]), path)
+
+def read_table(path, columns = None):
+    """
+    Reads a table saved by save_table. Only the given columns are read from the file.
+    The ids are nullable Int64 columns, the dictionary encoded columns are categoricals and
+    the lists are python lists, so the values are written as in the csv files.
+    """
+    pa, pq = import_pyarrow()
+    arrow_table = pq.read_table(path, columns=columns)
+    df = arrow_table.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+    for field in arrow_table.schema:
+        if pa.types.is_list(field.type):
+            df[field.name] = df[field.name].map(lambda v: v.tolist(), na_action='ignore')
+    return df
+
+def table_columns(path):
+    """Names of the columns of a parquet file, read from its schema without reading the data"""
+    pa, pq = import_pyarrow()
+    return pq.read_schema(path).names
+
+def read_frame(path, **csv_options):
+    """Reads a table from its parquet file (see read_table) or its csv file (with pd.read_csv)"""
+    if path.endswith('.parquet'):
+        return read_table(path)
+    return pd.read_csv(path, **csv_options)
@@ -1,6 +1,6 @@
 from os import listdir, remove
-from os.path import isfile, join
-from json import load, loads
+from os.path import isfile, isdir, join, basename, normpath
+from json import load, loads, JSONDecoder, JSONDecodeError
 from tifffile import imread,imwrite
 from re import search, findall
 import numpy as np
@@ -8,21 +8,151 @@ import pandas as pd
 
 def get_data():
     '''
-    Reads and returns data from the test/testdata directory
+    Returns a generator over the samples of the test/testdata directory,
+    see stream_samples
     '''
-    data_list = []
     fp = "test/testdata/"
     files = [
         'test_process.json',
         'test_char.json']
-    for i in files:
-        f = open(fp + i, 'r')
-        data = load(f)
-        data_list.append(data)
-        f.close()
+    return stream_samples(fp + files[0], fp + files[1])
+
+def find_batch(directory):
+    """Checks if a directory holds one batch: a process worklist json (name containing 'process'),
+    a characterization worklist json (name containing 'char') and a Characterization_<batch> folder.
+    
+    Returns a dictionary with the batch_id and the paths of the three inputs, or None if the
+    directory is not a batch. The batch_id is taken from the Characterization folder suffix in 
+    lower case ('Characterization_B19' -> 'b19'), or from the directory name otherwise.
+    """
+    files = sorted(listdir(directory))
+    process_files = [f for f in files if f.endswith('.json') and 'process' in f]
+    char_files = [f for f in files if f.endswith('.json') and 'char' in f]
+    char_folders = [f for f in files if f.startswith('Characterization') and isdir(join(directory, f))]
+    if len(process_files) == 0 or len(char_files) == 0 or len(char_folders) == 0:
+        return None
     
-    data_list.append(['Characterization_B19', 'sample0'])
-    return data_list
+    if search(r'Characterization_(\w+)', char_folders[0]) != None:
+        batch_id = search(r'Characterization_(\w+)', char_folders[0]).group(1).lower()
+    else:
+        batch_id = basename(normpath(directory)).replace(' ', '_')
+    return {'batch_id': batch_id,
+            'process_file': join(directory, process_files[0]),
+            'char_file': join(directory, char_files[0]),
+            'char_folder': join(directory, char_folders[0])}
+
+def find_batches(directory = 'test/testdata'):
+    """Finds every batch in the directory, either the directory itself or its subdirectories
+    (one batch per subdirectory). Batches are returned sorted by their directory name so
+    the order does not depend on the file system.
+    """
+    batches = []
+    batch = find_batch(directory)
+    if batch != None:
+        batches.append(batch)
+    for folder in sorted(listdir(directory)):
+        if isdir(join(directory, folder)) and not folder.startswith('Characterization'):
+            batch = find_batch(join(directory, folder))
+            if batch != None:
+                batches.append(batch)
+    return batches
+
+# characters that can follow the first part of a json number
+number_chars = '0123456789.eE+-'
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
 
+def stream_json_items(filepath, chunk_size = 65536):
+    """
+    Generator that reads a json file holding one top-level object (like the process and 
+    characterization worklists, keyed by sample) and yields its (key, value) pairs one at a time.
+    Only the value being decoded is kept in memory, not the whole file.
+    
+    :param filepath: path of the json file
+    :param chunk_size: number of characters read from the file at a time
+    """
+    decoder = JSONDecoder()
+    f = open(filepath, 'r')
+    # buffer holds the part of the file not decoded yet, starting at pos
+    state = {'buffer': f.read(chunk_size), 'pos': 0, 'eof': False, 'read_size': chunk_size}
+    
+    def read_more():
+        # the read size doubles while a value does not fit, so a large value is not re-decoded 
+        # once per chunk, and goes back to chunk_size once the value is decoded
+        more = f.read(state['read_size'])
+        state['read_size'] *= 2
+        if more == '':
+            state['eof'] = True
+        state['buffer'] += more
+    
+    def next_char():
+        # skips the whitespace and returns the next character ('' at the end of the file)
+        while True:
+            while state['pos'] < len(state['buffer']) and state['buffer'][state['pos']].isspace():
+                state['pos'] += 1
+            if state['pos'] < len(state['buffer']) or state['eof']:
+                break
+            read_more()
+        return state['buffer'][state['pos']:state['pos']+1]
+    
+    def decode():
+        while True:
+            try:
+                value, end = decoder.raw_decode(state['buffer'], state['pos'])
+                # a number at the end of the buffer could be cut in the middle (e.g. '0.' or '1.5e'
+                # decode as 0 and 1.5), it is complete once a character that is not part of it follows
+                if state['eof'] or (end < len(state['buffer']) and
+                                    not (is_number(value) and state['buffer'][end] in number_chars)):
+                    state['pos'] = end
+                    return value
+            except JSONDecodeError:
+                if state['eof']:
+                    raise
+            read_more()
+    
+    try:
+        if next_char() != '{':
+            raise ValueError(filepath + ' does not hold a json object')
+        state['pos'] += 1
+        while True:
+            char = next_char()
+            if char == '}':
+                break
+            if char == ',':
+                state['pos'] += 1
+                next_char()
+            key = decode()
+            if next_char() != ':':
+                raise ValueError('expected ":" after the key ' + str(key) + ' in ' + filepath)
+            state['pos'] += 1
+            next_char()
+            value = decode()
+            state['read_size'] = chunk_size
+            # drop what has been decoded once it is more than a chunk, the buffer is not copied
+            # after every value
+            if state['pos'] >= chunk_size:
+                state['buffer'] = state['buffer'][state['pos']:]
+                state['pos'] = 0
+            yield key, value
+    finally:
+        f.close()
 
-        
\ No newline at end of file
+def stream_samples(process_file, char_file, chunk_size = 65536):
+    """
+    Generator that yields (sample_id, process_sample, char_sample) one sample at a time, in the
+    order of the process worklist file. process_sample and char_sample are the entries of the sample
+    in the two files (holding its 'name' and 'worklist'); char_sample is None when the sample is not
+    in the characterization file. Samples that are in the same order in both files are matched
+    without keeping other samples in memory.
+    """
+    char_items = stream_json_items(char_file, chunk_size)
+    # characterization samples read ahead of the process file, waiting for their process sample
+    char_ahead = {}
+    for sample_id, process_sample in stream_json_items(process_file, chunk_size):
+        while sample_id not in char_ahead:
+            char_item = next(char_items, None)
+            if char_item == None:
+                break
+            char_ahead[char_item[0]] = char_item[1]
+        yield sample_id, process_sample, char_ahead.pop(sample_id, None)
@@ -0,0 +1,234 @@
+from os import makedirs
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+from columnar import read_table
+
+# kinds of nodes and types of links of the graph, in the order of their codes
+node_kinds = ['chem', 'action']
+edge_types = ['GOES_INTO', 'OUTPUTS', 'NEXT']
+# arrays of a GraphIndex, saved as .npy files
+index_arrays = ['keys', 'labels', 'out_ptr', 'out_dst', 'out_type', 'in_ptr', 'in_src', 'in_type']
+
+def node_keys(sample_codes, kinds, ids):
+    """
+    Key of each node as one int64, ordered by sample, then kind, then chemical_id or step_id,
+    so the nodes of a sample are next to each other once the keys are sorted
+    """
+    return (np.asarray(sample_codes, dtype=np.int64) * 2 + np.asarray(kinds, dtype=np.int64)) * 2 ** 32 + \
+        np.asarray(ids, dtype=np.int64)
+
+def csr(src, dst, types, n):
+    """Adjacency arrays of the links from src to dst: the links of node i are ptr[i]:ptr[i + 1] of dst and types"""
+    order = np.argsort(src, kind='stable')
+    ptr = np.zeros(n + 1, dtype=np.int64)
+    ptr[1:] = np.cumsum(np.bincount(src, minlength=n))
+    return ptr, dst[order], types[order]
+
+def read_columns(path, columns):
+    """Reads only some columns of a parquet or csv table"""
+    if path.endswith('.parquet'):
+        return read_table(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
+
+class GraphIndex:
+    """
+    In-memory index of the graph of the chem, action and link tables, for lineage queries
+    without Neo4j. The nodes are numbered 0, 1, ... in the order of their keys (see node_keys),
+    and the links are kept as CSR adjacency arrays both ways (out_* from each node and in_* to
+    each node), with the type of each link (its position in edge_types).
+    The arrays can be saved as .npy files and loaded memory-mapped (see load_graph_index).
+
+    :param samples: DataFrame with the batch_id and sample_id of each sample code
+    :param label_names: names of the labels, the action of the action nodes and the content
+        of the chem nodes
+    """
+    def __init__(self, samples, label_names, arrays):
+        self.samples = samples
+        self.label_names = label_names
+        for name in index_arrays:
+            setattr(self, name, arrays[name])
+        self.sample_codes = {key: i for i, key in enumerate(zip(samples['batch_id'], samples['sample_id']))}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def node(self, batch_id, sample_id, kind, node_id):
+        """Number of a node, e.g. node('b19', 'sample0', 'action', 30). Raises KeyError when it is not in the graph"""
+        key = node_keys(self.sample_codes[(batch_id, sample_id)], node_kinds.index(kind), node_id)
+        i = np.searchsorted(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            raise KeyError((batch_id, sample_id, kind, node_id))
+        return int(i)
+
+    def find(self, kind, label = None):
+        """Numbers of the nodes of a kind, only with the given label (e.g. 'spin' or 'DMF') if any"""
+        kinds = (self.keys // 2 ** 32) % 2
+        found = kinds == node_kinds.index(kind)
+        if label != None:
+            if label not in self.label_names:
+                return np.empty(0, dtype=np.int64)
+            found &= np.asarray(self.labels) == self.label_names.index(label)
+        return np.flatnonzero(found)
+
+    def describe(self, nodes):
+        """DataFrame with the batch_id, sample_id, kind, id and label of nodes"""
+        keys = np.asarray(self.keys)[np.asarray(nodes, dtype=np.int64)]
+        codes = keys // 2 ** 33
+        return pd.DataFrame({'node': nodes,
+                             'batch_id': self.samples['batch_id'].to_numpy()[codes],
+                             'sample_id': self.samples['sample_id'].to_numpy()[codes],
+                             'kind': np.array(node_kinds, dtype=object)[(keys // 2 ** 32) % 2],
+                             'id': keys % 2 ** 32,
+                             'label': np.array(self.label_names, dtype=object)[np.asarray(self.labels)[nodes]]})
+
+    def neighbors(self, nodes, direction = 'out', types = None):
+        """
+        Links of many nodes at once, as (position of the node in nodes, neighbor, link type) arrays.
+
+        :param direction: 'out' for the links from the nodes, 'in' for the links to them
+        :param types: optional list of the link types to follow, e.g. ['NEXT']
+        """
+        ptr, other, link_type = (self.out_ptr, self.out_dst, self.out_type) if direction == 'out' else \
+            (self.in_ptr, self.in_src, self.in_type)
+        nodes = np.asarray(nodes, dtype=np.int64)
+        starts = np.asarray(ptr[nodes])
+        counts = np.asarray(ptr[nodes + 1]) - starts
+        source = np.repeat(np.arange(len(nodes)), counts)
+        # positions of the links in the adjacency arrays, links of each node one after the other
+        offsets = np.cumsum(counts) - counts
+        positions = starts[source] + np.arange(counts.sum()) - offsets[source]
+        res_other = np.asarray(other[positions])
+        res_type = np.asarray(link_type[positions])
+        if types != None:
+            keep = np.isin(res_type, [edge_types.index(t) for t in types])
+            return source[keep], res_other[keep], res_type[keep]
+        return source, res_other, res_type
+
+    def traverse(self, nodes, direction = 'out', types = None):
+        """
+        Every node reachable from each of nodes, with all the nodes traversed at the same time.
+
+        :return: (position of the start node in nodes, reached node) arrays, without the start nodes
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        n = len(self.keys)
+        frontier_source, frontier = np.arange(len(nodes)), nodes
+        # (start node, node) pairs reached so far, as start * n + node, sorted
+        seen = np.unique(frontier_source * n + frontier)
+        res_source, res_node = [], []
+        while len(frontier) > 0:
+            pos, reached, link_type = self.neighbors(frontier, direction, types)
+            pairs = np.unique(frontier_source[pos] * n + reached)
+            pairs = pairs[~np.isin(pairs, seen, assume_unique=True)]
+            seen = np.union1d(seen, pairs)
+            frontier_source, frontier = pairs // n, pairs % n
+            res_source.append(frontier_source)
+            res_node.append(frontier)
+        if len(res_node) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(res_source), np.concatenate(res_node)
+
+    def ancestors(self, nodes, types = None):
+        """Nodes that lead to each of nodes, as (position in nodes, ancestor) arrays, see traverse"""
+        return self.traverse(nodes, 'in', types)
+
+    def descendants(self, nodes, types = None):
+        """Nodes each of nodes leads to, as (position in nodes, descendant) arrays, see traverse"""
+        return self.traverse(nodes, 'out', types)
+
+    def path(self, source, target, types = None):
+        """
+        Shortest path of links from source to target, as the list of its nodes
+        (from source to target), or None when target cannot be reached from source
+        """
+        parents = {int(source): None}
+        frontier = np.array([source], dtype=np.int64)
+        while len(frontier) > 0 and int(target) not in parents:
+            pos, reached, link_type = self.neighbors(frontier, 'out', types)
+            next_frontier = []
+            for p, node in zip(frontier[pos], reached):
+                if int(node) not in parents:
+                    parents[int(node)] = int(p)
+                    next_frontier.append(node)
+            frontier = np.array(next_frontier, dtype=np.int64)
+        if int(target) not in parents:
+            return None
+        res = [int(target)]
+        while parents[res[-1]] != None:
+            res.append(parents[res[-1]])
+        return res[::-1]
+
+    def save(self, folder):
+        """Saves the arrays as .npy files in folder, with the samples and the label names as csv files"""
+        makedirs(folder, exist_ok=True)
+        for name in index_arrays:
+            np.save(join(folder, name + '.npy'), np.asarray(getattr(self, name)))
+        self.samples.to_csv(join(folder, 'samples.csv'), index=False)
+        pd.DataFrame({'label': self.label_names}).to_csv(join(folder, 'labels.csv'), index=False)
+
+def load_graph_index(folder, mmap = True):
+    """Loads a GraphIndex saved with GraphIndex.save, with the arrays memory-mapped unless mmap is False"""
+    arrays = {name: np.load(join(folder, name + '.npy'), mmap_mode='r' if mmap else None) for name in index_arrays}
+    samples = pd.read_csv(join(folder, 'samples.csv'), dtype=str, keep_default_na=False)
+    label_names = pd.read_csv(join(folder, 'labels.csv'), dtype=str, keep_default_na=False)['label'].to_list()
+    return GraphIndex(samples, label_names, arrays)
+
+def build_graph_index(chem_df, action_df, link_df):
+    """
+    Builds the GraphIndex of the chem, action and link tables of one or more samples (e.g. the
+    concatenated tables of a batch, or the batch files of batch_output). The links are the
+    relationships of the cypher file (see query_feature.create_links): GOES_INTO from the
+    chemical_from to the step_to, OUTPUTS and NEXT from the step_from to the chemical_to, and NEXT
+    from the step_from to the step_to. Links to a node that is not in the tables are left out,
+    as the MATCH of the queries would.
+    """
+    samples = pd.concat([df[['batch_id', 'sample_id']] for df in [chem_df, action_df, link_df]])
+    samples = samples.astype(str).drop_duplicates().reset_index(drop=True)
+    sample_index = pd.MultiIndex.from_frame(samples)
+
+    def sample_codes(df):
+        return sample_index.get_indexer(pd.MultiIndex.from_arrays([df['batch_id'].astype(str), 
+                                                                   df['sample_id'].astype(str)])).astype(np.int64)
+
+    keys = np.concatenate([node_keys(sample_codes(chem_df), 0, chem_df['chemical_id']),
+                           node_keys(sample_codes(action_df), 1, action_df['step_id'])])
+    labels, label_names = pd.factorize(pd.concat([chem_df['content'], action_df['action']]).astype(str).to_numpy())
+    keys, first = np.unique(keys, return_index=True)
+    labels = labels[first]
+
+    link_codes = sample_codes(link_df)
+    link_type = np.array([edge_types.index(t) for t in link_df['action']], dtype=np.int64)
+    src, dst, types = [], [], []
+    for from_col, from_kind, to_col, to_kind in [('chemical_from', 0, 'step_to', 1), ('step_from', 1, 'chemical_to', 0),
+                                                 ('step_from', 1, 'step_to', 1)]:
+        has = link_df[from_col].notna().to_numpy() & link_df[to_col].notna().to_numpy()
+        src.append(node_keys(link_codes[has], from_kind, link_df[from_col][has].astype(np.int64)))
+        dst.append(node_keys(link_codes[has], to_kind, link_df[to_col][has].astype(np.int64)))
+        types.append(link_type[has])
+    src, dst, types = np.concatenate(src), np.concatenate(dst), np.concatenate(types)
+    src_node = np.minimum(np.searchsorted(keys, src), len(keys) - 1)
+    dst_node = np.minimum(np.searchsorted(keys, dst), len(keys) - 1)
+    found = (keys[src_node] == src) & (keys[dst_node] == dst)
+    src_node, dst_node, types = src_node[found], dst_node[found], types[found]
+
+    arrays = {'keys': keys, 'labels': labels}
+    arrays['out_ptr'], arrays['out_dst'], arrays['out_type'] = csr(src_node, dst_node, types, len(keys))
+    arrays['in_ptr'], arrays['in_src'], arrays['in_type'] = csr(dst_node, src_node, types, len(keys))
+    return GraphIndex(samples, list(label_names), arrays)
+
+def index_file_tables(file_dict):
+    """
+    Reads the columns the graph index needs from the chem, action and link files of a file_dict
+    (as used by query_feature.save_queries, with csv or parquet files), concatenated by table
+    """
+    columns = {'chem': ['chemical_id', 'content', 'sample_id', 'batch_id'],
+               'action': ['step_id', 'action', 'sample_id', 'batch_id'],
+               'link': ['action', 'chemical_from', 'step_to', 'chemical_to', 'step_from', 'sample_id', 'batch_id']}
+    tables = {}
+    for table in ['chem', 'action', 'link']:
+        files = list(dict.fromkeys(file_dict[key][table] for key in file_dict))
+        tables[table] = pd.concat([read_columns(f, columns[table]) for f in files], ignore_index=True)
+    return tables['chem'], tables['action'], tables['link']
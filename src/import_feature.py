@@ -0,0 +1,194 @@
+from os import makedirs
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+from columnar import read_frame
+
+# columns holding ids, always written as integers
+id_columns = ['chemical_id', 'step_id', 'chemical_from', 'step_to', 'chemical_to', 'step_from']
+
+def node_ids(prefix, df, id_col):
+    """
+    Globally unique node ids, e.g. 'chem:b19:sample0:4' or 'action:b19:sample0:11'.
+    The ids of the different samples and batches never collide, so every sample can go into
+    the same import.
+    """
+    return (prefix + ':' + df['batch_id'].astype(str) + ':' + df['sample_id'].astype(str) + ':'
+            + df[id_col].astype('Int64').astype(str))
+
+def column_type(col, values):
+    """
+    neo4j-admin import type of a column: long for the id columns, and boolean, long or double
+    when every value of the column is of that type. Anything else (e.g. the lists and
+    dictionaries of the spin logs and characterization outputs) is stored as a string.
+    """
+    if col in id_columns:
+        return 'long'
+    values = values.dropna()
+    if len(values) == 0:
+        return 'string'
+    if values.map(lambda v: isinstance(v, (bool, np.bool_))).all():
+        return 'boolean'
+    if values.map(lambda v: isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_))).all():
+        return 'long'
+    if values.map(lambda v: isinstance(v, (int, float, np.integer, np.floating))
+                  and not isinstance(v, (bool, np.bool_))).all():
+        return 'double'
+    return 'string'
+
+def single_line(v):
+    return str(v).replace('\r\n', ' ').replace('\n', ' ').replace('\r', ' ')
+
+def typed_frame(df, fixed_columns = []):
+    """
+    Renames the columns of df to the 'name:type' header format of neo4j-admin import and
+    converts the values so they are written as that type (no 1.0 in a long column,
+    true/false for booleans). The fixed_columns (':ID', ':LABEL', ...) are kept as they are.
+    The line breaks of the strings (e.g. in the repr of the arrays of the characterization
+    outputs) are replaced with spaces, as neo4j-admin reads one row per line by default.
+    """
+    res = pd.DataFrame(index=df.index)
+    for col in df.columns:
+        if col in fixed_columns:
+            res[col] = df[col]
+            continue
+        col_type = column_type(col, df[col])
+        if col_type == 'long':
+            res[col + ':long'] = df[col].astype('Int64')
+        elif col_type == 'boolean':
+            res[col + ':boolean'] = df[col].map(lambda v: str(v).lower(), na_action='ignore')
+        elif col_type == 'double':
+            res[col + ':double'] = df[col].astype('float64')
+        else:
+            res[col] = df[col].map(single_line, na_action='ignore')
+    return res
+
+def import_nodes(chem_dfs, action_dfs):
+    """
+    Builds the Chemical and Action node tables of neo4j-admin import from the outputs of
+    chem_table and action_table (one DataFrame per sample).
+    """
+    # empty chem tables only have the bare chem columns
+    chem = pd.concat([c for c in chem_dfs if c.shape[0] > 0] or chem_dfs, ignore_index=True)
+    chem.insert(0, ':ID', node_ids('chem', chem, 'chemical_id'))
+    chem[':LABEL'] = 'Chemical'
+
+    action = pd.concat(action_dfs, ignore_index=True)
+    action.insert(0, ':ID', node_ids('action', action, 'step_id'))
+    action[':LABEL'] = 'Action'
+
+    return typed_frame(chem, [':ID', ':LABEL']), typed_frame(action, [':ID', ':LABEL'])
+
+def import_relationships(link_dfs, action_dfs):
+    """
+    Builds the relationship table of neo4j-admin import from the outputs of link_table,
+    with the same links as create_links:
+        chemical_from -> step_to is a GOES_INTO link,
+        step_from -> chemical_to is an OUTPUTS link from a dissolve step or a NEXT link from a drop step,
+        step_from -> step_to is a NEXT link.
+    """
+    links = pd.concat(link_dfs, ignore_index=True)
+    actions = pd.concat([a[['batch_id', 'sample_id', 'step_id', 'action']] for a in action_dfs], ignore_index=True)
+    action_of_step = dict(zip(node_ids('action', actions, 'step_id'), actions['action']))
+
+    rels = []
+    goes_into = links[links['chemical_from'].notna() & links['step_to'].notna()]
+    rels.append(pd.DataFrame({':START_ID': node_ids('chem', goes_into, 'chemical_from'),
+                              ':END_ID': node_ids('action', goes_into, 'step_to'),
+                              ':TYPE': 'GOES_INTO'}))
+
+    to_chem = links[links['step_from'].notna() & links['chemical_to'].notna()]
+    start = node_ids('action', to_chem, 'step_from')
+    rel_type = start.map(action_of_step).map({'dissolve': 'OUTPUTS', 'drop': 'NEXT'})
+    rels.append(pd.DataFrame({':START_ID': start,
+                              ':END_ID': node_ids('chem', to_chem, 'chemical_to'),
+                              ':TYPE': rel_type}).dropna(subset=[':TYPE']))
+
+    next_step = links[links['step_from'].notna() & links['step_to'].notna()]
+    rels.append(pd.DataFrame({':START_ID': node_ids('action', next_step, 'step_from'),
+                              ':END_ID': node_ids('action', next_step, 'step_to'),
+                              ':TYPE': 'NEXT'}))
+
+    res = pd.concat(rels)
+    # keep the order of the link table
+    return res.sort_index(kind='stable').reset_index(drop=True)
+
+def save_import_files(chem_dfs, action_dfs, link_dfs, folder = 'import'):
+    """
+    Saves the node and relationship files for an offline load with neo4j-admin database import.
+    Links whose start or end node does not exist are dropped, like the MATCH in create_links.
+
+    :param chem_dfs, action_dfs, link_dfs: lists of the chem_table, action_table and link_table
+        outputs of every sample to import
+    :param folder: folder where the files are saved
+    :return: dictionary with the paths of the 'chemicals', 'actions' and 'relationships' files
+    """
+    makedirs(folder, exist_ok=True)
+    chem, action = import_nodes(chem_dfs, action_dfs)
+    rels = import_relationships(link_dfs, action_dfs)
+    ids = set(chem[':ID']) | set(action[':ID'])
+    rels = rels[rels[':START_ID'].isin(ids) & rels[':END_ID'].isin(ids)]
+
+    files = {'chemicals': join(folder, 'chemicals.csv'),
+             'actions': join(folder, 'actions.csv'),
+             'relationships': join(folder, 'relationships.csv')}
+    chem.to_csv(files['chemicals'], index=False)
+    action.to_csv(files['actions'], index=False)
+    rels.to_csv(files['relationships'], index=False)
+    return files
+
+def read_sample_csvs(file_dict, filepath = ''):
+    """
+    Reads back the chem, action and link csv (or parquet) files of each sample (a file_dict as 
+    used by save_queries) into the lists of DataFrames taken by save_import_files
+    """
+    dfs = {'chem': [], 'action': [], 'link': []}
+    for sample in file_dict:
+        for table in dfs:
+            dfs[table].append(read_frame(join(filepath, file_dict[sample][table])))
+    return dfs['chem'], dfs['action'], dfs['link']
+
+def import_command(files, database = 'neo4j'):
+    """The neo4j-admin (5.x) command that imports the files from save_import_files"""
+    return ('neo4j-admin database import full {} --nodes={} --nodes={} --relationships={}'
+            .format(database, files['chemicals'], files['actions'], files['relationships']))
+
+def check_import_files(files):
+    """
+    Checks the files from save_import_files before running neo4j-admin: the headers have the
+    required columns, node ids are unique, every relationship starts and ends at a node, and no
+    field holds a line break (the command of import_command reads one row per line).
+
+    :return: list of the problems found, empty if the files can be imported
+    """
+    problems = []
+    ids = set()
+    for node_file in [files['chemicals'], files['actions']]:
+        nodes = pd.read_csv(node_file, dtype=str, usecols=lambda c: c in [':ID', ':LABEL'])
+        for col in [':ID', ':LABEL']:
+            if col not in nodes.columns:
+                problems.append('{} has no {} column'.format(node_file, col))
+        if ':ID' not in nodes.columns:
+            continue
+        duplicated = nodes[':ID'][nodes[':ID'].duplicated() | nodes[':ID'].isin(ids)]
+        if len(duplicated) > 0:
+            problems.append('{} has {} duplicated ids, e.g. {}'.format(node_file, len(duplicated), duplicated.iloc[0]))
+        ids |= set(nodes[':ID'])
+
+        fields = pd.read_csv(node_file, dtype=str, keep_default_na=False)
+        multiline = [col for col in fields.columns if fields[col].str.contains('[\r\n]').any()]
+        if len(multiline) > 0:
+            problems.append('{} has line breaks in {} columns, e.g. {}'.format(node_file, len(multiline), multiline[0]))
+
+    rels = pd.read_csv(files['relationships'], dtype=str)
+    for col in [':START_ID', ':END_ID', ':TYPE']:
+        if col not in rels.columns:
+            problems.append('{} has no {} column'.format(files['relationships'], col))
+            return problems
+    for col in [':START_ID', ':END_ID']:
+        missing = rels[col][~rels[col].isin(ids)]
+        if len(missing) > 0:
+            problems.append('{} ids of {} are not nodes, e.g. {}'.format(len(missing), col, missing.iloc[0]))
+    return problems
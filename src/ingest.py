@@ -0,0 +1,270 @@
+import asyncio
+from os import listdir, makedirs, stat
+from os.path import isfile, join
+from json import dumps
+from hashlib import sha256
+from time import time
+from threading import Lock
+from queue import SimpleQueue
+from concurrent.futures import ProcessPoolExecutor
+
+from etl import find_batches, stream_samples
+from pipeline import sample_task, process_sample
+from manifest import load_manifest, save_manifest
+from query_feature import query_maker, delete_sample, shared_key_constraint
+from bolt_loader import result_frames, load_sample
+import instrument
+from instrument import stage
+
+def file_state(path):
+    """(size, modification time) of a file or folder, None when it does not exist"""
+    try:
+        st = stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+def folder_files(path):
+    """Sorted (name, size, modification time) of the files of a folder, empty when it does not exist"""
+    try:
+        names = sorted(listdir(path))
+    except FileNotFoundError:
+        return ()
+    return tuple((name,) + file_state(join(path, name)) for name in names
+                 if isfile(join(path, name)) and file_state(join(path, name)) != None)
+
+def entry_digest(process_sample, char_sample):
+    """Hash of the worklist entries of a sample, to notice when they change"""
+    return sha256(dumps([process_sample, char_sample], sort_keys=True).encode()).hexdigest()
+
+def cypher_filename(batch_id, sample):
+    """Name of the cypher file of a sample written by the ingest daemon"""
+    return (batch_id + '_' + sample + '.cypher').replace(' ', '_')
+
+class SampleWatcher:
+    """
+    Polls the batches of a directory for the samples that are ready to be processed. A sample is
+    ready when it is in the process and the characterization worklists, its characterization0
+    folder has files, and neither its worklist entries nor these files changed for settle seconds
+    (the robot may still be writing them). A processed sample is ready again when its inputs change,
+    and so is a sample that could not be processed (see fail): it is not tried again until then.
+    The worklists are only read again when their files change, and only the worklist entries of
+    the samples not processed yet are kept in memory.
+
+    :param directory: folder with one batch or one subfolder per batch (see etl.find_batches)
+    :param settle: seconds without changes before a sample is ready
+    """
+    def __init__(self, directory, settle = 5.0):
+        self.directory = directory
+        self.settle = settle
+        # (size, modification time) of the two worklist files of each batch when they were read
+        self.worklists = {}
+        # batches whose worklists are read at the next scan, for the entries of samples to process again
+        self.reload = set()
+        # state of each sample by (batch_id, sample)
+        self.samples = {}
+        # samples that could not be processed with their error, put by fail (from any thread) and taken by scan
+        self.failures = SimpleQueue()
+
+    def read_worklists(self, batch):
+        """Reads the worklist entries of the samples of a batch when its worklist files changed"""
+        files = (file_state(batch['process_file']), file_state(batch['char_file']))
+        if self.worklists.get(batch['batch_id']) == files and batch['batch_id'] not in self.reload:
+            return
+        try:
+            entries = list(stream_samples(batch['process_file'], batch['char_file']))
+        except ValueError:
+            # a worklist file that is being written, it is read again at the next scan
+            return
+        self.worklists[batch['batch_id']] = files
+        self.reload.discard(batch['batch_id'])
+        for sample, process_entry, char_entry in entries:
+            key = (batch['batch_id'], sample)
+            digest = entry_digest(process_entry, char_entry)
+            s = self.samples.setdefault(key, {'batch': batch, 'digest': None, 'entries': None, 'folder': None,
+                                              'state': None, 'since': None, 'done': None, 'error': None})
+            # the entries are kept until the sample is processed with its current inputs
+            if digest != s['digest'] or s['done'] == None or s['done'] != s['state']:
+                s['digest'] = digest
+                s['entries'] = (process_entry, char_entry) if char_entry != None else None
+                s['folder'] = None
+
+    def scan(self, now = None):
+        """
+        Polls the directory once.
+
+        :return: list of the samples that became ready, as dictionaries with the batch, the sample,
+            its process_sample and char_sample entries and the time its inputs last changed ('since')
+        """
+        now = time() if now == None else now
+        while not self.failures.empty():
+            key, error = self.failures.get()
+            self.samples[key]['error'] = error
+        for batch in find_batches(self.directory):
+            self.read_worklists(batch)
+        ready = []
+        for key, s in self.samples.items():
+            path = join(s['batch']['char_folder'], key[1], 'characterization0')
+            folder = file_state(path)
+            # processed samples are only looked at again when files are added to or removed from their folder
+            if s['entries'] == None and (s['done'] == None or (folder == s['folder'] and s['state'] == s['done'])):
+                continue
+            s['folder'] = folder
+            files = folder_files(path)
+            if len(files) == 0:
+                continue
+            state = (s['digest'], files)
+            if state != s['state']:
+                s['state'], s['since'] = state, now
+            if state == s['done'] or now - s['since'] < self.settle:
+                continue
+            if s['entries'] == None:
+                self.reload.add(key[0])
+                continue
+            ready.append({'batch': s['batch'], 'sample': key[1], 'process_sample': s['entries'][0],
+                          'char_sample': s['entries'][1], 'since': s['since']})
+            s['done'] = state
+            s['entries'] = None
+            s['error'] = None
+        return ready
+
+    def fail(self, batch_id, sample, error):
+        """
+        Records that a sample could not be processed. The sample stays done with its current inputs,
+        so a sample that always fails (e.g. a corrupt file) is not processed again until its inputs
+        change. Only scan changes the state of the samples, so fail can be called while a scan runs
+        in another thread
+        """
+        self.failures.put(((batch_id, sample), error))
+
+    def errors(self):
+        """Error of each sample whose inputs could not be processed, by (batch_id, sample)"""
+        return {key: s['error'] for key, s in self.samples.items() if s['error'] != None}
+
+class IngestDaemon:
+    """
+    Long-running service that processes the samples of a directory as soon as they are complete:
+    a SampleWatcher polls the directory every interval seconds and puts the ready samples in a
+    queue of at most queue_size samples, and the samples are taken from the queue by the worker
+    processes, which make their chem, action and link files (pipeline.process_sample). The cypher
+    file of each sample (<batch>_<sample>.cypher, with the deletion of its previous nodes when it
+    is processed again) is then written in cypher_folder, and the sample is loaded into the graph
+    if there is one. The watcher waits while the queue is full, so a burst of samples does not
+    pile up in memory.
+
+    :param directory: folder with one batch or one subfolder per batch (see etl.find_batches)
+    :param filepath: folder where the csv files are saved
+    :param cypher_folder: folder of the cypher files, None to write none
+    :param graph: optional bolt_loader.Neo4jGraph (or MemoryGraph) the samples are loaded into
+    :param interval: seconds between two scans of the directory
+    :param settle: seconds without changes before a sample is processed, see SampleWatcher
+    :param queue_size: number of ready samples waiting for a worker
+    :param workers: number of worker processes, with 1 the samples are processed in a thread
+    :param manifest_file: optional manifest csv (see manifest.py), samples whose inputs did not
+        change since it was saved are not processed again; it is saved after every sample
+    :param store: optional folder where the characterization outputs are saved as .npy files
+    :param shared_chemicals: the cypher files use the shared Chemical nodes (see query_feature.save_queries).
+        The graph loader writes one Chemical node per sample, so there can be no graph then
+    """
+    def __init__(self, directory, filepath = '', cypher_folder = 'cypher', graph = None, interval = 2.0,
+                 settle = 5.0, queue_size = 16, workers = 2, manifest_file = None, store = None,
+                 shared_chemicals = False):
+        if shared_chemicals and graph != None:
+            raise ValueError('the graph loader does not make shared Chemical nodes, use the cypher files')
+        self.watcher = SampleWatcher(directory, settle)
+        self.filepath = filepath
+        self.cypher_folder = cypher_folder
+        self.graph = graph
+        self.interval = interval
+        self.queue_size = queue_size
+        self.workers = workers
+        self.manifest_file = manifest_file
+        self.manifest = load_manifest(manifest_file) if manifest_file != None else {}
+        self.store = store
+        self.shared_chemicals = shared_chemicals
+        self.lock = Lock()
+        self.processed = 0
+        self.stopping = None
+
+    def publish(self, result, since):
+        """Writes the cypher file of a processed sample, loads it into the graph and updates the manifest"""
+        batch_id, sample = result['batch_id'], result['sample']
+        with stage('ingest', batch_id, sample) as record:
+            if result['changed']:
+                if self.cypher_folder != None:
+                    queries = [shared_key_constraint()] if self.shared_chemicals else []
+                    if result['replaced']:
+                        queries.append(delete_sample(batch_id, sample))
+                    queries += query_maker(result['chem'], result['action'], result['link'],
+                                           columns=result['columns'], shared_chemicals=self.shared_chemicals)
+                    makedirs(self.cypher_folder, exist_ok=True)
+                    f = open(join(self.cypher_folder, cypher_filename(batch_id, sample)), 'w')
+                    for query in queries:
+                        f.write(query)
+                    f.close()
+                if self.graph != None:
+                    if result['replaced']:
+                        self.graph.delete_sample(batch_id, sample)
+                    for frames in result_frames([result]):
+                        load_sample(self.graph, *frames)
+            with self.lock:
+                self.manifest[(batch_id, sample)] = result['hash']
+                if self.manifest_file != None:
+                    save_manifest(self.manifest, self.manifest_file)
+                self.processed += 1
+            # seconds from the last change of the sample's inputs to its files (and nodes) being ready
+            record['latency'] = time() - since
+        instrument.add_records(result['metrics'])
+
+    async def watch(self, queue):
+        while not self.stopping.is_set():
+            for item in await asyncio.to_thread(self.watcher.scan):
+                await queue.put(item)
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def work(self, queue, pool):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await queue.get()
+            batch_id = item['batch']['batch_id']
+            try:
+                task = sample_task(item['batch'], item['sample'], item['process_sample'], item['char_sample'],
+                                   self.filepath, self.manifest, self.store,
+                                   shared_chemicals=self.shared_chemicals, return_tables=self.graph != None)
+                result = await loop.run_in_executor(pool, process_sample, task)
+                await asyncio.to_thread(self.publish, result, item['since'])
+            except Exception as e:
+                print('could not ingest', batch_id, item['sample'], repr(e))
+                self.watcher.fail(batch_id, item['sample'], repr(e))
+            finally:
+                queue.task_done()
+
+    async def run(self, duration = None):
+        """
+        Runs the service until stop is called (or for duration seconds), then finishes the
+        samples already in the queue.
+        """
+        self.stopping = asyncio.Event()
+        queue = asyncio.Queue(self.queue_size)
+        # with one worker the default thread pool of the event loop is used
+        pool = ProcessPoolExecutor(max_workers = self.workers) if self.workers != 1 else None
+        if self.graph != None:
+            await asyncio.to_thread(self.graph.setup)
+        if duration != None:
+            asyncio.get_running_loop().call_later(duration, self.stop)
+        workers = [asyncio.create_task(self.work(queue, pool)) for i in range(self.workers)]
+        try:
+            await self.watch(queue)
+            await queue.join()
+        finally:
+            for w in workers:
+                w.cancel()
+            if pool != None:
+                pool.shutdown()
+
+    def stop(self):
+        """Stops the service started with run, from the event loop"""
+        self.stopping.set()
@@ -0,0 +1,103 @@
+from os.path import getsize
+from json import dumps
+from time import time, perf_counter, process_time
+from contextlib import contextmanager
+import tracemalloc
+
+# instrumentation of the current process: it is off until enable is called, and the records
+# of the stages are kept here until take_records
+state = {'enabled': False, 'memory': False}
+records = []
+# calls, rows and time of the func_map helpers since the last stage record
+helpers = {}
+
+def enable(enabled = True, memory = False):
+    """
+    Turns the recording of the stages on or off in this process.
+
+    :param memory: also record the peak memory of each stage, traced with tracemalloc
+        (which slows the pipeline down)
+    """
+    state['enabled'] = enabled
+    state['memory'] = enabled and memory
+    if state['memory'] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def config():
+    """Settings of this process, to enable the same instrumentation in a worker process"""
+    return dict(state)
+
+@contextmanager
+def stage(name, batch_id = None, sample = None):
+    """
+    Records the wall time, cpu time and peak memory of the code in the with block as one
+    stage of a sample. The block can set the 'rows' and 'bytes' of the record it gets:
+
+        with stage('chem', batch_id, sample) as record:
+            ...
+            record['rows'] = df.shape[0]
+
+    The calls of the func_map helpers made during the stage are added to its record.
+    A stage that raises is recorded too, with the exception in its 'error'.
+    Nothing is recorded when the instrumentation is off.
+    """
+    record = {'stage': name, 'batch_id': batch_id, 'sample': sample, 'rows': None, 'bytes': None}
+    if not state['enabled']:
+        yield record
+        return
+
+    if state['memory']:
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+    record['time'] = time()
+    start_wall = perf_counter()
+    start_cpu = process_time()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        record['wall'] = perf_counter() - start_wall
+        record['cpu'] = process_time() - start_cpu
+        record['peak_mb'] = None
+        if state['memory']:
+            record['peak_mb'] = (tracemalloc.get_traced_memory()[1] - start_memory) / 2 ** 20
+        # the helpers of a stage that raised are not counted in the next stage
+        if len(helpers) > 0:
+            record['helpers'] = dict(helpers)
+            helpers.clear()
+        records.append(record)
+
+def helper(name, func, *args):
+    """Calls func(*args), counting the call, the rows it returns and its time under name"""
+    if not state['enabled']:
+        return func(*args)
+    start = perf_counter()
+    res = func(*args)
+    counts = helpers.setdefault(name, {'calls': 0, 'rows': 0, 'wall': 0.0})
+    counts['calls'] += 1
+    counts['rows'] += len(res)
+    counts['wall'] += perf_counter() - start
+    return res
+
+def file_size(path):
+    """Bytes of a file that was written in a stage, only looked up when the instrumentation is on"""
+    return getsize(path) if state['enabled'] else None
+
+def take_records():
+    """Returns the stage records of this process and clears them"""
+    res = list(records)
+    records.clear()
+    return res
+
+def add_records(new_records):
+    """Adds the records taken in another process (e.g. a worker of pipeline.run_pipeline)"""
+    records.extend(new_records)
+
+def write_records(stage_records, metrics_file):
+    """Appends the records to a JSON lines file, one record per line"""
+    f = open(metrics_file, 'a')
+    for record in stage_records:
+        f.write(dumps(record) + '\n')
+    f.close()
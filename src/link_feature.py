@@ -7,151 +7,181 @@ from re import search, findall
 import numpy as np
 import pandas as pd
 
+from instrument import stage, file_size
+
 # PIPELINE
-def goes_into_links(dissolve_rows):
-    """
-    Helper method to create links for chemical nodes that "go into" a dissolve node.
-        AKA the "GOES_INTO" links
-    :param dissolve_rows: From an action table, takes in the rows of the table where dissolve
-        steps are involved. For this batch, this is at the beginning steps of the action table
-    """
-    # step_id, action(link), chemical_from, step_to, chemical_to, step_from, sample_id, batch_id
-    row_template = [0, 'GOES_INTO', 0, 0, np.nan, np.nan]
-    links = []
-    for i in range(dissolve_rows.shape[0]):
-        row = dissolve_rows.iloc[i]
-        link = row_template.copy()
-        link[0] = row['step_id']
-        link[2] = row['chemical_from']
-        link[3] = link[2]
-        links.append(link)
-    return links
-
-def output_links(dissolve_rows):
-    """
-    Helper method to create the OUTPUTS links from the initial solutes and solvents used
-    :param dissolve_rows: From an action table, takes in the rows of the table where dissolve
-        steps are involved. For this batch, this is at the beginning steps of the action table
-    """
-    row_template = [0, 'OUTPUTS', np.nan, np.nan, 0, 0]
-    links = []
-    mix_step = dissolve_rows.iloc[-1]['step_id']+1
-    prev_step = dissolve_rows.iloc[-1]['step_id']
-    for i in range(dissolve_rows.shape[0]):
-        row = dissolve_rows.iloc[i]
-        link = row_template.copy()
-        link[0] = prev_step+1
-        prev_step +=1
-        link[4] = mix_step
-        link[5] = row['step_id']
-        links.append(link)
-    return links
-
-def next_func(other_steps, step_num):
-    # step_id, action, chemical_from, step_to, chemical_to, step_from
-    row_template = [0, 'NEXT', np.nan, np.nan, np.nan, 0]
-    rows = []
-    step_id = step_num
-    for i in range(other_steps.shape[0]):
-        step_to = other_steps.iloc[i]['step_id']
-        row = row_template.copy()
-        row[0] = step_id
-        row[3] = step_to
-        row[-1] = row[3] - 2
-        rows.append(row)
-        step_id += 2
-    return rows
-
-def char_link_helper(output_rows, char_nodes, step_id):
-    # step_id, action, chemical_from, step_to, chemical_to, step_from
-    row_template = [0, 'NEXT', np.nan, np.nan, np.nan, 0]
-    rows=[]
-
-    for i in range(char_nodes.shape[0]):
-        curr_output = output_rows.iloc[i]
-        char = curr_output['char_name']
-        if '_' in char:
-            char = 'plimaging'
-        curr_node = char_nodes[char_nodes['char_name']==char]
-        step_to = curr_output['step_id']
-        row = row_template.copy()
-        row[0] = step_id
-        row[3] = step_to
-        row[-1] = curr_node['step_id'].iloc[0]
-        rows.append(row)
-        step_id += 1
-    return rows
+link_cols = ['step_id', 'action', 'chemical_from', 'step_to', 'chemical_to', 'step_from', 'sample_id', 'batch_id']
+link_id_cols = ['chemical_from', 'step_to', 'chemical_to', 'step_from']
 
-def link_table(action_table, sample_id, batch_id):
-    
-    link_cols = ['step_id',
-    'action',
-    'chemical_from',
-    'step_to',
-    'chemical_to',
-    'step_from',
-    'sample_id',
-    'batch_id']
-    
-    dissolve_rows = action_table[action_table['action'] == 'dissolve']
-    go_into = goes_into_links(dissolve_rows)
-    outputs = output_links(dissolve_rows)
-    
-    next_link_step = outputs[-1][0] + 3
-    
-    mix1_into_drop = [next_link_step, 'GOES_INTO', outputs[-1][4], outputs[-1][0]+1, np.nan, np.nan]
+# helper functions used in links, working on the columns of the action table of one or more
+# samples as arrays. groups holds the number of the sample of each row (0, 1, ...).
+def first_per_group(groups, values, n_groups):
+    """First value of each group, NaN for the groups without values"""
+    res = np.full(n_groups, np.nan)
+    keys, first = np.unique(groups, return_index=True)
+    res[keys] = values[first]
+    return res
+
+def last_per_group(groups, values, n_groups):
+    return first_per_group(groups[::-1], values[::-1], n_groups)
+
+def rank_in_group(groups):
+    """Position of each value in its group (0, 1, ...), in the order of the array"""
+    return pd.Series(groups).groupby(groups).cumcount().to_numpy()
+
+def link_block(groups, action, step_id, chemical_from = np.nan, step_to = np.nan, chemical_to = np.nan, 
+               step_from = np.nan):
+    """Links of one kind, as a dictionary of columns. The scalars are repeated for every link."""
+    n = len(groups)
+    block = {'group': groups, 'order': np.arange(n), 'action': np.full(n, action, dtype=object)}
+    for col, values in [('step_id', step_id), ('chemical_from', chemical_from), ('step_to', step_to), 
+                        ('chemical_to', chemical_to), ('step_from', step_from)]:
+        block[col] = np.broadcast_to(np.array(values, dtype=float), (n,))
+    return block
+
+def char_steps(groups, char_names, step_ids):
+    """step_id of the first char step with each char_name, by (group, char_name)"""
+    res = {}
+    for key in zip(groups, char_names, step_ids):
+        res.setdefault(key[:2], key[2])
+    return res
+
+def links(action_table, groups, n_groups):
+    """
+    Builds the links of the samples of an action table, as link_table, with the arithmetic done
+    on whole columns: the first and last steps of each sample are found once, and the link
+    step_ids are computed from them for every link at a time.
     
-    next_link_step += 1 
+    :param groups: array with the number of the sample of each row of the action table
+    :return: DataFrame with the link columns (without sample_id and batch_id) and the 'group' of
+        each link, with the links of each sample in the order of link_table
+    """
+    step = action_table['step_id'].to_numpy(dtype=float)
+    action = action_table['action'].to_numpy()
+    chemical_from = action_table['chemical_from'].to_numpy(dtype=float, na_value=np.nan)
+    if 'fid' in action_table.columns:
+        is_output = action_table['fid'].notna().to_numpy()
+    else:
+        is_output = np.zeros(len(step), dtype=bool)
+    all_groups = np.arange(n_groups)
+    blocks = []
     
-    first_drop_step_id = action_table[action_table['action']=='drop'].iloc[0]['step_id']
-    second_drop_step_id = first_drop_step_id + 1
-    mix2_chem_id = mix1_into_drop[2] + 2
+    # GOES_INTO links for the dissolve nodes, from the chemicals to the dissolve nodes
+    dissolve = action == 'dissolve'
+    d_groups = groups[dissolve]
+    d_steps = step[dissolve]
+    blocks.append(link_block(d_groups, 'GOES_INTO', d_steps, chemical_from[dissolve], chemical_from[dissolve]))
     
-    mix1_to_mix2 = [next_link_step, 'NEXT', np.nan, np.nan, mix2_chem_id, first_drop_step_id]
+    # OUTPUTS links from the dissolve nodes to the first mix
+    last_dissolve = last_per_group(d_groups, d_steps, n_groups)
+    mix1 = last_dissolve + 1
+    blocks.append(link_block(d_groups, 'OUTPUTS', last_dissolve[d_groups] + 1 + rank_in_group(d_groups),
+                             chemical_to=mix1[d_groups], step_from=d_steps))
+    last_output = last_dissolve + np.bincount(d_groups, minlength=n_groups)
     
-    mix_antisolvent = [action_table.iloc[-1]['step_id']+4, 'GOES_INTO', mix2_chem_id-1, second_drop_step_id, np.nan, np.nan]
+    # links between the mixes, the drops and the spin step
+    next_link_step = last_output + 3
+    blocks.append(link_block(all_groups, 'GOES_INTO', next_link_step, mix1, last_output + 1))
+    next_link_step = next_link_step + 1
+    drop = action == 'drop'
+    first_drop = first_per_group(groups[drop], step[drop], n_groups)
+    second_drop = first_drop + 1
+    mix2 = mix1 + 2
+    blocks.append(link_block(all_groups, 'NEXT', next_link_step, chemical_to=mix2, step_from=first_drop))
+    last_step = last_per_group(groups, step, n_groups)
+    blocks.append(link_block(all_groups, 'GOES_INTO', last_step + 4, mix2 - 1, second_drop))
+    next_link_step = next_link_step + 2
+    blocks.append(link_block(all_groups, 'NEXT', next_link_step, chemical_to=mix2, step_from=second_drop))
+    spin = action == 'spin'
+    spin_step = first_per_group(groups[spin], step[spin], n_groups)
+    blocks.append(link_block(all_groups, 'GOES_INTO', next_link_step, mix2, spin_step))
     
-    next_link_step += 2
-    drop_to_mix2 = [next_link_step, 'NEXT', np.nan, np.nan, mix2_chem_id, second_drop_step_id]
+    # NEXT links between the steps after the spin step (not the characterization outputs)
+    after_spin = (step > spin_step[groups]) & ~is_output
+    n_groups_next = groups[after_spin]
+    step_to = step[after_spin]
+    blocks.append(link_block(n_groups_next, 'NEXT', next_link_step[n_groups_next] + 2 + 2 * rank_in_group(n_groups_next),
+                             step_to=step_to, step_from=step_to - 2))
     
-    spin_step_id = action_table[action_table['action']=='spin'].iloc[0]['step_id']
-    mix2_to_spin = [next_link_step, 'GOES_INTO', mix2_chem_id, spin_step_id, np.nan, np.nan]
+    # NEXT links from the char steps to their outputs, e.g. plimaging -> plimaging_0
+    if is_output.any():
+        char = (action == 'char') & ~is_output
+        steps_of_char = char_steps(groups[char], action_table['char_name'].to_numpy()[char], step[char])
+        o_groups = groups[is_output]
+        o_names = ['plimaging' if '_' in name else name for name in action_table['char_name'].to_numpy()[is_output]]
+        o_from = [steps_of_char[(g, name)] for g, name in zip(o_groups, o_names)]
+        start = next_link_step + 2 * np.bincount(n_groups_next, minlength=n_groups) + 2
+        blocks.append(link_block(o_groups, 'NEXT', start[o_groups] + rank_in_group(o_groups), 
+                                 step_to=step[is_output], step_from=o_from))
     
-    if 'fid' in action_table.columns:
-        next_steps = action_table.loc[(action_table['step_id']>spin_step_id) & (pd.isna(action_table['fid']))]
-    else:
-        next_steps = action_table.loc[(action_table['step_id']>spin_step_id)]
-        
-    next_rows = next_func(next_steps, next_link_step+2)
-    
-    # for characterization outputs
-    if 'fid' in action_table.columns:
-        output_rows = action_table.loc[~pd.isna(action_table['fid'])]
-        char_rows = action_table.loc[(action_table['action'] == 'char') & (pd.isna(action_table['fid']))]
-        char_output_links = char_link_helper(output_rows, char_rows, next_rows[-1][0]+2)
-        
-        res = go_into + outputs + [mix1_into_drop] + [mix1_to_mix2] + [mix_antisolvent] + [drop_to_mix2] + [mix2_to_spin] + next_rows + char_output_links 
+    # the links of each sample, block by block
+    res = {}
+    for col in ['group', 'order', 'step_id', 'action'] + link_id_cols:
+        res[col] = np.concatenate([block[col] for block in blocks])
+    res['block'] = np.concatenate([np.full(len(block['group']), i) for i, block in enumerate(blocks)])
+    order = np.lexsort((res.pop('order'), res.pop('block'), res['group']))
+    res = pd.DataFrame(res).iloc[order].reset_index(drop=True)
+    res['step_id'] = res['step_id'].astype(np.int64)
+    return res
 
-    else:
-        res = go_into + outputs + [mix1_into_drop] + [mix1_to_mix2] + [mix_antisolvent] + [drop_to_mix2] + [mix2_to_spin] + next_rows
-    
-    for i in res:
-        i.append(sample_id)
-        i.append(batch_id)
-        
-    return pd.DataFrame(res, columns=link_cols)
+def link_table(action_table, sample_id, batch_id):
+    """
+    Creates the table with the links between the nodes of one sample from its action table:
+    GOES_INTO and OUTPUTS links of the dissolve steps, the links between the mixes, drops and
+    spin step, NEXT links between the following steps, and NEXT links from each char step to 
+    its outputs.
+    """
+    res = links(action_table, np.zeros(action_table.shape[0], dtype=np.int64), 1)
+    res['sample_id'] = sample_id
+    res['batch_id'] = batch_id
+    return res[link_cols]
 
-def save_link_csvs(action_dfs):
+def batch_link_table(action_table):
+    """
+    Builds the links of many samples in one call, from their action tables concatenated into one
+    (e.g. a combined batch action table). The samples are told apart by their batch_id and sample_id.
+    Returns the same table as concatenating the sample_link_table of every sample.
+    """
+    groups = action_table.groupby(['batch_id', 'sample_id'], sort=False, dropna=False).ngroup().to_numpy()
+    n_groups = groups.max() + 1 if len(groups) > 0 else 0
+    res = links(action_table, groups, n_groups)
+    first = np.unique(groups, return_index=True)[1]
+    res['sample_id'] = action_table['sample_id'].to_numpy()[first][res['group']]
+    res['batch_id'] = action_table['batch_id'].to_numpy()[first][res['group']]
+    return res[link_cols].astype({col: 'Int64' for col in link_id_cols})
+
+def sample_link_table(act, batch_id):
+    """Builds the link table of one sample from its action table"""
+    l_df = link_table(act, act.iloc[0]['sample_id'], batch_id)
+    return l_df.astype({col: 'Int64' for col in link_id_cols})
+
+def add_chemical_key_links(l_df, c_df):
+    """
+    Adds the chemical_key_from column to the link table of a sample, the chemical_key (see
+    chem_feature.add_chemical_keys) of the chemical_from of the links from a shared chemical
+    """
+    keys = {int(i): key for i, key in zip(c_df['chemical_id'], c_df['chemical_key']) if not pd.isna(key)}
+    l_df['chemical_key_from'] = l_df['chemical_from'].map(keys.get, na_action='ignore')
+    return l_df
+
+def link_filename(batch_id, sample):
+    """Name of the link csv file of a sample"""
+    return batch_id + '_' + sample + '_link.csv'
+
+def save_link_csvs(action_dfs, batch_id = 'b19', filepath = ''):
+    """
+    Saves the link csv of each action table. action_dfs can be a list or the generator from 
+    save_action_csvs, in which case this runs the whole chem -> action -> link pipeline one sample
+    at a time.
+    """
     # PIPELINE
     # run to save all as csvs
-    link_dfs = []
-    batch_id = 'b19'
-
     for act in action_dfs:
-        l_df = link_table(act, act.iloc[0]['sample_id'], batch_id)
-        l_df = l_df.astype({'chemical_from':'Int64', 'step_to':'Int64', 'chemical_to':'Int64', 'step_from':'Int64'})
-        link_dfs.append(l_df)
-        fname = batch_id + '_' + act.iloc[0]['sample_id'] + '_link.csv'
-        l_df.to_csv(fname, index=False)
+        sample = act.iloc[0]['sample_id']
+        with stage('link', batch_id, sample) as record:
+            l_df = sample_link_table(act, batch_id)
+            l_df.to_csv(join(filepath, link_filename(batch_id, sample)), index=False)
+            record['rows'] = l_df.shape[0]
+            record['bytes'] = file_size(join(filepath, link_filename(batch_id, sample)))
 
     return
\ No newline at end of file
@@ -0,0 +1,52 @@
+from os import listdir
+from os.path import isfile, isdir, join
+from json import dumps
+from hashlib import sha256
+
+import pandas as pd
+
+def sample_hash(process_sample, char_sample, folder, sample, options = None):
+    """
+    Content hash of everything a sample's csv files are made from: its process worklist entry,
+    its characterization worklist entry and every file under <folder>/<sample>/characterization0.
+
+    :param folder: the Characterization folder of the batch
+    :param options: optional dictionary of the options the files also depend on (e.g. their
+        format), so a run with other options makes the files again
+    :return: the sha256 hex digest
+    """
+    h = sha256()
+    # sort_keys so the hash does not depend on the key order in the json files
+    h.update(dumps(process_sample, sort_keys=True).encode())
+    h.update(dumps(char_sample, sort_keys=True).encode())
+    if options != None:
+        h.update(dumps(options, sort_keys=True, default=str).encode())
+
+    path = join(folder, sample, 'characterization0')
+    if isdir(path):
+        for fid in sorted(listdir(path)):
+            if not isfile(join(path, fid)):
+                continue
+            h.update(fid.encode())
+            f = open(join(path, fid), 'rb')
+            block = f.read(1 << 20)
+            while block:
+                h.update(block)
+                block = f.read(1 << 20)
+            f.close()
+    return h.hexdigest()
+
+def load_manifest(manifest_file):
+    """
+    Reads the manifest csv (batch_id, sample_id, hash) written by save_manifest.
+    Returns a dictionary of hash by (batch_id, sample_id), empty if the file does not exist yet.
+    """
+    if not isfile(manifest_file):
+        return {}
+    manifest = pd.read_csv(manifest_file, dtype=str)
+    return dict(zip(zip(manifest['batch_id'], manifest['sample_id']), manifest['hash']))
+
+def save_manifest(manifest, manifest_file):
+    """Saves the dictionary of hash by (batch_id, sample_id) as a csv, sorted by batch and sample"""
+    rows = [[batch_id, sample_id, manifest[(batch_id, sample_id)]] for batch_id, sample_id in sorted(manifest)]
+    pd.DataFrame(rows, columns=['batch_id', 'sample_id', 'hash']).to_csv(manifest_file, index=False)
@@ -0,0 +1,63 @@
+from os import makedirs
+from os.path import join
+from hashlib import sha256
+
+import numpy as np
+import pandas as pd
+
+def output_array(output):
+    """
+    Array of a characterization output from char_outputs. Images are kept as they are, and
+    csv outputs (a dictionary of columns) become a structured array with one float field per
+    column, named after the column.
+    """
+    if not isinstance(output, dict):
+        return np.asarray(output)
+    cols = list(output)
+    n = len(output[cols[0]]) if len(cols) > 0 else 0
+    arr = np.empty(n, dtype=[(str(c), 'f8') for c in cols])
+    for c in cols:
+        arr[str(c)] = pd.to_numeric(pd.Series(list(output[c].values())), errors='coerce').to_numpy()
+    return arr
+
+def output_filename(batch_id, fid):
+    """Name of the .npy file of an output, e.g. 'b19_sample0_pl.npy' for sample0_pl.csv"""
+    return (batch_id + '_' + fid.rsplit('.', 1)[0] + '.npy').replace(' ', '_')
+
+def store_outputs(output_df, store, batch_id):
+    """
+    Saves each output of char_outputs in its own .npy file in the store folder, and replaces
+    the 'output' column with the name of the file. The 'output_shape', 'output_dtype' and
+    'output_checksum' (sha256 of the array data) columns describe the array, so the action
+    table and the Neo4j nodes only carry the reference instead of the data.
+    """
+    makedirs(store, exist_ok=True)
+    refs, shapes, dtypes, checksums = [], [], [], []
+    for fid, output in zip(output_df['fid'], output_df['output']):
+        arr = np.ascontiguousarray(output_array(output))
+        fname = output_filename(batch_id, fid)
+        np.save(join(store, fname), arr)
+        refs.append(fname)
+        shapes.append(list(arr.shape))
+        dtypes.append(str(arr.dtype))
+        checksums.append(sha256(arr.tobytes()).hexdigest())
+
+    res = output_df.drop(columns='output')
+    res['output'] = refs
+    res['output_shape'] = shapes
+    res['output_dtype'] = dtypes
+    res['output_checksum'] = checksums
+    return res
+
+def load_output(ref, store = '', mmap = True, checksum = None):
+    """
+    Reads an output saved by store_outputs. With mmap the file is memory-mapped, so only
+    the parts of the array that are used are read.
+
+    :param ref: the 'output' value of the char_output row
+    :param checksum: optional 'output_checksum' of the row, checked against the data
+    """
+    arr = np.load(join(store, ref), mmap_mode='r' if mmap else None)
+    if checksum != None and sha256(np.ascontiguousarray(arr).tobytes()).hexdigest() != checksum:
+        raise ValueError('checksum of ' + ref + ' does not match')
+    return arr
@@ -0,0 +1,352 @@
+from os import cpu_count
+from os.path import join
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from etl import find_batches, stream_samples
+from chem_feature import chem_table, chem_filename, recipe_cache, add_chemical_keys
+from action_feature import sample_action_table, action_filename, take_unknown_steps, take_undeclared_columns, \
+    report_steps, DecodePool
+from link_feature import sample_link_table, link_filename, add_chemical_key_links
+from manifest import sample_hash, load_manifest, save_manifest
+from batch_output import BatchWriter, batch_filename
+from char_metrics import batch_metrics
+from similarity import sample_features
+from columnar import save_table, parquet_filename
+import instrument
+from instrument import stage, file_size
+
+# DecodePool of this process by number of threads, made by the first task that uses it and 
+# kept for the next samples
+decode_pools = {}
+
+def decode_pool(threads):
+    """DecodePool of this process with the given number of threads, None without threads"""
+    if threads == None or threads <= 1:
+        return None
+    if threads not in decode_pools:
+        decode_pools[threads] = DecodePool(threads)
+    return decode_pools[threads]
+
+# options of a task that change the files of its sample, hashed with the inputs of the sample.
+# The metrics are the fitted metrics of the sample, which depend on the other samples of its batch
+output_options = ['batch_output', 'table_format', 'shared_chemicals', 'store', 'spin_store', 'spin_interval',
+                  'image_preview', 'metrics']
+
+def sample_tasks(batches, samples = None, filepath = '', manifest = None, store = None, batch_output = False,
+                 table_format = 'csv', shared_chemicals = False, decode_threads = None, fit_metrics = False,
+                 features = False, spin_store = None, spin_interval = None, image_preview = None,
+                 recipe_cache_file = None, return_tables = False):
+    """
+    Generator of the per-sample work of one or more batches, in batch order and then in the
+    order the samples appear in the process worklist. The worklists are streamed, so only
+    the samples waiting to be processed are in memory.
+
+    :param batches: list of batches as returned by etl.find_batches
+    :param samples: optional list of sample names, only these samples are processed
+    :param filepath: folder where the csv files are saved
+    :param manifest: optional dictionary of hash by (batch_id, sample_id) from the previous run,
+        samples whose inputs still have the same hash are not processed again
+    :param store: optional folder where the characterization outputs are saved as .npy files
+    :param batch_output: the tables are returned to be written to the batch files instead of
+        being saved as csv files
+    :param table_format: 'csv' or 'parquet', format of the saved tables
+    :param shared_chemicals: add the chemical keys of the shared Chemical nodes to the chem and link tables
+    :param decode_threads: number of threads reading the characterization files of a sample
+    :param fit_metrics: the characterization metrics of every sample of a batch are computed
+        (see char_metrics.batch_metrics) before its samples, each task gets the metrics of its sample
+    :param features: the feature vector of each sample is returned with its result
+    :param spin_store: optional folder where the spin logs are saved as .npz files
+    :param spin_interval: optional number of seconds the spin logs are downsampled to
+    :param image_preview: optional step, only every image_preview-th row and column of the images is read
+    :param recipe_cache_file: optional json file of chem_feature.RecipeCache, loaded by each process
+        before its first sample
+    :param return_tables: the tables are also returned with the result of each sample, for the
+        Bolt loader
+    """
+    for batch in batches:
+        metrics = {}
+        if fit_metrics:
+            with stage('metrics', batch['batch_id']) as record:
+                metrics = batch_metrics(batch['char_folder']).to_dict('index')
+                record['rows'] = len(metrics)
+        for sample, process_sample, char_sample in stream_samples(batch['process_file'], batch['char_file']):
+            if samples != None and sample not in samples:
+                continue
+            yield sample_task(batch, sample, process_sample, char_sample, filepath, manifest, store, batch_output,
+                              table_format, shared_chemicals, decode_threads, metrics.get(sample), features,
+                              spin_store, spin_interval, image_preview, recipe_cache_file, return_tables)
+
+def sample_task(batch, sample, process_sample, char_sample, filepath = '', manifest = None, store = None,
+                batch_output = False, table_format = 'csv', shared_chemicals = False, decode_threads = None,
+                metrics = None, features = False, spin_store = None, spin_interval = None, image_preview = None,
+                recipe_cache_file = None, return_tables = False):
+    """
+    Task of one sample for process_sample, see sample_tasks for the parameters.
+    metrics is the row of the sample in char_metrics.batch_metrics, if any.
+    """
+    task = {'batch_id': batch['batch_id'], 'sample': sample, 'process_sample': process_sample,
+            'char_sample': char_sample, 'char_folder': batch['char_folder'], 'filepath': filepath,
+            'check_hash': manifest != None, 'previous_hash': None, 'store': store,
+            'batch_output': batch_output, 'table_format': table_format, 
+            'shared_chemicals': shared_chemicals, 'decode_threads': decode_threads, 
+            'metrics': metrics, 'features': features, 'spin_store': spin_store,
+            'spin_interval': spin_interval, 'image_preview': image_preview, 'recipe_cache_file': recipe_cache_file,
+            'return_tables': return_tables, 'instrument': instrument.config()}
+    if manifest != None:
+        task['previous_hash'] = manifest.get((batch['batch_id'], sample))
+    return task
+
+def chunks(tasks, chunksize):
+    """Groups the tasks into lists of chunksize tasks"""
+    chunk = []
+    for task in tasks:
+        chunk.append(task)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def process_chunk(tasks):
+    return [process_sample(task) for task in tasks]
+
+def process_sample(task):
+    """
+    Creates and saves the chem, action and link csv files of one sample (a task from sample_tasks).
+    Every sample is independent, so this runs in the worker processes of run_pipeline.
+    When the task checks the hash and neither the sample's inputs nor the options of the task
+    that change its files (output_options) have changed since the previous run, nothing is saved.
+    With the batch_output of the task, the tables are not saved but returned ('tables'), for
+    run_pipeline to write them to the batch files. With the return_tables of the task, they are
+    saved and returned, for bolt_loader.load_samples. With the 'parquet' table_format of the task,
+    they are saved as parquet files (see columnar.save_table).
+
+    :return: dictionary with the batch_id, sample, the names of the csv files, the hash of the
+        inputs, whether the files were saved ('changed'), whether they replace the files of a
+        previous run ('replaced'), the columns of the saved files ('columns', for the queries
+        of query_feature.save_queries), the counts of the worklist steps of an unknown type that
+        were skipped ('unknown_steps', see action_feature.register_step), the counts of the rows with
+        columns their step handler did not declare ('undeclared_columns') and the records of the 
+        stages ('metrics', see instrument.stage). With the features of the task, the feature vector 
+        of the sample is added ('features', see similarity.sample_features). With the recipe_cache_file
+        of the task, the recipe strings parsed for the sample are added ('recipes', see
+        chem_feature.RecipeCache.take_new)
+    """
+    instrument.enable(**task['instrument'])
+    batch_id = task['batch_id']
+    sample = task['sample']
+    filepath = task['filepath']
+    result = {'batch_id': batch_id, 'sample': sample, 
+              'chem': chem_filename(batch_id, sample), 
+              'action': action_filename(batch_id, sample), 
+              'link': link_filename(batch_id, sample),
+              'hash': None, 'changed': True, 'replaced': False, 'columns': {}, 'metrics': []}
+    if task['batch_output']:
+        for table in ['chem', 'action', 'link']:
+            result[table] = batch_filename(batch_id, table)
+    elif task['table_format'] == 'parquet':
+        for table in ['chem', 'action', 'link']:
+            result[table] = parquet_filename(result[table])
+    if task['batch_output'] or task['return_tables']:
+        result['tables'] = {}
+    
+    def save(df, table, record):
+        record['rows'] = df.shape[0]
+        if task['batch_output'] or task['return_tables']:
+            result['tables'][table] = df
+        if task['batch_output']:
+            return
+        result['columns'][table] = [str(col) for col in df.columns]
+        if task['table_format'] == 'parquet':
+            save_table(df, join(filepath, result[table]), table)
+            record['bytes'] = file_size(join(filepath, result[table]))
+        else:
+            df.to_csv(join(filepath, result[table]), index=False)
+            record['bytes'] = file_size(join(filepath, result[table]))
+
+    if task['check_hash']:
+        result['hash'] = sample_hash(task['process_sample'], task['char_sample'], task['char_folder'], sample,
+                                     {name: task[name] for name in output_options})
+        if result['hash'] == task['previous_hash']:
+            result['changed'] = False
+            return result
+        result['replaced'] = task['previous_hash'] != None
+
+    if task['recipe_cache_file'] != None and task['recipe_cache_file'] not in recipe_cache.loaded:
+        recipe_cache.load(task['recipe_cache_file'])
+    with stage('chem', batch_id, sample) as record:
+        c_df = chem_table(task['process_sample'], batch_id)
+        if task['shared_chemicals']:
+            c_df = add_chemical_keys(c_df)
+        save(c_df, 'chem', record)
+        record['recipes'] = recipe_cache.stats()
+
+    with stage('action', batch_id, sample) as record:
+        a_df = sample_action_table(task['process_sample'], task['char_sample'], sample, batch_id, 
+                                   task['char_folder'], task['store'], decode_pool(task['decode_threads']),
+                                   task['metrics'], task['spin_store'], task['spin_interval'],
+                                   task['image_preview'])
+        save(a_df, 'action', record)
+        record['unknown_steps'] = result['unknown_steps'] = take_unknown_steps()
+        record['undeclared_columns'] = result['undeclared_columns'] = take_undeclared_columns()
+
+    with stage('link', batch_id, sample) as record:
+        l_df = sample_link_table(a_df, batch_id)
+        if task['shared_chemicals']:
+            l_df = add_chemical_key_links(l_df, c_df)
+        save(l_df, 'link', record)
+
+    if task['features']:
+        result['features'] = sample_features(c_df, a_df)
+    if task['recipe_cache_file'] != None:
+        result['recipes'] = recipe_cache.take_new()
+    result['metrics'] = instrument.take_records()
+    return result
+
+def run_pipeline(directory = 'test/testdata', workers = None, chunksize = 1, samples = None, filepath = '',
+                 manifest_file = None, store = None, batch_output = False, table_format = 'csv',
+                 shared_chemicals = False, decode_threads = None, fit_metrics = False, features = False,
+                 spin_store = None, spin_interval = None, image_preview = None, recipe_cache_file = None,
+                 return_tables = False):
+    """
+    Runs the chem/action/link stage on every sample of every batch found in directory,
+    fanning the samples out over a pool of worker processes.
+    At most two chunks per worker are read ahead of the workers, so memory stays bounded
+    by the samples in flight rather than the size of the batches.
+
+    :param directory: folder with one batch, or with one subfolder per batch (see etl.find_batches)
+    :param workers: number of worker processes, defaults to the number of cpus.
+        With 1 worker the samples are processed in this process
+    :param chunksize: number of samples sent to a worker at a time
+    :param samples: optional list of sample names to process
+    :param filepath: folder where the csv files are saved
+    :param manifest_file: optional manifest csv (see manifest.py) with the hash of every sample's
+        inputs. Only the samples that are new or whose inputs changed since the manifest was saved
+        are processed, and the manifest is updated at the end of the run
+    :param store: optional folder where the characterization outputs are saved as .npy files
+        instead of being written into the action csv files
+    :param batch_output: write one chem, one action and one link csv per batch, with the index of
+        the samples' rows in output_index.csv (see batch_output.BatchWriter), instead of three
+        csv files per sample
+    :param table_format: 'csv', or 'parquet' to save the tables of each sample as parquet files
+        with typed columns (see columnar.py, needs pyarrow). The parquet files are read by
+        the Bolt loader and the neo4j-admin import files, LOAD CSV needs the csv files
+    :param shared_chemicals: add the chemical_key column to the chem tables and chemical_key_from
+        to the link tables, for the queries of the shared Chemical nodes (see query_feature.save_queries)
+    :param decode_threads: number of threads of each worker reading the characterization files of a
+        sample at the same time (see action_feature.DecodePool), by default they are read one by one
+    :param fit_metrics: add a fitted_metrics row with the PL peak, FWHM and intensity, the highest
+        absorbance and the bandgap of the sample at the end of each action table (see char_metrics.py)
+    :param features: return the process-parameter feature vector of each sample, for the similarity
+        search of similarity.SimilarityIndex
+    :param spin_store: optional folder where the spincoater logs and liquid handler timings of the
+        spin steps are saved as compressed .npz files instead of being copied into every spin row
+        (see spin_logs.py), read back with spin_logs.SpinLogStore
+    :param spin_interval: optional number of seconds, the spin logs of the spin_store are
+        downsampled to one point per interval
+    :param image_preview: optional step, the characterization images are read at every
+        image_preview-th row and column only (see action_feature.load_image)
+    :param recipe_cache_file: optional json file of the parsed recipe strings (see 
+        chem_feature.RecipeCache), loaded before the samples and saved with the strings 
+        parsed by every worker at the end of the run
+    :param return_tables: keep the chem, action and link DataFrames of the changed samples in their
+        results ('tables'), to load them into Neo4j with bolt_loader.load_samples without reading
+        the files back. The tables of every sample are then kept in memory until they are loaded
+
+    When the instrumentation is on (instrument.enable), the workers record the stages of every
+    sample, and the records are added to the records of this process (instrument.take_records).
+
+    :return: list with one dictionary per sample (see process_sample), in the same order
+        whatever the number of workers
+    """
+    if batch_output and table_format != 'csv':
+        raise ValueError('the batch files are csv files, batch_output needs the csv table_format')
+    manifest = None
+    if manifest_file != None:
+        manifest = load_manifest(manifest_file)
+    if recipe_cache_file != None:
+        recipe_cache.load(recipe_cache_file)
+
+    writer = BatchWriter(filepath) if batch_output else None
+    results = []
+    
+    def collect(chunk_results):
+        # the batch files are written in this process, in the order of the samples
+        for r in chunk_results:
+            if writer != None and r['changed']:
+                writer.write(r['batch_id'], r['sample'], r['tables'] if return_tables else r.pop('tables'))
+            results.append(r)
+
+    tasks = sample_tasks(find_batches(directory), samples, filepath, manifest, store, batch_output, table_format,
+                         shared_chemicals, decode_threads, fit_metrics, features, spin_store, spin_interval,
+                         image_preview, recipe_cache_file, return_tables)
+    if workers == 1:
+        for task in tasks:
+            collect([process_sample(task)])
+    else:
+        if workers == None:
+            workers = cpu_count()
+
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            # futures are collected in submission order, which keeps the results deterministic
+            pending = deque()
+            for chunk in chunks(tasks, chunksize):
+                pending.append(pool.submit(process_chunk, chunk))
+                if len(pending) >= 2 * workers:
+                    collect(pending.popleft().result())
+            while len(pending) > 0:
+                collect(pending.popleft().result())
+
+    if writer != None:
+        writer.close()
+
+    # the stage records of the samples (made in the worker processes) are gathered in this process
+    for r in results:
+        instrument.add_records(r['metrics'])
+    report_steps([r.get('unknown_steps', {}) for r in results], [r.get('undeclared_columns', {}) for r in results])
+
+    if recipe_cache_file != None:
+        for r in results:
+            recipe_cache.add(r.get('recipes', {}))
+        recipe_cache.save(recipe_cache_file)
+
+    if manifest_file != None:
+        # samples that were not part of this run keep their previous hash
+        for r in results:
+            manifest[(r['batch_id'], r['sample'])] = r['hash']
+        save_manifest(manifest, manifest_file)
+    return results
+
+def combine_batch_csvs(file_dict, filepath = ''):
+    """
+    Combines the per-sample csv files into one chem, one action and one link csv per batch
+    (<batch_id>_chem.csv, ...), for save_batch_queries. The values are copied as text, 
+    and the action files' columns are the union of the samples' columns.
+
+    :param file_dict: dictionary with the chem, action and link csv file of each sample,
+        as used by save_queries
+    :param filepath: folder of the csv files
+    :return: dictionary with the chem, action and link csv file of each batch
+    """
+    tables = {}
+    for sample in file_dict:
+        dfs = {}
+        for table in ['chem', 'action', 'link']:
+            dfs[table] = pd.read_csv(join(filepath, file_dict[sample][table]), dtype=str, keep_default_na=False)
+        batch_id = dfs['action']['batch_id'].iloc[0]
+        if batch_id not in tables:
+            tables[batch_id] = {'chem': [], 'action': [], 'link': []}
+        for table in dfs:
+            tables[batch_id][table].append(dfs[table])
+
+    batch_dict = {}
+    for batch_id in tables:
+        batch_dict[batch_id] = {}
+        for table in ['chem', 'action', 'link']:
+            fname = batch_filename(batch_id, table)
+            pd.concat(tables[batch_id][table]).fillna('').to_csv(join(filepath, fname), index=False)
+            batch_dict[batch_id][table] = fname
+    return batch_dict
@@ -1,23 +1,44 @@
 from os import listdir, remove
 from os.path import isfile, join
 from json import load, loads
+from io import StringIO
 from tifffile import imread,imwrite
 from re import search, findall
 
 import numpy as np
 import pandas as pd
 
+from instrument import stage, file_size
+from batch_output import index_file_dict
+from columnar import table_columns
+
+# columns of every header line parsed by find_columns. The samples of a batch mostly have the
+# same chem and action columns, so a header is only parsed once per batch
+column_cache = {}
+
+def read_header(csv_file):
+    """First line of a csv file, without reading the rest of the file"""
+    f = open(csv_file, newline='')
+    header = f.readline()
+    f.close()
+    return header
+
 def find_columns(csv_file):
     """
-    Helper method to find all the columns
+    Helper method to find all the columns. Only the header line of the file is read
+    (the rows of the action files hold the characterization outputs), or the schema of a parquet file.
     
     :param csv_file: Takes in the csv file string, e.g:
         'WBG Repeat, Batch 4 (Experiment 1)_sample12_action.csv'
         
     :return: Returns a list all the columns
     """
-    df = pd.read_csv(csv_file)
-    return df.columns.to_list()
+    if csv_file.endswith('.parquet'):
+        return table_columns(csv_file)
+    header = read_header(csv_file)
+    if header not in column_cache:
+        column_cache[header] = pd.read_csv(StringIO(header)).columns.to_list()
+    return list(column_cache[header])
 
 def find_local_csv_files():
     """Find all the csv files ending with the name sample_chem.csv, sample_link.csv, 
@@ -45,18 +66,21 @@ def find_local_csv_files():
         
     return file_dict, file_list
 
-def create_nodes(filepath, node_type, cols, stored_folder = ''):
+def create_nodes(filepath, node_type, cols, stored_folder = '', where = None):
     query = "LOAD CSV WITH HEADERS FROM \"file:///"
     query += stored_folder
     
     if stored_folder != '':
         query += '/'
         
-    query += "{}\" ".format(filepath)
+    query += "{}\" AS row ".format(filepath)
+    # only the rows matching the where condition become nodes
+    if where != None:
+        query += "WITH row WHERE {} ".format(where)
     if node_type == 'chem':
-        query += "AS row CREATE (c:Chemical {"
+        query += "CREATE (c:Chemical {"
     elif node_type == 'action':
-        query += "AS row CREATE (a:Action {"
+        query += "CREATE (a:Action {"
     
     # add the columns into the query
     query_columns = (["{}: row['{}'], ".format(cols[i], cols[i]) if i < len(cols) - 1 
@@ -66,7 +90,29 @@ def create_nodes(filepath, node_type, cols, stored_folder = ''):
     # close the brackets and return
     return query + "});"
 
-def create_links(filepath, stored_folder = ''):
+# rows of a chem csv with the chemical_key column (see chem_feature.add_chemical_keys): the shared
+# chemicals have a key, the Mix solutions of the sample do not
+shared_chem_row = "row['chemical_key'] IS NOT NULL"
+sample_chem_row = "row['chemical_key'] IS NULL"
+
+def shared_chemical_body():
+    """Merges the shared Chemical node of a row on its chemical_key"""
+    props = ', '.join(["c.{} = row['{}']".format(c, c) for c in ['content', 'concentration', 'chem_type']])
+    return "WITH row WHERE {} MERGE (c:Chemical {{chemical_key: row['chemical_key']}}) ON CREATE SET {}".format(
+        shared_chem_row, props)
+
+def create_shared_nodes(filepath, cols, stored_folder = ''):
+    """
+    Same as create_nodes for a chem csv, with the solutes, solvents and antisolvents merged into
+    Chemical nodes shared by every sample, keyed by their chemical_key (e.g. 'DMF0.75'). 
+    Only the Mix solutions are created as nodes of the sample.
+    """
+    query = "LOAD CSV WITH HEADERS FROM {} AS row {};".format(csv_location(filepath, stored_folder), 
+                                                             shared_chemical_body())
+    sample_cols = [c for c in cols if c != 'chemical_key']
+    return [query, create_nodes(filepath, 'chem', sample_cols, stored_folder, where = sample_chem_row)]
+
+def create_links(filepath, stored_folder = '', shared_chemicals = False):
     query_start = "LOAD CSV WITH HEADERS FROM \"file:///"
     query_start += stored_folder
     
@@ -91,44 +137,245 @@ batch_id: row['batch_id']}) CREATE (a3)-[:NEXT]->(c4);"
 batch_id: row['batch_id']}),(a4:Action {step_id:row['step_to'], sample_id: row['sample_id'], \
 batch_id: row['batch_id']}) CREATE (a3)-[:NEXT]->(a4);"
     
+    link_queries = [query_1, query_2, query_3, query_4]
+    if shared_chemicals:
+        # the links from a shared chemical match it on the chemical_key_from of the link
+        query_0 = "AS row WITH row WHERE row['chemical_key_from'] IS NOT NULL MATCH (c:Chemical \
+{chemical_key: row['chemical_key_from']}), (a:Action {step_id:row['step_to'], sample_id: row['sample_id'], \
+batch_id: row['batch_id']}) CREATE (c)-[:GOES_INTO]->(a);"
+        query_1 = query_1.replace("AS row MATCH", "AS row WITH row WHERE row['chemical_key_from'] IS NULL MATCH")
+        link_queries = [query_0, query_1, query_2, query_3, query_4]
 
     queries = []
-    for i in [query_1, query_2, query_3, query_4]:
+    for i in link_queries:
         query_str = query_start + i
         queries.append(query_str)
     
     return queries
 
-def query_maker(chem_filepath, action_filepath, link_fileid, stored_folder = ''):
+def delete_sample(batch_id, sample_id):
+    """
+    Query that deletes every node (and its links) of a sample, so that a sample whose
+    inputs changed can be loaded again without duplicating its nodes
+    """
+    batch_id = str(batch_id).replace("\\", "\\\\").replace("'", "\\'")
+    sample_id = str(sample_id).replace("\\", "\\\\").replace("'", "\\'")
+    return "MATCH (n {{sample_id: '{}', batch_id: '{}'}}) DETACH DELETE n;".format(sample_id, batch_id)
+
+def query_maker(chem_filepath, action_filepath, link_fileid, stored_folder = '', columns = None,
+                shared_chemicals = False):
+    """
+    Calls the other query functions in this one function, given the necessary file ids
+    
+    :param columns: optional dictionary with the chem and action columns, e.g. the 'columns' of the
+        results of pipeline.run_pipeline, so the files are not read. By default they are found
+        with find_columns
+    :param shared_chemicals: the chemicals are shared nodes (see create_shared_nodes), the chem
+        and link csv files need the chemical_key and chemical_key_from columns
     """
-    Calls the other query functions in this one function, given the necessary file ids"""
     queries = []
+    if columns == None:
+        columns = {}
     
-    chem_cols = find_columns(chem_filepath)
-    queries.append(create_nodes(chem_filepath, 'chem', chem_cols, stored_folder))
+    chem_cols = columns.get('chem') or find_columns(chem_filepath)
+    if shared_chemicals:
+        queries += create_shared_nodes(chem_filepath, chem_cols, stored_folder)
+    else:
+        queries.append(create_nodes(chem_filepath, 'chem', chem_cols, stored_folder))
     
-    action_cols = find_columns(action_filepath)
+    action_cols = columns.get('action') or find_columns(action_filepath)
     queries.append(create_nodes(action_filepath, 'action', action_cols, stored_folder))
     
-    queries = queries + create_links(link_fileid, stored_folder)
+    queries = queries + create_links(link_fileid, stored_folder, shared_chemicals)
     return queries
 
-def save_queries():
-    file_dict, file_list = find_local_csv_files()
-    queries = []
+def save_queries(file_dict = None, replaced = (), index = None, shared_chemicals = False):
+    """
+    Creates the output.cypher file with the queries of every sample.
+    
+    :param file_dict: optional dictionary with the chem, action and link csv file of each sample,
+        e.g. from the results of pipeline.run_pipeline (their 'columns' are used instead of reading
+        the headers of the files). By default the csv files are found in the current directory 
+        with find_local_csv_files
+    :param replaced: optional list of (batch_id, sample_id) of samples that are already in the database
+        and are loaded again, their nodes are deleted before the new ones are created
+    :param index: optional output_index.csv of the batch files (or the index DataFrame), see
+        batch_output.BatchWriter. The queries then load the batch files listed in the index,
+        six queries per batch, without looking for csv files in the directory
+    :param shared_chemicals: the solutes, solvents and antisolvents are Chemical nodes shared by 
+        every sample (see create_shared_nodes), created with a uniqueness constraint on their key
+    """
+    if index is not None:
+        file_dict = index_file_dict(index)
+    if file_dict == None:
+        file_dict, file_list = find_local_csv_files()
+    queries = [[delete_sample(batch_id, sample_id) for batch_id, sample_id in replaced]]
+    if shared_chemicals:
+        queries.insert(0, [shared_key_constraint()])
     neo4j_stored_folder = ''
 
-    for sample in file_dict:
-        # the input file_id is in the order of chem.csv, action.csv, link.csv
-        queries.append(query_maker(file_dict[sample]['chem'], 
-                                    file_dict[sample]['action'], 
-                                    file_dict[sample]['link'], 
-                                    stored_folder = neo4j_stored_folder))
-    
-    # saving the file as .cypher file
-    output = open('output.cypher', 'w')
-    for q in queries:
-        for query in q:
-            output.write(query)
-    output.close()
-    return
\ No newline at end of file
+    with stage('queries') as record:
+        for sample in file_dict:
+            # the input file_id is in the order of chem.csv, action.csv, link.csv
+            queries.append(query_maker(file_dict[sample]['chem'], 
+                                        file_dict[sample]['action'], 
+                                        file_dict[sample]['link'], 
+                                        stored_folder = neo4j_stored_folder,
+                                        columns = file_dict[sample].get('columns'),
+                                        shared_chemicals = shared_chemicals))
+        
+        # saving the file as .cypher file
+        output = open('output.cypher', 'w')
+        for q in queries:
+            for query in q:
+                output.write(query)
+        output.close()
+        record['rows'] = sum(len(q) for q in queries)
+        record['bytes'] = file_size('output.cypher')
+    return
+
+# keys that identify a node, used by the constraints and by MERGE
+node_keys = {
+    'chem': ('Chemical', 'c', ['chemical_id', 'sample_id', 'batch_id']),
+    'action': ('Action', 'a', ['step_id', 'sample_id', 'batch_id'])
+}
+
+def create_constraints(legacy = False):
+    """
+    Queries creating a uniqueness constraint on the key of the Chemical and Action nodes.
+    The constraints come with an index, so MERGE and the MATCH of the links look up nodes
+    directly instead of scanning every node with the label.
+    
+    :param legacy: Neo4j 4.x only has composite uniqueness constraints in the enterprise 
+        edition, so a composite index is created instead
+    """
+    queries = []
+    for node_type in ['chem', 'action']:
+        label, var, keys = node_keys[node_type]
+        key_str = ', '.join(['{}.{}'.format(var, k) for k in keys])
+        if legacy:
+            queries.append("CREATE INDEX {}_key IF NOT EXISTS FOR ({}:{}) ON ({});".format(
+                label.lower(), var, label, key_str))
+        else:
+            queries.append("CREATE CONSTRAINT {}_key IF NOT EXISTS FOR ({}:{}) REQUIRE ({}) IS UNIQUE;".format(
+                label.lower(), var, label, key_str))
+    return queries
+
+def shared_key_constraint(legacy = False):
+    """Query creating a uniqueness constraint (an index if legacy) on the key of the shared Chemical nodes"""
+    if legacy:
+        return "CREATE INDEX chemical_shared_key IF NOT EXISTS FOR (c:Chemical) ON (c.chemical_key);"
+    return "CREATE CONSTRAINT chemical_shared_key IF NOT EXISTS FOR (c:Chemical) REQUIRE c.chemical_key IS UNIQUE;"
+
+def csv_location(filepath, stored_folder = ''):
+    """Location of a csv file in the LOAD CSV queries"""
+    location = "\"file:///"
+    location += stored_folder
+    if stored_folder != '':
+        location += '/'
+    return location + "{}\"".format(filepath)
+
+def load_csv_batched(filepath, body, stored_folder = '', batch_size = 1000, legacy = False):
+    """
+    Wraps a query body that uses `row` so that the csv is loaded in transactions of batch_size 
+    rows, with CALL { ... } IN TRANSACTIONS (Neo4j 4.4+) or USING PERIODIC COMMIT if legacy
+    """
+    location = csv_location(filepath, stored_folder)
+    
+    if legacy:
+        return "USING PERIODIC COMMIT {} LOAD CSV WITH HEADERS FROM {} AS row {};".format(
+            batch_size, location, body)
+    return "LOAD CSV WITH HEADERS FROM {} AS row CALL {{ WITH row {} }} IN TRANSACTIONS OF {} ROWS;".format(
+        location, body, batch_size)
+
+def merge_nodes(filepath, node_type, cols, stored_folder = '', batch_size = 1000, legacy = False, where = None):
+    """
+    Same as create_nodes, but the nodes are merged on their key and their other properties are set,
+    so loading the same csv again does not duplicate the nodes
+    """
+    label, var, keys = node_keys[node_type]
+    body = ""
+    if where != None:
+        body += "WITH row WHERE {} ".format(where)
+    body += "MERGE ({}:{} {{".format(var, label)
+    body += ', '.join(["{}: row['{}']".format(k, k) for k in keys])
+    body += "})"
+    
+    props = [c for c in cols if c not in keys]
+    if len(props) > 0:
+        body += " SET " + ', '.join(["{}.{} = row['{}']".format(var, c, c) for c in props])
+    return load_csv_batched(filepath, body, stored_folder, batch_size, legacy)
+
+def merge_shared_nodes(filepath, cols, stored_folder = '', batch_size = 1000, legacy = False):
+    """Same as create_shared_nodes, with the Mix nodes merged as in merge_nodes"""
+    sample_cols = [c for c in cols if c != 'chemical_key']
+    return [load_csv_batched(filepath, shared_chemical_body(), stored_folder, batch_size, legacy),
+            merge_nodes(filepath, 'chem', sample_cols, stored_folder, batch_size, legacy, where = sample_chem_row)]
+
+def merge_links(filepath, stored_folder = '', batch_size = 1000, legacy = False, shared_chemicals = False):
+    """
+    Same as create_links, but the links are merged so loading the same csv again 
+    does not duplicate them
+    """
+    body_1 = "MATCH (c:Chemical {chemical_id: row['chemical_from'], sample_id: row['sample_id'], \
+batch_id: row['batch_id']}), (a:Action {step_id: row['step_to'], sample_id: row['sample_id'], \
+batch_id: row['batch_id']}) MERGE (c)-[:GOES_INTO]->(a)"
+    
+    body_2 = "MATCH (a1:Action {step_id: row['step_from'], sample_id: row['sample_id'], \
+batch_id: row['batch_id']}), (c1:Chemical {chemical_id: row['chemical_to'], sample_id: row['sample_id'], \
+batch_id: row['batch_id']}) WHERE a1.action = 'dissolve' MERGE (a1)-[:OUTPUTS]->(c1)"
+    
+    body_3 = "MATCH (a3:Action {step_id: row['step_from'], sample_id: row['sample_id'], \
+batch_id: row['batch_id']}), (c4:Chemical {chemical_id: row['chemical_to'], sample_id: row['sample_id'], \
+batch_id: row['batch_id']}) WHERE a3.action = 'drop' MERGE (a3)-[:NEXT]->(c4)"
+    
+    body_4 = "MATCH (a3:Action {step_id: row['step_from'], sample_id: row['sample_id'], \
+batch_id: row['batch_id']}), (a4:Action {step_id: row['step_to'], sample_id: row['sample_id'], \
+batch_id: row['batch_id']}) MERGE (a3)-[:NEXT]->(a4)"
+    
+    bodies = [body_1, body_2, body_3, body_4]
+    if shared_chemicals:
+        body_0 = "WITH row WHERE row['chemical_key_from'] IS NOT NULL MATCH (c:Chemical \
+{chemical_key: row['chemical_key_from']}), (a:Action {step_id: row['step_to'], sample_id: row['sample_id'], \
+batch_id: row['batch_id']}) MERGE (c)-[:GOES_INTO]->(a)"
+        bodies = [body_0, "WITH row WHERE row['chemical_key_from'] IS NULL " + body_1] + bodies[1:]
+    return [load_csv_batched(filepath, body, stored_folder, batch_size, legacy) for body in bodies]
+
+def save_batch_queries(batch_dict, replaced = (), stored_folder = '', batch_size = 1000, legacy = False,
+                       shared_chemicals = False):
+    """
+    Creates the output.cypher file that loads one chem, one action and one link csv per batch
+    (see pipeline.combine_batch_csvs) instead of three csv files per sample.
+    The constraints are created first, then the nodes and links are merged in transactions of
+    batch_size rows, so running the file again does not duplicate anything.
+    
+    :param batch_dict: dictionary with the chem, action and link csv file of each batch
+    :param replaced: optional list of (batch_id, sample_id) of samples to delete before loading,
+        see save_queries
+    :param legacy: use the Neo4j 4.x syntax, see create_constraints and load_csv_batched
+    :param shared_chemicals: the chemicals are shared nodes, see save_queries
+    """
+    queries = create_constraints(legacy)
+    if shared_chemicals:
+        queries.append(shared_key_constraint(legacy))
+    queries += [delete_sample(batch_id, sample_id) for batch_id, sample_id in replaced]
+    
+    with stage('queries') as record:
+        for batch in batch_dict:
+            chem_file = batch_dict[batch]['chem']
+            action_file = batch_dict[batch]['action']
+            if shared_chemicals:
+                queries += merge_shared_nodes(chem_file, find_columns(chem_file), stored_folder, batch_size, legacy)
+            else:
+                queries.append(merge_nodes(chem_file, 'chem', find_columns(chem_file), 
+                                           stored_folder, batch_size, legacy))
+            queries.append(merge_nodes(action_file, 'action', find_columns(action_file), 
+                                       stored_folder, batch_size, legacy))
+            queries += merge_links(batch_dict[batch]['link'], stored_folder, batch_size, legacy, shared_chemicals)
+        
+        output = open('output.cypher', 'w')
+        output.write('\n'.join(queries))
+        output.close()
+        record['rows'] = len(queries)
+        record['bytes'] = file_size('output.cypher')
+    return
@@ -0,0 +1,168 @@
+from os import makedirs
+from os.path import isdir, join
+from zlib import crc32
+
+import numpy as np
+import pandas as pd
+
+# process parameters of a sample, in the order of the feature vector. The numbered features are
+# taken from the first and second drop, spin step or Mix solution of the sample
+process_features = ['mix1_molarity', 'mix1_volume', 'mix2_volume',
+                    'drop_rate_1', 'drop_height_1', 'drop_time_1', 'drop_rate_2', 'drop_height_2', 'drop_time_2',
+                    'spin_rpm_1', 'spin_duration_1', 'spin_acceleration_1',
+                    'spin_rpm_2', 'spin_duration_2', 'spin_acceleration_2',
+                    'anneal_temperature', 'anneal_duration', 'rest_duration']
+# the chemicals are hashed into a fixed number of features, so the width of the vectors does not
+# depend on the chemicals of the archive
+chemical_buckets = 16
+feature_names = process_features + ['chemical_' + str(i) for i in range(chemical_buckets)]
+
+def nth_value(df, action, col, n):
+    """Value of col in the n-th row (from 1) of the action, as a float, NaN when missing"""
+    if col not in df.columns:
+        return np.nan
+    values = pd.to_numeric(df.loc[df['action'] == action, col], errors='coerce').to_numpy(dtype=float)
+    return values[n - 1] if len(values) >= n else np.nan
+
+def chemical_bucket(content, chem_type):
+    return crc32((str(content) + ':' + str(chem_type)).encode()) % chemical_buckets
+
+def sample_features(chem_df, action_df):
+    """
+    Feature vector of a sample from its chem and action tables: the process parameters of
+    process_features, then the chemicals, with the concentration of each solute and solvent (1
+    for the recipes and antisolvents without one) added to the feature of its hash bucket.
+
+    :return: float32 array of len(feature_names) values, NaN for the missing parameters
+    """
+    res = np.full(len(feature_names), np.nan, dtype=np.float32)
+    values = {}
+    solutions = chem_df[chem_df['chem_type'] == 'solution']
+    for n in [1, 2]:
+        if solutions.shape[0] >= n:
+            values['mix{}_volume'.format(n)] = pd.to_numeric(solutions['volume'], errors='coerce').iat[n - 1]
+    if solutions.shape[0] >= 1:
+        values['mix1_molarity'] = pd.to_numeric(solutions['molarity'], errors='coerce').iat[0]
+    for n in [1, 2]:
+        for col in ['rate', 'height', 'time']:
+            values['drop_{}_{}'.format(col, n)] = nth_value(action_df, 'drop', 'drop_' + col, n)
+        for col in ['rpm', 'duration', 'acceleration']:
+            values['spin_{}_{}'.format(col, n)] = nth_value(action_df, 'spin', 'spin_' + col, n)
+    for col in ['anneal_temperature', 'anneal_duration']:
+        values[col] = nth_value(action_df, 'anneal', col, 1)
+    values['rest_duration'] = nth_value(action_df, 'rest', 'rest_duration', 1)
+    for i, name in enumerate(process_features):
+        res[i] = values.get(name, np.nan)
+
+    chemicals = chem_df[chem_df['chem_type'] != 'solution']
+    if chemicals.shape[0] > 0:
+        res[len(process_features):] = 0
+        concentrations = pd.to_numeric(chemicals['concentration'], errors='coerce').fillna(1).to_numpy()
+        for content, chem_type, concentration in zip(chemicals['content'], chemicals['chem_type'], concentrations):
+            res[len(process_features) + chemical_bucket(content, chem_type)] += concentration
+    return res
+
+class SimilarityIndex:
+    """
+    Feature vectors of samples (see sample_features) in a float32 matrix, for nearest neighbor
+    queries. Samples can be added at any time, the matrix grows by doubling its capacity and a
+    sample added again replaces its vector.
+    The features are standardized (by the mean and standard deviation of each feature over the
+    samples, missing features count as the mean) and the neighbors are the closest samples by
+    euclidean distance. The standardized matrix is kept between queries until samples are added.
+    A query is an exact scan of the whole matrix rather than an approximate index: it stays under
+    a millisecond up to roughly 25000 samples and grows linearly beyond (see
+    benchmark.benchmark_similarity).
+    """
+    def __init__(self, capacity = 1024):
+        self.matrix = np.empty((capacity, len(feature_names)), dtype=np.float32)
+        self.samples = []
+        self.rows = {}
+        self.scaled = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, batch_id, sample_id, features):
+        key = (batch_id, sample_id)
+        if key in self.rows:
+            self.matrix[self.rows[key]] = features
+        else:
+            if len(self.samples) == self.matrix.shape[0]:
+                matrix = np.empty((2 * self.matrix.shape[0], self.matrix.shape[1]), dtype=np.float32)
+                matrix[:len(self.samples)] = self.matrix[:len(self.samples)]
+                self.matrix = matrix
+            self.rows[key] = len(self.samples)
+            self.matrix[len(self.samples)] = features
+            self.samples.append(key)
+        self.scaled = None
+
+    def features(self):
+        """Feature matrix of the samples, as a DataFrame"""
+        index = pd.MultiIndex.from_tuples(self.samples, names=['batch_id', 'sample_id'])
+        return pd.DataFrame(self.matrix[:len(self.samples)], index=index, columns=feature_names)
+
+    def prepare(self):
+        """Standardizes the matrix and keeps the squared norms of its rows, for query"""
+        matrix = self.matrix[:len(self.samples)]
+        counts = np.maximum((~np.isnan(matrix)).sum(axis=0), 1)
+        self.mean = (np.nansum(matrix, axis=0) / counts).astype(np.float32)
+        std = np.sqrt(np.nansum((matrix - self.mean) ** 2, axis=0) / counts)
+        self.std = np.where(std == 0, 1, std).astype(np.float32)
+        self.scaled = np.nan_to_num((matrix - self.mean) / self.std).astype(np.float32)
+        self.norms = (self.scaled ** 2).sum(axis=1)
+
+    def query(self, features, k = 5, exclude = None):
+        """
+        The k samples closest to a feature vector.
+
+        :param exclude: optional (batch_id, sample_id) left out of the results
+        :return: DataFrame with the batch_id, sample_id and distance of the samples, closest first
+        """
+        if self.scaled is None:
+            self.prepare()
+        q = np.nan_to_num((np.asarray(features, dtype=np.float32) - self.mean) / self.std).astype(np.float32)
+        distances = self.norms - 2 * (self.scaled @ q) + (q ** 2).sum()
+        if exclude in self.rows:
+            distances[self.rows[exclude]] = np.inf
+        k = min(k, len(self.samples) - (exclude in self.rows))
+        if k <= 0:
+            return pd.DataFrame(columns=['batch_id', 'sample_id', 'distance'])
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        return pd.DataFrame({'batch_id': [self.samples[i][0] for i in nearest],
+                             'sample_id': [self.samples[i][1] for i in nearest],
+                             'distance': np.sqrt(np.maximum(distances[nearest], 0))})
+
+    def similar(self, batch_id, sample_id, k = 5):
+        """The k samples closest to a sample of the index, see query"""
+        return self.query(self.matrix[self.rows[(batch_id, sample_id)]], k, exclude=(batch_id, sample_id))
+
+    def save(self, folder):
+        """Saves the matrix as features.npy and the samples of its rows as samples.csv in folder"""
+        makedirs(folder, exist_ok=True)
+        np.save(join(folder, 'features.npy'), self.matrix[:len(self.samples)])
+        pd.DataFrame(self.samples, columns=['batch_id', 'sample_id']).to_csv(join(folder, 'samples.csv'), index=False)
+
+def load_similarity_index(folder):
+    """Loads a SimilarityIndex saved with SimilarityIndex.save, or an empty index when folder does not exist"""
+    index = SimilarityIndex()
+    if not isdir(folder):
+        return index
+    matrix = np.load(join(folder, 'features.npy'))
+    samples = pd.read_csv(join(folder, 'samples.csv'), dtype=str, keep_default_na=False)
+    for key, features in zip(zip(samples['batch_id'], samples['sample_id']), matrix):
+        index.add(key[0], key[1], features)
+    return index
+
+def update_similarity_index(results, folder = 'similarity_index'):
+    """
+    Adds the feature vectors of the results of pipeline.run_pipeline (with features) to the index
+    saved in folder, and saves it again
+    """
+    index = load_similarity_index(folder)
+    for r in results:
+        if r.get('features') is not None:
+            index.add(r['batch_id'], r['sample'], r['features'])
+    index.save(folder)
+    return index
@@ -0,0 +1,186 @@
+from os import listdir, makedirs
+from os.path import isdir, join
+
+import numpy as np
+import pandas as pd
+
+# Time series store of the spin steps. The spincoater_log (time, rpm, ...) and the
+# liquidhandler_timings of a spin step are saved once in a compressed .npz file, one typed
+# array per signal, instead of a copy of the whole log in every spin row. The integer
+# signals are saved as the differences between consecutive values, and the float signals as
+# the xor of the bits of consecutive values (close values share their high bits), which both
+# compress well and are read back exactly.
+
+def encode_signal(values):
+    """Encoded array of a signal and the name of its encoding ('delta', 'xor' or 'raw')"""
+    arr = np.asarray(values)
+    if arr.dtype == object:
+        arr = pd.to_numeric(pd.Series(list(values)), errors='coerce').to_numpy(dtype=float)
+    if arr.ndim != 1 or len(arr) == 0:
+        return arr, 'raw'
+    if arr.dtype.kind in 'iu':
+        arr = arr.astype(np.int64)
+        deltas = np.diff(arr, prepend=0)
+        for dtype in [np.int8, np.int16, np.int32]:
+            info = np.iinfo(dtype)
+            if deltas.min() >= info.min and deltas.max() <= info.max:
+                return deltas.astype(dtype), 'delta'
+        return deltas, 'delta'
+    if arr.dtype.kind == 'f':
+        bits = arr.astype(np.float64).view(np.uint64)
+        return np.bitwise_xor(bits, np.concatenate([np.zeros(1, dtype=np.uint64), bits[:-1]])), 'xor'
+    return arr, 'raw'
+
+def decode_signal(arr, encoding):
+    """Values of a signal from its encoded array, see encode_signal"""
+    if encoding == 'delta':
+        return np.cumsum(arr, dtype=np.int64)
+    if encoding == 'xor':
+        return np.bitwise_xor.accumulate(arr).view(np.float64)
+    return arr
+
+def downsample_log(log, interval):
+    """
+    Keeps the first point of every interval seconds of the time signal of a log (a dictionary
+    of signals of the same length), for every signal
+    """
+    if interval == None or 'time' not in log:
+        return log
+    time = np.asarray(log['time'], dtype=float)
+    bins = np.floor((time - time[0]) / interval) if len(time) > 0 else time
+    keep = np.flatnonzero(np.concatenate([[True], bins[1:] != bins[:-1]])) if len(time) > 0 else []
+    return {name: np.asarray(values)[keep] if len(values) == len(time) else values for name, values in log.items()}
+
+def spin_log_filename(batch_id, sample_id, step_id):
+    """Name of the .npz file of the log of a spin step, e.g. 'b19_sample0_spin_log_5.npz'"""
+    return (batch_id + '_' + sample_id + '_spin_log_' + str(step_id) + '.npz').replace(' ', '_')
+
+def save_spin_log(path, log, timings = None, interval = None):
+    """
+    Saves a spincoater_log (dictionary of signals) and optionally the liquidhandler_timings
+    (dictionary of times by event) of a spin step in a compressed .npz file.
+
+    :param interval: optional number of seconds, the log is downsampled to one point per interval
+    :return: number of points of the log that were saved
+    """
+    log = downsample_log(log, interval)
+    arrays = {}
+    names, encodings = [], []
+    for name, values in log.items():
+        arrays['signal_' + str(name)], encoding = encode_signal(values)
+        names.append(str(name))
+        encodings.append(encoding)
+    arrays['names'] = np.array(names, dtype=str)
+    arrays['encodings'] = np.array(encodings, dtype=str)
+    timings = timings or {}
+    arrays['timing_events'] = np.array([str(k) for k in timings], dtype=str)
+    arrays['timings'] = pd.to_numeric(pd.Series(list(timings.values()), dtype=object),
+                                      errors='coerce').to_numpy(dtype=float)
+    np.savez_compressed(path, **arrays)
+    return max([len(np.atleast_1d(v)) for v in log.values()], default=0)
+
+def load_spin_log(ref, store = ''):
+    """
+    Reads a spin log saved by save_spin_log.
+
+    :param ref: the 'spin_log' value of the spin row
+    :return: dictionary of the decoded signals, and the liquidhandler_timings as a Series
+    """
+    with np.load(join(store, ref)) as f:
+        signals = {str(name): decode_signal(f['signal_' + name], encoding)
+                   for name, encoding in zip(f['names'], f['encodings'])}
+        timings = pd.Series(f['timings'], index=f['timing_events'].tolist(), dtype=float)
+    return signals, timings
+
+def same_values(a, b):
+    return all(x is y or (isinstance(x, (list, dict)) and x == y) or
+               (not isinstance(x, (list, dict)) and not isinstance(y, (list, dict)) and pd.isna(x) and pd.isna(y))
+               for x, y in zip(a, b))
+
+def store_spin_logs(action_df, store, batch_id, sample_id, interval = None):
+    """
+    Saves the spin logs of an action table in the store folder (see save_spin_log), one file
+    per spin step (the spin rows of a step share its log), and replaces the spin_log_* and
+    liquidhandler_timings columns with the name of the file ('spin_log') and the number of
+    points saved ('spin_log_points').
+
+    :param interval: optional number of seconds the logs are downsampled to
+    """
+    log_cols = [col for col in action_df.columns if str(col).startswith('spin_log_')]
+    timing_col = 'liquidhandler_timings' if 'liquidhandler_timings' in action_df.columns else None
+    cols = log_cols + ([timing_col] if timing_col != None else [])
+    if len(cols) == 0:
+        return action_df
+    makedirs(store, exist_ok=True)
+    refs = [np.nan] * action_df.shape[0]
+    points = [np.nan] * action_df.shape[0]
+    previous, ref, n = None, None, None
+    for r in range(action_df.shape[0]):
+        values = [action_df[col].iat[r] for col in cols]
+        if all(not isinstance(v, (list, dict)) and pd.isna(v) for v in values):
+            previous = None
+            continue
+        # the next spin rows of the same step carry the same log
+        if previous == None or not same_values(values, previous):
+            log = {col[len('spin_log_'):]: v for col, v in zip(log_cols, values) if isinstance(v, list)}
+            timings = values[-1] if timing_col != None and isinstance(values[-1], dict) else None
+            ref = spin_log_filename(batch_id, sample_id, action_df['step_id'].iat[r])
+            n = save_spin_log(join(store, ref), log, timings, interval)
+            previous = values
+        refs[r] = ref
+        points[r] = n
+
+    res = action_df.drop(columns=cols)
+    res['spin_log'] = refs
+    res['spin_log_points'] = pd.array(points, dtype='Int64')
+    return res
+
+class SpinLogStore:
+    """
+    Reader of the spin logs of a store folder (see store_spin_logs), to read time windows of the
+    logs of many samples at once.
+
+    :param folder: the store folder
+    """
+    def __init__(self, folder):
+        self.folder = folder
+
+    def keys(self):
+        """Names of the log files of the store, the spin_log values of the spin rows"""
+        if not isdir(self.folder):
+            return []
+        return sorted([f for f in listdir(self.folder) if f.endswith('.npz')])
+
+    def read(self, key):
+        """Decoded signals and timings of a log, see load_spin_log"""
+        return load_spin_log(key, self.folder)
+
+    def window(self, keys = None, start = 0, stop = np.inf, signals = None):
+        """
+        Points of the logs between start and stop seconds (start included), as one DataFrame
+        with the key of each point's log, its time and the signals.
+
+        :param keys: optional list of log keys, by default every log of the store
+        :param signals: optional list of signals, by default every signal of the logs
+        """
+        if keys == None:
+            keys = self.keys()
+        frames = []
+        for key in keys:
+            log, timings = self.read(key)
+            if 'time' not in log:
+                continue
+            lo, hi = np.searchsorted(log['time'], [start, stop])
+            frame = {name: values[lo:hi] for name, values in log.items()
+                     if name == 'time' or signals == None or name in signals}
+            frames.append(pd.DataFrame(frame).assign(key=key))
+        if len(frames) == 0:
+            return pd.DataFrame(columns=['key', 'time'])
+        res = pd.concat(frames, ignore_index=True)
+        return res[['key', 'time'] + [col for col in res.columns if col not in ['key', 'time']]]
+
+    def timings(self, keys = None):
+        """liquidhandler_timings of the logs, one row per log and one column per event"""
+        if keys == None:
+            keys = self.keys()
+        return pd.DataFrame({key: self.read(key)[1] for key in keys}).T
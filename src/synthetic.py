@@ -0,0 +1,196 @@
+from os import makedirs
+from os.path import join
+from json import dump
+from uuid import UUID
+from tifffile import imwrite
+
+import numpy as np
+
+from etl import find_batch
+
+# recipes the synthetic drops are made of, in the formats chem_table handles:
+# 'Name0.5_Other0.5' strings are split into chemicals, anything else is a recipe name
+solutes = ['Xu-Recipe-PSK', 'FA0.78_MA0.10_Cs0.12', 'MA1.0_Pb1.0', 'Cs0.17_FA0.83']
+solvents = ['DMF0.75_DMSO0.25', 'DMF0.80_DMSO0.20', 'DMSO1.0']
+antisolvents = ['MethylAcetate', 'Chlorobenzene', 'Toluene']
+
+# characterization tasks as they appear in the characterization worklist
+char_task_templates = {
+    'PL_635nm': {'details': {'exposure_times': [0.1, 5, 20], 'num_scans': 1},
+                 'duration': 25.32, 'position': 286, 'station': 'pl_red'},
+    'Transmission': {'details': {'exposure_times': [0.02, 0.05, 0.2, 1, 5, 15], 'num_scans': 2},
+                     'duration': 46.54, 'position': 286, 'station': 'transmission'},
+    'PLImaging': {'details': {'exposure_times': [0.1], 'num_frames': 1},
+                  'duration': 0.1, 'position': 81.0, 'station': 'pl_imaging'},
+    'Darkfield': {'details': {'exposure_time': 0.05, 'num_frames': 50},
+                  'duration': 2.5, 'position': 81.0, 'station': 'darkfield'},
+    'Brightfield': {'details': {'exposure_time': 0.05, 'num_frames': 1},
+                    'duration': 0.05, 'position': 164.4, 'station': 'brightfield'}
+}
+
+def step_id(name, rng):
+    return name + '-' + str(UUID(bytes=rng.bytes(16)))
+
+def worklist_step(name, details, precedent, sample, start, duration, rng, extra = {}):
+    """One step of a worklist, with the timing keys of the real worklists and the extra keys"""
+    step = {'details': details, 'id': step_id(name, rng), 'name': name,
+            'precedent': precedent['id'] if precedent != None else None, 'sample': sample,
+            'start': int(start), 'start_actual': start + rng.uniform(0, 30)}
+    step.update(extra)
+    step['finish_actual'] = step['start_actual'] + duration
+    return step
+
+def synthetic_drop(i, rng):
+    """The first drop is a perovskite solution, the next ones are antisolvents"""
+    drop = {'air_gap': True, 'blow_out': True, 'height': 2 if i == 0 else 0.5, 'pre_mix': [3, 50],
+            'rate': 80 if i == 0 else float(rng.choice([150.0, 300.0, 450.0])),
+            'reuse_tip': i > 0, 'slow_retract': True, 'slow_travel': i > 0, 'touch_tip': i == 0,
+            'time': -5 if i == 0 else float(rng.choice([10.0, 20.0, 30.0])),
+            'volume': 40 if i == 0 else 75.0}
+    if i == 0:
+        drop['solution'] = {'molarity': float(rng.choice([1.2, 1.4, 1.6])), 'solutes': str(rng.choice(solutes)),
+                            'solvent': str(rng.choice(solvents)), 'well': {'labware': '15mL_Tray1', 'well': 'A4'}}
+    else:
+        drop['solution'] = {'molarity': 0, 'solutes': '', 'solvent': str(rng.choice(antisolvents)),
+                            'well': {'labware': '15mL_Tray1', 'well': 'C' + str(i + 3)}}
+    return drop
+
+def synthetic_process_sample(sample, rng, drops = 2, spin_steps = 1, anneal = True, rest = True, log_points = 440):
+    """
+    Process worklist entry of a sample: storage -> spincoat (drops and spin steps) -> hotplate,
+    with optional anneal and rest steps.
+    The action and link tables expect at least 2 drops (a solution and an antisolvent).
+    """
+    worklist = []
+    t = float(rng.uniform(0, 10000))
+    step = worklist_step('storage_to_spincoater', {'destination': 'SpincoaterLiquidhandler', 'source': 'Tray2'},
+                         None, sample, t, 25, rng)
+    worklist.append(step)
+
+    spin = [{'acceleration': 2000.0, 'duration': float(rng.choice([30.0, 50.0, 60.0])),
+             'rpm': float(rng.choice([2000.0, 4000.0, 5000.0]))} for i in range(spin_steps)]
+    spin_duration = sum(s['duration'] for s in spin)
+    log_time = np.linspace(0, spin_duration + 40, log_points)
+    log_rpm = np.interp(log_time, [0, 5, 5 + spin_duration, log_time[-1]], [0, spin[0]['rpm'], spin[-1]['rpm'], 0])
+    details = {'drops': [synthetic_drop(i, rng) for i in range(drops)], 'duration': int(spin_duration + 60),
+               'start_times': [5], 'steps': spin}
+    timings = {}
+    for i in range(drops):
+        for action in ['aspirate', 'dispense', 'stage']:
+            timings[action + '_solution' + str(i)] = float(rng.uniform(10, 70))
+    timings['clear_chuck_between_drops'] = float(rng.uniform(20, 30))
+    step = worklist_step('spincoat', details, step, sample, t + 30, spin_duration + 60, rng,
+                         {'headstart': float(rng.uniform(20, 40)), 'liquidhandler_timings': timings,
+                          'spincoater_log': {'rpm': log_rpm.tolist(), 'time': log_time.tolist()}})
+    worklist.append(step)
+
+    t += 150
+    step = worklist_step('spincoater_to_hotplate', {'destination': 'Hotplate1', 'source': 'SpincoaterLiquidhandler'},
+                         step, sample, t, 28, rng)
+    worklist.append(step)
+    if anneal:
+        duration = int(rng.choice([600, 1200, 1800]))
+        step = worklist_step('anneal', {'duration': duration, 'hotplate': 'Hotplate1',
+                                        'temperature': int(rng.choice([70, 100, 150]))},
+                             step, sample, t + 30, duration, rng)
+        worklist.append(step)
+        t += duration
+    step = worklist_step('hotplate_to_storage', {'destination': 'Tray2', 'source': 'Hotplate1'},
+                         step, sample, t + 40, 17, rng)
+    worklist.append(step)
+    if rest:
+        step = worklist_step('rest', {'duration': 300}, step, sample, t + 60, 300, rng)
+        worklist.append(step)
+
+    return {'hotplate_slot': {'hotplate': 'Hotplate1', 'slot': 'D4'}, 'name': sample,
+            'storage_slot': {'slot': 'A1', 'tray': 'Tray2'}, 'substrate': 'Glass', 'worklist': worklist}
+
+def synthetic_char_sample(sample, rng, char_tasks = tuple(char_task_templates)):
+    """Characterization worklist entry of a sample, with the given characterization tasks"""
+    step = worklist_step('storage_to_characterization', {'destination': 'Characterization', 'source': 'Tray2'},
+                         None, sample, 0, 15, rng)
+    worklist = [step]
+    tasks = [dict(char_task_templates[name], name=name) for name in char_tasks]
+    step = worklist_step('characterize', {'characterization_tasks': tasks}, step, sample, 15,
+                         sum(task['duration'] for task in tasks), rng, {'duration': 125})
+    worklist.append(step)
+    step = worklist_step('characterization_to_storage', {'destination': 'Tray2', 'source': 'Characterization'},
+                         step, sample, 140, 11, rng)
+    worklist.append(step)
+    return {'name': sample, 'storage_slot': {'slot': 'A1', 'tray': 'Tray2'}, 'substrate': 'PSK', 'worklist': worklist}
+
+def write_spectrum(fid, header, wavelength, values):
+    """Writes a spectrum csv in the layout of the instruments: the header rows, then one row per wavelength"""
+    f = open(fid, 'w')
+    for row in header:
+        f.write(','.join(row) + '\n')
+    for i in range(len(wavelength)):
+        f.write(','.join([str(round(wavelength[i], 2))] + [str(v) for v in values[i]]) + '\n')
+    f.close()
+
+def write_char_outputs(folder, sample, rng, char_tasks = tuple(char_task_templates), points = 2048, image_size = 128):
+    """
+    Writes fake outputs of the characterization tasks in <folder>/<sample>/characterization0:
+    a PL csv (one column per exposure time), a transmission csv, and one RGB tiff per imaging task
+    (one per exposure time for PLImaging).
+    """
+    path = join(folder, sample, 'characterization0')
+    makedirs(path, exist_ok=True)
+    wavelength = np.linspace(178.95, 1100, points)
+    for name in char_tasks:
+        task = char_task_templates[name]
+        if name.startswith('PL_'):
+            times = task['details']['exposure_times']
+            peak = rng.uniform(700, 800)
+            counts = np.exp(-((wavelength - peak) / rng.uniform(15, 40)) ** 2)
+            values = np.round(np.outer(counts, times) * 1000 + rng.poisson(30, (points, len(times))), 1)
+            write_spectrum(join(path, sample + '_pl.csv'),
+                           [['Dwelltimes (s)'] + [str(t) for t in times], ['Wavelength (nm)'] + ['PL (counts)'] * len(times)],
+                           wavelength, values.tolist())
+        elif name == 'Transmission':
+            edge = rng.uniform(750, 800)
+            values = 1 / (1 + np.exp(-(wavelength - edge) / 10)) + rng.normal(0, 0.01, points)
+            write_spectrum(join(path, sample + '_transmission.csv'), [['Wavelength (nm)', 'Transmission (0-1)']],
+                           wavelength, values[:, None].tolist())
+        elif image_size != None:
+            fids = [sample + '_' + name.lower() + '.tif']
+            if name == 'PLImaging':
+                fids = [sample + '_plimaging_' + str(t) + '.tif' for t in task['details']['exposure_times']]
+            for fid in fids:
+                imwrite(join(path, fid), rng.integers(0, 256, (image_size, image_size, 3), dtype=np.uint8))
+
+def make_batch(directory, samples = 10, batch_id = 'syn', drops = 2, spin_steps = 1, anneal = True, rest = True,
+               char_tasks = tuple(char_task_templates), points = 2048, image_size = 128, seed = 0):
+    """
+    Writes a synthetic batch in the layout etl.find_batch expects: <batch_id>_process.json,
+    <batch_id>_char.json and a Characterization_<BATCH_ID> folder with the outputs of every sample.
+    The same seed always gives the same batch.
+
+    :param samples: number of samples (sample0, sample1, ...)
+    :param drops: number of drops per spincoat step, at least 2
+    :param spin_steps: number of spin steps per spincoat step
+    :param anneal, rest: whether the samples have an anneal and a rest step
+    :param char_tasks: names of the characterization tasks, from char_task_templates
+    :param points: number of wavelengths of the PL and transmission spectra
+    :param image_size: width and height of the tiffs, None to write no images
+    :return: the batch, as returned by etl.find_batch
+    """
+    rng = np.random.default_rng(seed)
+    char_folder = join(directory, 'Characterization_' + batch_id.upper())
+    makedirs(char_folder, exist_ok=True)
+
+    process = {}
+    char = {}
+    for i in range(samples):
+        sample = 'sample' + str(i)
+        process[sample] = synthetic_process_sample(sample, rng, drops, spin_steps, anneal, rest)
+        char[sample] = synthetic_char_sample(sample, rng, char_tasks)
+        write_char_outputs(char_folder, sample, rng, char_tasks, points, image_size)
+
+    f = open(join(directory, batch_id + '_process.json'), 'w')
+    dump(process, f)
+    f.close()
+    f = open(join(directory, batch_id + '_char.json'), 'w')
+    dump(char, f)
+    f.close()
+    return find_batch(directory)
@@ -0,0 +1,61 @@
+import sys
+from os.path import dirname, join
+
+import numpy as np
+from tifffile import imwrite, imread
+
+sys.path.insert(0, join(dirname(__file__), '..', 'src'))
+
+from action_feature import load_image, to_greyscale
+
+def baseline_greyscale(fid):
+    # load_image before the images were converted in blocks
+    img = imread(fid) * 64 * 255
+    img = img.astype(np.float32)
+    img = np.dot(img[...,:3], [0.2989, 0.5870, 0.1140])
+    return img.astype(int)
+
+def test_rgb_stack(tmp_path):
+    rng = np.random.default_rng(0)
+    fid = str(tmp_path / 'stack.tif')
+    imwrite(fid, rng.random((5, 16, 16, 3), dtype=np.float32), photometric='rgb')
+    res = load_image(fid)
+    expected = baseline_greyscale(fid)
+    assert res.shape == expected.shape == (5, 16, 16)
+    # the blocks are weighted in float32, the baseline in float64
+    assert np.abs(res - expected).max() <= 1
+
+def test_rgb_stack_preview(tmp_path):
+    rng = np.random.default_rng(1)
+    fid = str(tmp_path / 'stack.tif')
+    imwrite(fid, rng.random((3, 16, 16, 3), dtype=np.float32), photometric='rgb')
+    assert load_image(fid, preview=4).shape == (3, 4, 4)
+
+def test_single_frame(tmp_path):
+    rng = np.random.default_rng(2)
+    fid = str(tmp_path / 'rgb.tif')
+    imwrite(fid, rng.random((16, 16, 3), dtype=np.float32), photometric='rgb')
+    assert np.abs(load_image(fid) - baseline_greyscale(fid)).max() <= 1
+
+class RecordedImage:
+    """Image that records the shape of the blocks read from it"""
+    def __init__(self, img):
+        self.img = img
+        self.shape = img.shape
+        self.ndim = img.ndim
+        self.blocks = []
+
+    def __getitem__(self, key):
+        block = self.img[key]
+        self.blocks.append(block.shape)
+        return block
+
+def test_stack_blocks():
+    rng = np.random.default_rng(3)
+    img = RecordedImage(rng.random((2, 3, 40, 8, 3), dtype=np.float32))
+    res = to_greyscale(img, block_rows=16)
+    assert res.shape == (2, 3, 40, 8)
+    # one frame and at most block_rows rows at a time
+    assert len(img.blocks) == 2 * 3 * 3
+    assert max(img.blocks) == (16, 8, 3)
+    assert np.array_equal(res, to_greyscale(img.img))
@@ -0,0 +1,43 @@
+import sys
+import json
+from os.path import dirname, join
+
+sys.path.insert(0, join(dirname(__file__), '..', 'src'))
+
+from synthetic import make_batch
+from pipeline import run_pipeline
+from batch_output import load_output_index, read_sample_rows
+
+def sample_rows(filepath):
+    index = load_output_index(join(filepath, 'output_index.csv'))
+    return {(sample, table): read_sample_rows(index, batch_id, sample, table, filepath).to_csv(index=False)
+            for batch_id, sample, table in zip(index['batch_id'], index['sample_id'], index['table'])}
+
+def test_rerun_with_manifest(tmp_path):
+    batch = make_batch(str(tmp_path / 'batch'), 3, image_size=8, points=64)
+    out = tmp_path / 'out'
+    out.mkdir()
+    options = {'workers': 1, 'filepath': str(out), 'manifest_file': str(tmp_path / 'manifest.csv'),
+               'batch_output': True}
+    run_pipeline(str(tmp_path / 'batch'), **options)
+    first = sample_rows(str(out))
+    assert len(first) == 9
+
+    # nothing changed, every sample stays in the batch files and the index
+    results = run_pipeline(str(tmp_path / 'batch'), **options)
+    assert not any(r['changed'] for r in results)
+    assert sample_rows(str(out)) == first
+
+    process = json.load(open(batch['process_file']))
+    for entry in process['sample1']['worklist']:
+        for drop in entry['details'].get('drops', []):
+            drop['volume'] += 10
+    json.dump(process, open(batch['process_file'], 'w'))
+    results = run_pipeline(str(tmp_path / 'batch'), **options)
+    assert [r['sample'] for r in results if r['changed']] == ['sample1']
+    rows = sample_rows(str(out))
+    assert set(rows) == set(first)
+    assert any(rows[key] != first[key] for key in first if key[0] == 'sample1')
+    for key in first:
+        if key[0] != 'sample1':
+            assert rows[key] == first[key]
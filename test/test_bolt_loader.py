@@ -0,0 +1,56 @@
+import sys
+from os.path import dirname, join
+
+import pytest
+
+sys.path.insert(0, join(dirname(__file__), '..', 'src'))
+
+from pipeline import run_pipeline
+from bolt_loader import (MemoryGraph, TransientWriteError, load_samples, write_batches, read_sample_frames,
+                         result_frames)
+
+testdata = join(dirname(__file__), 'testdata')
+
+def test_tables_and_csv_files(tmp_path):
+    results = run_pipeline(testdata, workers=1, filepath=str(tmp_path), return_tables=True)
+    file_dict = {(r['batch_id'], r['sample']): r for r in results}
+    from_csv = MemoryGraph()
+    assert load_samples(from_csv, read_sample_frames(file_dict, str(tmp_path))) == 1
+    from_tables = MemoryGraph()
+    assert load_samples(from_tables, result_frames(results)) == 1
+
+    assert len(from_tables.nodes['Chemical']) == 6
+    assert len(from_tables.nodes['Action']) == 15
+    assert {r[0] for r in from_tables.relationships} == {'GOES_INTO', 'OUTPUTS', 'NEXT'}
+    # the nodes are the same as with the csv files read back as text
+    assert from_tables.nodes == from_csv.nodes
+    assert from_tables.relationships == from_csv.relationships
+    assert all(isinstance(v, str) for node in from_tables.nodes['Action'].values() for v in node.values())
+
+def test_retries():
+    rows = [{'chemical_id': str(i), 'sample_id': 's', 'batch_id': 'b'} for i in range(5)]
+    graph = MemoryGraph(failures=2)
+    write_batches(graph, 'chem', rows, batch_size=2, max_retries=2, backoff=0)
+    assert graph.writes == 3
+    assert len(graph.nodes['Chemical']) == 5
+
+    graph = MemoryGraph(failures=3)
+    with pytest.raises(TransientWriteError):
+        write_batches(graph, 'chem', rows, batch_size=2, max_retries=2, backoff=0)
+    assert graph.writes == 0
+
+def test_replaced_samples(tmp_path):
+    results = run_pipeline(testdata, workers=1, filepath=str(tmp_path), return_tables=True)
+    chem_df, action_df, link_df = next(result_frames([dict(results[0])]))
+    graph = MemoryGraph()
+    load_samples(graph, [(chem_df, action_df, link_df)])
+    assert len(graph.nodes['Action']) == 15
+
+    # the sample is processed again with fewer steps, its previous nodes are deleted first
+    action_df = action_df[action_df['action'] != 'char_output']
+    link_df = link_df[link_df['step_to'].isin(action_df['step_id']) | link_df['step_to'].isna()]
+    load_samples(graph, [(chem_df, action_df, link_df)], replaced=[('b19', 'sample0')])
+    assert len(graph.nodes['Action']) == action_df.shape[0] < 15
+    assert len(graph.nodes['Chemical']) == 6
+    # no relationship is left to a deleted node
+    assert all(r[2] in graph.nodes[r[1]] and r[4] in graph.nodes[r[3]] for r in graph.relationships)
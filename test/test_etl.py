@@ -0,0 +1,61 @@
+import sys
+import json
+import tracemalloc
+from os.path import dirname, join
+
+import numpy as np
+
+sys.path.insert(0, join(dirname(__file__), '..', 'src'))
+
+from etl import stream_json_items
+
+def random_value(rng, depth = 0):
+    kind = rng.integers(0, 7 if depth < 3 else 4)
+    if kind == 0:
+        return int(rng.integers(-10 ** 6, 10 ** 6))
+    if kind == 1:
+        return float(rng.normal() * 10.0 ** rng.integers(-8, 8))
+    if kind == 2:
+        return ['x', 'a "quoted" b', '', 'ünïcode'][rng.integers(0, 4)]
+    if kind == 3:
+        return [None, True, False][rng.integers(0, 3)]
+    if kind == 4:
+        return [random_value(rng, depth + 1) for i in range(rng.integers(0, 4))]
+    return {'k' + str(i): random_value(rng, depth + 1) for i in range(rng.integers(0, 4))}
+
+def test_numbers_at_chunk_boundaries(tmp_path):
+    fid = str(tmp_path / 'numbers.json')
+    for text in ['{"a": 0.1}', '{"a": 1.5e3}', '{"a": -12, "b": 3E-2}']:
+        open(fid, 'w').write(text)
+        for chunk_size in range(1, len(text) + 2):
+            assert dict(stream_json_items(fid, chunk_size)) == json.loads(text)
+
+def test_chunk_size_fuzz(tmp_path):
+    rng = np.random.default_rng(0)
+    fid = str(tmp_path / 'fuzz.json')
+    for i in range(200):
+        obj = {'s' + str(j): random_value(rng) for j in range(rng.integers(0, 5))}
+        f = open(fid, 'w')
+        json.dump(obj, f, indent=[None, 1][i % 2])
+        f.close()
+        expected = json.load(open(fid))
+        for chunk_size in [1, 2, 3, 5, 8, 13, 64]:
+            assert dict(stream_json_items(fid, chunk_size)) == expected
+
+def test_bounded_memory(tmp_path):
+    fid = str(tmp_path / 'large.json')
+    sample = {'worklist': [{'name': 'spin', 'details': {'rpm': 3000, 'log': list(range(50))}}] * 5}
+    f = open(fid, 'w')
+    json.dump({'sample' + str(i): sample for i in range(5000)}, f)
+    f.close()
+    tracemalloc.start()
+    try:
+        count = 0
+        for key, value in stream_json_items(fid, 4096):
+            count += 1
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert count == 5000
+    # the file is about 5 MB, only a few chunks and one sample are kept at a time
+    assert peak < 2 ** 20
@@ -0,0 +1,28 @@
+import sys
+import asyncio
+from os import remove
+from os.path import dirname, join
+
+sys.path.insert(0, join(dirname(__file__), '..', 'src'))
+
+from synthetic import make_batch
+from ingest import IngestDaemon
+
+def test_failed_sample(tmp_path, capsys):
+    batch = make_batch(str(tmp_path / 'batch'), 2, image_size=8, points=64)
+    folder = join(batch['char_folder'], 'sample1', 'characterization0')
+    open(join(folder, 'sample1_darkfield.tif'), 'wb').write(b'not a tiff')
+    daemon = IngestDaemon(str(tmp_path / 'batch'), filepath=str(tmp_path), cypher_folder=str(tmp_path / 'cypher'),
+                          interval=0.05, settle=0, workers=1)
+    asyncio.run(daemon.run(1.0))
+    # the corrupt sample is reported once, not at every scan
+    assert capsys.readouterr().out.count('could not ingest syn sample1') == 1
+    assert daemon.processed == 1
+    assert list(daemon.watcher.errors()) == [('syn', 'sample1')]
+
+    # it is processed again once its inputs change
+    remove(join(folder, 'sample1_darkfield.tif'))
+    asyncio.run(daemon.run(1.0))
+    assert 'could not ingest' not in capsys.readouterr().out
+    assert daemon.processed == 2
+    assert daemon.watcher.errors() == {}
@@ -0,0 +1,26 @@
+import sys
+from os.path import dirname, join
+
+import pytest
+
+sys.path.insert(0, join(dirname(__file__), '..', 'src'))
+
+import instrument
+from instrument import stage, helper
+
+def test_failed_stage():
+    instrument.enable()
+    try:
+        with pytest.raises(ValueError):
+            with stage('action', 'b19', 'sample0'):
+                helper('spin', list, [1, 2])
+                raise ValueError('bad step')
+        with stage('link', 'b19', 'sample0'):
+            pass
+        failed, link = instrument.take_records()
+    finally:
+        instrument.enable(False)
+    assert failed['stage'] == 'action' and failed['error'] == "ValueError('bad step')"
+    assert failed['helpers'] == {'spin': {'calls': 1, 'rows': 2, 'wall': failed['helpers']['spin']['wall']}}
+    # the helpers of the failed stage are not counted in the next one
+    assert 'helpers' not in link and 'error' not in link